@@ -27,6 +27,7 @@
 ############################################################
 
 import sys # Import globally: for stderr output
+import http.server # Import globally: base class of ProgressHandler
 
 # Splash screen shown at launch of program 
 RPAC_SPLASH_STRING = '''\
@@ -41,8 +42,323 @@ RPAC_SPLASH_STRING = '''\
 '''
 
 # Available sections
-RPAC_SECTIONS = ['System', 'Screen', 'Wired', 'Wireless', 'Localization', 
-    'APT', 'Remote', 'SimpChinese']
+RPAC_SECTIONS = ['System', 'Screen', 'Performance', 'Memory', 'Tuning',
+    'Storage', 'Wired', 'Wireless', 'Localization', 'APT', 'Remote',
+    'SimpChinese', 'Benchmark']
+
+# Typical duration (in seconds) of each section on a Model B, used to
+# estimate remaining time of a provisioning run.
+RPAC_SECTION_ESTIMATES = {'System': 15, 'Screen': 1, 'Performance': 1,
+    'Memory': 5, 'Tuning': 1, 'Storage': 1, 'Wired': 10,
+    'Wireless': 30, 'Localization': 240, 'APT': 90, 'Remote': 300,
+    'SimpChinese': 600, 'Benchmark': 60}
+
+# Live provisioning progress, published by the progress exporter
+# (see progress_start()).
+RPAC_PROGRESS = {'section': '', 'step': '', 'started': 0.0,
+    'sectionstarted': 0.0, 'stepstarted': 0.0, 'updated': 0.0,
+    'done': [], 'pending': [], 'failures': [], 'waits': {},
+    'finished': False, 'textfile': None, 'written': 0.0, 'server': None}
+
+# Minimum interval between textfile writes for steps and failures, in
+# seconds (SD card wear). Section boundaries are always written at once.
+RPAC_PROGRESS_INTERVAL = 15
+
+# Run mode: 'run' for normal (first boot) run, 'bake' for running
+# device-independent steps at image build time (see bake_done()).
+RPAC_MODE = 'run'
+
+# State directory of raspi-autoconfig
+RPAC_STATEDIR = '/var/lib/raspi-autoconfig'
+
+# Record of steps done at image build time (bake mode)
+RPAC_BAKEFILE = RPAC_STATEDIR + '/baked.json'
+
+# Sections including device-independent steps, run in bake mode
+RPAC_BAKE_SECTIONS = ['Localization', 'APT', 'Remote', 'SimpChinese']
+
+# Sections which need network connection.
+RPAC_NETWORK_SECTIONS = ['APT', 'Remote', 'SimpChinese', 'Benchmark']
+
+# Sections run before network stage (fetching config from provisioning
+# server...): network configuration, and local settings before it. The
+# network stage is run as soon as they are done.
+RPAC_PRENETWORK_SECTIONS = ['System', 'Screen', 'Performance', 'Memory',
+    'Tuning', 'Storage', 'Wired', 'Wireless']
+
+# Sections safe to configure again in the same run, if changed on
+# provisioning server after they are done (not [System], which expands
+# root filesystem, nor [Wired]/[Wireless], which restart network).
+RPAC_RERUN_SECTIONS = ['Screen', 'Performance', 'Memory', 'Tuning',
+    'Storage']
+
+# Cached copy of autoconfig.ini fetched from [Fleet].ConfigURL, and its
+# HTTP validators (ETag, Last-Modified)
+RPAC_REMOTE_CONFIG = RPAC_STATEDIR + '/remote.ini'
+RPAC_REMOTE_META = RPAC_STATEDIR + '/remote.json'
+
+# Sections which need a ready kernel entropy pool (ssh-keygen, TLS)
+RPAC_ENTROPY_SECTIONS = ['APT', 'Remote']
+
+# Entropy seed file, refreshed after each run. Seeds the kernel pool of
+# next boot, together with hardware RNG (bcm2708-rng).
+RPAC_ENTROPY_SEED = '/boot/raspi-autoconfig.seed'
+
+# Clock synchronisation at network stage (the Pi has no RTC): SNTP servers
+# ([Time].Servers, host or host:port), then Date header of APT mirror.
+# Last known time is kept on boot partition between boots, like
+# fake-hwclock.
+RPAC_TIME_SERVERS = ['0.debian.pool.ntp.org', '1.debian.pool.ntp.org',
+    '2.debian.pool.ntp.org']
+RPAC_CLOCKFILE = '/boot/raspi-autoconfig.clock'
+
+# Early-boot service mode (raspi-autoconfig.py --service), started by the
+# raspi-autoconfig init script or systemd unit once local filesystems are
+# mounted. Network-dependent sections wait up to RPAC_NETWORK_TIMEOUT
+# seconds for a default route.
+RPAC_SERVICE_NAME = 'raspi-autoconfig'
+RPAC_NETWORK_TIMEOUT = 180
+RPAC_LOCKFILE = '/run/raspi-autoconfig.lock'
+RPAC_LOCK = None
+
+# Deadlines in seconds, see [Deadlines] section. An external command
+# ('command'), memory-heavy command ('heavy', see heavy_call()) or network
+# request ('network') is killed/aborted when it runs out of its own deadline,
+# the deadline of its section, or the deadline of the whole run ('total').
+RPAC_DEADLINES = {'command': 300, 'heavy': 3600, 'network': 30,
+    'total': 14400, 'sections': {}, 'runend': 0.0, 'sectionend': 0.0}
+
+# Hardware watchdog (bcm2708_wdog), pet by a thread until the total deadline,
+# so a wedged run resets the board. An interrupted run is resumed on next
+# boot from RPAC_RESUMEFILE, at most 'attempts' times.
+RPAC_WATCHDOG = {'device': '/dev/watchdog', 'timeout': 15, 'attempts': 3,
+    'file': None, 'stop': None, 'thread': None}
+RPAC_RESUMEFILE = RPAC_STATEDIR + '/resume.json'
+
+# Manifest of everything created or changed on the system (files, init
+# scripts, services enabled/disabled, packages), with backups of edited
+# files, for --uninstall and --rollback. See artifact_edit().
+RPAC_MANIFEST = RPAC_STATEDIR + '/manifest.json'
+RPAC_BACKUPDIR = RPAC_STATEDIR + '/backup'
+RPAC_ARTIFACTS = None
+
+# [Performance] profiles: /boot/config.txt settings per board family (see
+# RPAC_BOARD_FAMILIES). None means firmware default (setting commented
+# out); settings not listed are left unchanged. Clocks below stock clock of
+# the board model (see RPAC_PERFORMANCE_STOCK) are never written.
+RPAC_PERFORMANCE_PROFILES = {
+    'stock': dict((family, {'arm_freq': None, 'core_freq': None,
+        'sdram_freq': None, 'over_voltage': None, 'force_turbo': None,
+        'gpu_mem': None}) for family in ['pi1', 'zero', 'pi2', 'pi3', 'pi4']),
+    'balanced': {
+        'pi1': {'arm_freq': 900, 'core_freq': 250, 'sdram_freq': 450,
+            'over_voltage': 2, 'force_turbo': None, 'gpu_mem': 64},
+        'zero': {'arm_freq': 1000, 'core_freq': 400, 'sdram_freq': 450,
+            'over_voltage': None, 'force_turbo': None, 'gpu_mem': 64},
+        'pi2': {'arm_freq': 1000, 'core_freq': 250, 'sdram_freq': 450,
+            'over_voltage': 2, 'force_turbo': None, 'gpu_mem': 64},
+        'pi3': {'arm_freq': 1300, 'core_freq': 400, 'sdram_freq': 450,
+            'over_voltage': 2, 'force_turbo': None, 'gpu_mem': 64},
+        'pi4': {'arm_freq': 1800, 'core_freq': None, 'sdram_freq': None,
+            'over_voltage': 2, 'force_turbo': None, 'gpu_mem': 64}},
+    'headless-max': {
+        'pi1': {'arm_freq': 1000, 'core_freq': 500, 'sdram_freq': 600,
+            'over_voltage': 6, 'force_turbo': None, 'gpu_mem': 16},
+        'zero': {'arm_freq': 1100, 'core_freq': 500, 'sdram_freq': 500,
+            'over_voltage': 6, 'force_turbo': None, 'gpu_mem': 16},
+        'pi2': {'arm_freq': 1000, 'core_freq': 500, 'sdram_freq': 500,
+            'over_voltage': 2, 'force_turbo': None, 'gpu_mem': 16},
+        'pi3': {'arm_freq': 1450, 'core_freq': 500, 'sdram_freq': 500,
+            'over_voltage': 4, 'force_turbo': None, 'gpu_mem': 16},
+        'pi4': {'arm_freq': 2000, 'core_freq': None, 'sdram_freq': None,
+            'over_voltage': 6, 'force_turbo': None, 'gpu_mem': 16}}}
+
+# Stock (firmware default) clocks of each board model in MHz:
+#  (arm_freq, core_freq, sdram_freq)
+RPAC_PERFORMANCE_STOCK = {'A': (700, 250, 400), 'B': (700, 250, 400),
+    'A+': (700, 250, 400), 'B+': (700, 250, 400), 'CM': (700, 250, 400),
+    'Zero': (1000, 400, 450), 'ZeroW': (1000, 400, 450),
+    'Zero2W': (1000, 400, 450), '2B': (900, 250, 450),
+    '3B': (1200, 400, 450), 'CM3': (1200, 400, 450),
+    '3B+': (1400, 400, 500), '3A+': (1400, 400, 500),
+    'CM3+': (1200, 400, 500), '4B': (1500, 500, 3200),
+    'CM4': (1500, 500, 3200), 'CM4S': (1500, 500, 3200),
+    '400': (1800, 500, 3200)}
+
+# [Performance] option names -> /boot/config.txt settings
+RPAC_PERFORMANCE_OPTIONS = {'ArmFreq': 'arm_freq', 'CoreFreq': 'core_freq',
+    'SdramFreq': 'sdram_freq', 'OverVoltage': 'over_voltage',
+    'ForceTurbo': 'force_turbo', 'GPUMem': 'gpu_mem'}
+
+# Safe (min, max) values of overclock settings, per board family.
+# Profiles are clamped to these limits on each board.
+RPAC_PERFORMANCE_LIMITS = {
+    'pi1': {'arm_freq': (200, 1000), 'core_freq': (100, 500),
+        'sdram_freq': (200, 600), 'over_voltage': (-16, 6)},
+    'zero': {'arm_freq': (200, 1100), 'core_freq': (100, 500),
+        'sdram_freq': (200, 500), 'over_voltage': (-16, 6)},
+    'pi2': {'arm_freq': (200, 1000), 'core_freq': (100, 500),
+        'sdram_freq': (200, 500), 'over_voltage': (-16, 6)},
+    'pi3': {'arm_freq': (200, 1500), 'core_freq': (100, 500),
+        'sdram_freq': (200, 500), 'over_voltage': (-16, 6)},
+    'pi4': {'arm_freq': (200, 2000), 'core_freq': (100, 550),
+        'sdram_freq': (200, 3200), 'over_voltage': (-16, 6)}}
+
+# Board models (see RPAC_BOARD_REVISIONS/RPAC_BOARD_TYPES) -> family
+RPAC_BOARD_FAMILIES = {'A': 'pi1', 'B': 'pi1', 'A+': 'pi1', 'B+': 'pi1',
+    'CM': 'pi1', 'Zero': 'zero', 'ZeroW': 'zero', '2B': 'pi2', '3B': 'pi3',
+    '3B+': 'pi3', '3A+': 'pi3', 'CM3': 'pi3', 'CM3+': 'pi3', '4B': 'pi4',
+    'Zero2W': 'pi3', '400': 'pi4', 'CM4': 'pi4', 'CM4S': 'pi4'}
+
+# Memory-pressure guard of heavy steps (locale compilation, apt/dpkg,
+# ssh-keygen), configured in [Memory] section. See heavy_call().
+RPAC_MEMGUARD = {'minavailable': 48, 'maxpressure': 20.0, 'wait': 120,
+    'swapsize': 128, 'swapfile': '/var/tmp/raspi-autoconfig.swap',
+    'swapon': False}
+
+# zram swap init script, see setup_memory()
+RPAC_ZRAM_SCRIPT = '''\
+#!/bin/sh
+### BEGIN INIT INFO
+# Provides:          zram-swap
+# Required-Start:    $local_fs
+# Required-Stop:     $local_fs
+# Default-Start:     S
+# Default-Stop:      0 6
+# Short-Description: Compressed swap in RAM (zram)
+### END INIT INFO
+
+# Installed by raspi-autoconfig, see [Memory] section of autoconfig.ini
+
+SIZE_MB=%(size)d
+ALGORITHM=%(algorithm)s
+PRIORITY=%(priority)d
+
+case "$1" in
+  start)
+    grep -q '^/dev/zram0 ' /proc/swaps && exit 0
+    modprobe zram num_devices=1 || exit 1
+    if [ -n "$ALGORITHM" ] && [ -w /sys/block/zram0/comp_algorithm ]; then
+      echo $ALGORITHM > /sys/block/zram0/comp_algorithm
+    fi
+    echo $(($SIZE_MB * 1024 * 1024)) > /sys/block/zram0/disksize
+    mkswap /dev/zram0 > /dev/null && swapon -p $PRIORITY /dev/zram0
+    ;;
+  stop)
+    swapoff /dev/zram0 2> /dev/null
+    echo 1 > /sys/block/zram0/reset 2> /dev/null
+    ;;
+  *)
+    echo "Usage: /etc/init.d/zram-swap {start|stop}"
+    exit 1
+    ;;
+esac
+exit 0
+'''
+
+# [Tuning] sysctl profiles
+RPAC_SYSCTL_PROFILES = {
+    # Bulk transfers and batch jobs: large write-back cache, big buffers
+    'throughput': [('vm.dirty_background_ratio', '10'),
+        ('vm.dirty_ratio', '40'), ('vm.dirty_writeback_centisecs', '1500'),
+        ('vm.dirty_expire_centisecs', '6000'), ('vm.swappiness', '60'),
+        ('vm.vfs_cache_pressure', '50'),
+        ('net.core.rmem_max', '4194304'), ('net.core.wmem_max', '4194304'),
+        ('net.ipv4.tcp_rmem', '4096 87380 4194304'),
+        ('net.ipv4.tcp_wmem', '4096 65536 4194304')],
+    # Interactive and real-time work: small write bursts, low swapping
+    'latency': [('vm.dirty_background_ratio', '3'),
+        ('vm.dirty_ratio', '10'), ('vm.dirty_writeback_centisecs', '500'),
+        ('vm.dirty_expire_centisecs', '1500'), ('vm.swappiness', '10'),
+        ('vm.vfs_cache_pressure', '100'),
+        ('net.core.rmem_max', '1048576'), ('net.core.wmem_max', '1048576'),
+        ('net.ipv4.tcp_rmem', '4096 87380 1048576'),
+        ('net.ipv4.tcp_wmem', '4096 16384 1048576')]}
+
+# [Tuning] init script, applies cpufreq governor and block device settings
+# on boot (after raspi-config, which sets "ondemand" governor).
+RPAC_TUNING_SCRIPT = '''\
+#!/bin/sh
+### BEGIN INIT INFO
+# Provides:          raspi-tuning
+# Required-Start:    $local_fs
+# Required-Stop:
+# Should-Start:      raspi-config
+# Default-Start:     2 3 4 5
+# Default-Stop:
+# Short-Description: CPU governor and SD card I/O tuning
+### END INIT INFO
+
+# Installed by raspi-autoconfig, see [Tuning] section of autoconfig.ini
+
+GOVERNOR=%(governor)s
+BLOCKDEV=%(blockdev)s
+SCHEDULER=%(scheduler)s
+READAHEAD_KB=%(readahead)s
+
+case "$1" in
+  start)
+    if [ -n "$GOVERNOR" ]; then
+      for f in /sys/devices/system/cpu/cpu*/cpufreq/scaling_governor; do
+        [ -w $f ] && echo $GOVERNOR > $f
+      done
+    fi
+    if [ -n "$SCHEDULER" ]; then
+      echo $SCHEDULER > /sys/block/$BLOCKDEV/queue/scheduler
+    fi
+    if [ -n "$READAHEAD_KB" ]; then
+      echo $READAHEAD_KB > /sys/block/$BLOCKDEV/queue/read_ahead_kb
+    fi
+    ;;
+  stop)
+    ;;
+  *)
+    echo "Usage: /etc/init.d/raspi-tuning {start|stop}"
+    exit 1
+    ;;
+esac
+exit 0
+'''
+
+# [Benchmark] measurements, in report order:
+#  (result key, description, unit, threshold option, 'min' or 'max')
+RPAC_BENCHMARK_TESTS = [
+    ('seqwrite', 'SD card sequential write', 'MB/s', 'MinSeqWrite', 'min'),
+    ('seqread', 'SD card sequential read', 'MB/s', 'MinSeqRead', 'min'),
+    ('randwrite', 'SD card 4K random write', 'IOPS', 'MinRandWrite', 'min'),
+    ('randread', 'SD card 4K random read', 'IOPS', 'MinRandRead', 'min'),
+    ('cpu', 'CPU (SHA-256)', 'MB/s', 'MinCPU', 'min'),
+    ('membw', 'Memory copy bandwidth', 'MB/s', 'MinMemBandwidth', 'min'),
+    ('ping', 'Gateway ping latency', 'ms', 'MaxPing', 'max'),
+    ('pingloss', 'Gateway ping loss', '%', 'MaxPingLoss', 'max'),
+    ('throughput', 'Network download throughput', 'MB/s', 'MinThroughput',
+        'min')]
+RPAC_BENCHMARK_REPORT = '/boot/raspi-autoconfig-benchmark.txt'
+
+# Root directory of /sys and /proc, read by inventory_load(), fstab_check(),
+# local_subnet() and default_gateway(). Can be pointed to a fake tree for
+# testing.
+RPAC_SYSROOT = '/'
+
+# Hardware inventory of this board, loaded once by inventory() and shared by
+# all sections.
+RPAC_INVENTORY = None
+
+# Old style board revision codes in /proc/cpuinfo: (model, RAM in MB)
+# See: http://elinux.org/RPi_HardwareHistory
+RPAC_BOARD_REVISIONS = {
+    '0002': ('B', 256), '0003': ('B', 256), '0004': ('B', 256),
+    '0005': ('B', 256), '0006': ('B', 256), '0007': ('A', 256),
+    '0008': ('A', 256), '0009': ('A', 256), '000d': ('B', 512),
+    '000e': ('B', 512), '000f': ('B', 512), '0010': ('B+', 512),
+    '0011': ('CM', 512), '0012': ('A+', 256), '0013': ('B+', 512),
+    '0014': ('CM', 512), '0015': ('A+', 256)}
+
+# New style board revision codes: model field -> model name
+RPAC_BOARD_TYPES = {0x0: 'A', 0x1: 'B', 0x2: 'A+', 0x3: 'B+', 0x4: '2B',
+    0x6: 'CM', 0x8: '3B', 0x9: 'Zero', 0xa: 'CM3', 0xc: 'ZeroW',
+    0xd: '3B+', 0xe: '3A+', 0x10: 'CM3+', 0x11: '4B', 0x12: 'Zero2W',
+    0x13: '400', 0x14: 'CM4', 0x15: 'CM4S'}
 
 ############################################################
 ########## A U X I L I A R Y   F U N C T I O N S  ##########
@@ -58,13 +374,15 @@ def envreq():
     
     # OS, architecture and distribution check. Require:
     # * Linux operating system
-    # * armv6l hardware architecture
+    # * armv6l hardware architecture (or any ARM in bake mode: an image
+    #   chroot under qemu-arm-static reports armv7l)
     # * Debian 7.0 "wheezy" distribution
     import platform
     if platform.system() != 'Linux':
         sys.stderr.write('This program must be run under Linux. \n')
         return False
-    if not platform.machine().startswith('armv6'):
+    if not platform.machine().startswith('armv6') and \
+        not (RPAC_MODE == 'bake' and platform.machine().startswith('arm')):
         sys.stderr.write('This program must be run under an ARMv6 ' + \
             'architecture machine. \n')
         return False
@@ -86,9 +404,11 @@ def envreq():
 # end of envreq()
 
 # Config file load
+# No interpolation: values like ZramSize=50% are taken as is, also when
+#  set by provisioning server or fleet manifest.
 def loadconfig(filename):
     import configparser;
-    configfile = configparser.ConfigParser()
+    configfile = configparser.ConfigParser(interpolation=None)
     readret = configfile.read(filename, encoding='UTF-8')
     if len(readret) == 0:
         sys.stderr.write('Unable to load configuration file \"' + filename + \
@@ -97,6 +417,592 @@ def loadconfig(filename):
     return configfile
 # end of loadconfig()
 
+# Normalize a fleet manifest key (MAC address or CPU serial):
+#  B8-27-EB-00-00-01 -> b8:27:eb:00:00:01, 00000000abcdef01 -> abcdef01
+def fleet_normkey(key):
+    key = key.strip().lower().replace('-', ':')
+    if key.count(':') != 5:
+        key = key.lstrip('0') or '0'
+    return key
+# end of fleet_normkey()
+
+# Keys identifying this board in fleet manifest: MAC addresses of all
+#  network cards, and CPU serial number from /proc/cpuinfo.
+def fleet_device_keys():
+    inv = inventory()
+    keys = [fleet_normkey(nic['mac']) for nic in inv['nics'] \
+        if nic['mac'] and nic['physical']]
+    if inv['serial']:
+        keys.append(fleet_normkey(inv['serial']))
+    return keys
+# end of fleet_device_keys()
+
+# Stream all rows of a fleet manifest, yields (key, byte offset of row).
+# Two formats are supported:
+#  *.csv: first line is header. First column is the key, other columns are
+#   "Section.Option" names, e.g: Key,Wired.DHCP,Wired.IP
+#  otherwise (ini): each board has its own section named by the key, with
+#   "Section.Option = value" lines, e.g: [b8:27:eb:00:00:01]
+# Rows are single lines (CSV quoted fields must not contain line breaks).
+def fleet_rows(manifestpath):
+    import csv
+    iscsv = manifestpath.lower().endswith('.csv')
+    with open(manifestpath, 'rb') as fmanifest:
+        offset = 0
+        first = True
+        for line in fmanifest:
+            lineoffset = offset
+            offset += len(line)
+            text = line.decode('UTF-8', 'replace').strip()
+            if iscsv:
+                if first:
+                    first = False
+                    continue
+                if not text or text.startswith('#'):
+                    continue
+                row = next(csv.reader([text]))
+                if row and row[0].strip():
+                    yield (fleet_normkey(row[0]), lineoffset)
+            elif text.startswith('[') and text.endswith(']'):
+                yield (fleet_normkey(text[1:-1]), lineoffset)
+# end of fleet_rows()
+
+# Normalized key of the row at specific byte offset of fleet manifest, or
+#  None if there is no row there.
+def fleet_row_key(manifestpath, offset):
+    import csv
+    with open(manifestpath, 'rb') as fmanifest:
+        if offset == 0 and manifestpath.lower().endswith('.csv'):
+            return None # header
+        fmanifest.seek(offset)
+        text = fmanifest.readline().decode('UTF-8', 'replace').strip()
+    if manifestpath.lower().endswith('.csv'):
+        row = next(csv.reader([text])) if text else []
+        if row and row[0].strip() and not text.startswith('#'):
+            return fleet_normkey(row[0])
+    elif text.startswith('[') and text.endswith(']'):
+        return fleet_normkey(text[1:-1])
+    return None
+# end of fleet_row_key()
+
+# Overrides in the row at specific byte offset of fleet manifest.
+# Returns a dictionary {(section, option): value}.
+def fleet_read_row(manifestpath, offset):
+    import csv
+    overrides = {}
+    def add(name, value):
+        name = name.strip(); value = value.strip()
+        if '.' in name and value:
+            (section, option) = name.split('.', 1)
+            overrides[(section.strip(), option.strip())] = value
+    with open(manifestpath, 'rb') as fmanifest:
+        if manifestpath.lower().endswith('.csv'):
+            header = next(csv.reader([fmanifest.readline().decode('UTF-8',
+                'replace').strip()]))
+            fmanifest.seek(offset)
+            row = next(csv.reader([fmanifest.readline().decode('UTF-8',
+                'replace').strip()]))
+            for (name, value) in zip(header[1:], row[1:]):
+                add(name, value)
+        else:
+            fmanifest.seek(offset)
+            fmanifest.readline() # [key] line
+            for line in fmanifest:
+                text = line.decode('UTF-8', 'replace').strip()
+                if text.startswith('['): break
+                if not text or text[0] in '#;': continue
+                for sep in ('=', ':'):
+                    if sep in text:
+                        add(*text.split(sep, 1))
+                        break
+    return overrides
+# end of fleet_read_row()
+
+# Fleet manifest index: <manifest>.idx, fixed-width records sorted by key,
+#  so a key is found by binary search with a few seeks, without loading
+#  the manifest or the index into memory. First record is a header with
+#  size of the manifest and CRC-32 of its first and last blocks, to detect
+#  a stale index without reading the whole manifest. (Not mtime: the index
+#  is built on a workstation and copied to FAT /boot, which changes mtime
+#  of the manifest.) Edits in the middle keeping the size are caught by
+#  fleet_row_key() check of the row found.
+RPAC_FLEET_KEYLEN = 32
+RPAC_FLEET_RECLEN = RPAC_FLEET_KEYLEN + 1 + 12 + 1
+RPAC_FLEET_BLOCK = 65536
+
+def fleet_index_header(manifestpath):
+    import os, zlib
+    with open(manifestpath, 'rb') as fmanifest:
+        size = os.fstat(fmanifest.fileno()).st_size
+        crc = zlib.crc32(fmanifest.read(RPAC_FLEET_BLOCK))
+        if size > RPAC_FLEET_BLOCK:
+            fmanifest.seek(max(RPAC_FLEET_BLOCK, size - RPAC_FLEET_BLOCK))
+            crc = zlib.crc32(fmanifest.read(RPAC_FLEET_BLOCK), crc)
+    header = 'RPACIDX ' + str(size) + ' ' + '%08x' % (crc & 0xffffffff)
+    return header.ljust(RPAC_FLEET_RECLEN - 1)[:RPAC_FLEET_RECLEN - 1] + '\n'
+# end of fleet_index_header()
+
+# Build index of fleet manifest. Returns number of rows indexed.
+def fleet_build_index(manifestpath):
+    import os
+    records = []
+    for (key, offset) in fleet_rows(manifestpath):
+        if len(key) > RPAC_FLEET_KEYLEN:
+            sys.stderr.write('WARN: Fleet manifest key too long, skipped: ' + \
+                key + ' \n')
+            continue
+        records.append(key.ljust(RPAC_FLEET_KEYLEN) + ' ' + \
+            str(offset).rjust(12) + '\n')
+    records.sort()
+    idxpath = manifestpath + '.idx'
+    with open(idxpath + '.tmp', 'w', encoding='ascii') as findex:
+        findex.write(fleet_index_header(manifestpath))
+        findex.writelines(records)
+    os.rename(idxpath + '.tmp', idxpath)
+    return len(records)
+# end of fleet_build_index()
+
+# Find offset of key via manifest index.
+# Returns offset, -1 if key not found, or None if index missing or stale.
+# Parameters:
+#  header: fleet_index_header() of the manifest, if already computed
+def fleet_index_lookup(manifestpath, key, header=None):
+    import os
+    idxpath = manifestpath + '.idx'
+    try:
+        findex = open(idxpath, 'rb')
+    except (OSError, IOError):
+        return None
+    with findex:
+        if header is None:
+            header = fleet_index_header(manifestpath)
+        if findex.read(RPAC_FLEET_RECLEN).decode('ascii', 'replace') != \
+            header:
+            return None
+        nrecords = os.fstat(findex.fileno()).st_size // RPAC_FLEET_RECLEN - 1
+        target = key.ljust(RPAC_FLEET_KEYLEN).encode('ascii', 'replace')
+        (lo, hi) = (0, nrecords)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            findex.seek((mid + 1) * RPAC_FLEET_RECLEN)
+            if findex.read(RPAC_FLEET_KEYLEN) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < nrecords:
+            findex.seek((lo + 1) * RPAC_FLEET_RECLEN)
+            record = findex.read(RPAC_FLEET_RECLEN)
+            if record[:RPAC_FLEET_KEYLEN] == target:
+                return int(record[RPAC_FLEET_KEYLEN:])
+    return -1
+# end of fleet_index_lookup()
+
+# Find row of this board in fleet manifest, and merge its overrides into
+#  configfile. Manifest is configured in [Fleet].Manifest (relative paths
+#  are relative to directory of autoconfig.ini).
+def fleet_apply(configfile, configfilepath):
+    SECNAME = 'Fleet'
+    if not configfile.has_option(SECNAME, 'Manifest'): return
+    import os
+    manifestpath = os.path.join(os.path.dirname(configfilepath),
+        configfile.get(SECNAME, 'Manifest').strip())
+    if not os.path.isfile(manifestpath):
+        sys.stderr.write('WARN: Fleet manifest ' + manifestpath + \
+            ' not found. \n')
+        return
+
+    # Look up each key of this board, via index if it is up-to-date,
+    #  otherwise by scanning the manifest until the first match.
+    keys = fleet_device_keys()
+    offset = -1
+    header = None
+    if os.path.isfile(manifestpath + '.idx'):
+        header = fleet_index_header(manifestpath)
+    for key in keys:
+        offset = fleet_index_lookup(manifestpath, key, header)
+        if offset is None: break
+        if offset >= 0:
+            if fleet_row_key(manifestpath, offset) != key:
+                offset = None # stale index
+            break
+    if offset is None:
+        for (rowkey, rowoffset) in fleet_rows(manifestpath):
+            if rowkey in keys:
+                offset = rowoffset
+                break
+        else:
+            offset = -1
+    if offset < 0:
+        sys.stdout.write('INFO: This board (' + ', '.join(keys) + \
+            ') is not listed in fleet manifest. \n')
+        return
+
+    # Merge overrides into base config
+    overrides = fleet_read_row(manifestpath, offset)
+    for ((section, option), value) in overrides.items():
+        if not configfile.has_section(section):
+            configfile.add_section(section)
+        configfile.set(section, option, value)
+    sys.stdout.write('INFO: ' + str(len(overrides)) + ' option(s) ' + \
+        'loaded from fleet manifest. \n')
+# end of fleet_apply()
+
+# Read hardware inventory of the board from sysfs and procfs, without
+#  running any external command. Returns a dictionary:
+#   'nics': list of network cards, each one a dictionary of 'name', 'mac',
+#           'type' (ARPHRD_* number, 1 for ethernet), 'wireless' (True for
+#           Wi-Fi) and 'physical' (False for virtual devices like lo)
+#   'revision', 'model', 'serial', 'hardware': from /proc/cpuinfo
+#   'ram': RAM on board in MB, decoded from revision
+#   'memtotal': RAM available to Linux in MB, from /proc/meminfo
+# Parameters:
+#  sysroot: root directory of /sys and /proc
+def inventory_load(sysroot='/'):
+    import os
+    inv = {'nics': [], 'revision': '', 'model': '', 'serial': '',
+        'hardware': '', 'ram': 0, 'memtotal': 0}
+
+    # Network cards, /sys/class/net/<dev>/{address,type,wireless,device}
+    netdir = os.path.join(sysroot, 'sys/class/net')
+    try:
+        devnames = sorted(os.listdir(netdir))
+    except OSError:
+        devnames = []
+    for devname in devnames:
+        devdir = os.path.join(netdir, devname)
+        nic = {'name': devname, 'mac': '', 'type': 0, 'wireless': False,
+            'physical': os.path.exists(os.path.join(devdir, 'device'))}
+        try:
+            nic['mac'] = open(os.path.join(devdir, 'address'),
+                'r').read().strip().lower()
+            nic['type'] = int(open(os.path.join(devdir, 'type'),
+                'r').read().strip())
+        except (IOError, OSError, ValueError):
+            pass
+        if nic['mac'] == '00:00:00:00:00:00':
+            nic['mac'] = ''
+        nic['wireless'] = os.path.isdir(os.path.join(devdir, 'wireless')) \
+            or os.path.exists(os.path.join(devdir, 'phy80211'))
+        inv['nics'].append(nic)
+
+    # Board revision and serial, /proc/cpuinfo
+    try:
+        for line in open(os.path.join(sysroot, 'proc/cpuinfo'), 'r'):
+            if not ':' in line: continue
+            (name, value) = [s.strip() for s in line.split(':', 1)]
+            if name.lower() in ('revision', 'serial', 'hardware'):
+                inv[name.lower()] = value.lower()
+    except (IOError, OSError):
+        pass
+    if inv['revision']:
+        try:
+            revcode = int(inv['revision'], 16)
+        except ValueError:
+            revcode = 0
+        if revcode & 0x800000: # New style revision code
+            inv['model'] = RPAC_BOARD_TYPES.get((revcode >> 4) & 0xff, '')
+            inv['ram'] = 256 << ((revcode >> 20) & 0x7)
+        else: # Old style, leading "1000" means over-volted
+            (inv['model'], inv['ram']) = RPAC_BOARD_REVISIONS.get(
+                inv['revision'][-4:], ('', 0))
+
+    # RAM, /proc/meminfo
+    try:
+        for line in open(os.path.join(sysroot, 'proc/meminfo'), 'r'):
+            if line.startswith('MemTotal:'):
+                inv['memtotal'] = int(line.split()[1]) // 1024
+                break
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    return inv
+# end of inventory_load()
+
+# Hardware inventory of the board, loaded on first call and cached for the
+#  whole run.
+def inventory():
+    global RPAC_INVENTORY
+    if RPAC_INVENTORY is None:
+        RPAC_INVENTORY = inventory_load(RPAC_SYSROOT)
+    return RPAC_INVENTORY
+# end of inventory()
+
+# Wired ethernet cards of the board, like:
+#  [('eth0', 'b8:27:eb:00:00:00'), ('eth1', 'aa:bb:cc:dd:ee:ff')]
+def inventory_wired():
+    return [(nic['name'], nic['mac']) for nic in inventory()['nics'] \
+        if nic['type'] == 1 and nic['physical'] and not nic['wireless']]
+# end of inventory_wired()
+
+# Wi-Fi cards of the board, in the same format of inventory_wired().
+def inventory_wireless():
+    return [(nic['name'], nic['mac']) for nic in inventory()['nics'] \
+        if nic['wireless']]
+# end of inventory_wireless()
+
+# Run a wpa_cli command on specific Wi-Fi device, returns its output.
+#  Raises CalledProcessError if it fails or is killed by its deadline.
+def wpa_cli(ethdev, *args):
+    import subprocess
+    proc = timed_popen(['wpa_cli', '-i' + ethdev] + list(args),
+        stdout=subprocess.PIPE)
+    output = timed_communicate(proc)[0].decode('UTF-8', 'replace').strip()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.cmdline)
+    return output
+# end of wpa_cli()
+
+# Derived WPA PSKs, cached by (ssid, passphrase)
+RPAC_PSK_CACHE = {}
+
+# Derive 256-bit WPA pre-shared key from SSID and passphrase, as
+#  wpa_passphrase does: PBKDF2-HMAC-SHA1(passphrase, ssid, 4096, 32).
+# Returns 64 hex digits. A passphrase which is already 64 hex digits is
+#  returned as is. Returns None for an invalid passphrase (length not in
+#  8~63 characters).
+# Checked against IEEE 802.11i-2004 H.4.2 test vectors, see
+#  tests/test_wpa_psk.py.
+def wpa_psk(ssid, passphrase):
+    import re
+    if re.match('^[0-9a-fA-F]{64}$', passphrase):
+        return passphrase.lower()
+    if not 8 <= len(passphrase) <= 63:
+        return None
+    if (ssid, passphrase) in RPAC_PSK_CACHE:
+        return RPAC_PSK_CACHE[(ssid, passphrase)]
+
+    import hashlib, binascii
+    password = passphrase.encode('UTF-8')
+    salt = ssid.encode('UTF-8')
+    if hasattr(hashlib, 'pbkdf2_hmac'): # Python 3.4 or later
+        key = hashlib.pbkdf2_hmac('sha1', password, salt, 4096, 32)
+    else:
+        import hmac
+        key = b''
+        for block in (1, 2):
+            u = hmac.new(password, salt + bytes([0, 0, 0, block]),
+                hashlib.sha1).digest()
+            t = int.from_bytes(u, 'big')
+            for i in range(4095):
+                u = hmac.new(password, u, hashlib.sha1).digest()
+                t ^= int.from_bytes(u, 'big')
+            key += t.to_bytes(20, 'big')
+        key = key[:32]
+    psk = binascii.hexlify(key).decode('ascii')
+    RPAC_PSK_CACHE[(ssid, passphrase)] = psk
+    return psk
+# end of wpa_psk()
+
+# Networks configured in [Wireless] section. Several networks are supported:
+#  SSID/Passphrase/Priority, SSID2/Passphrase2/Priority2, ...
+# SSID and SSID1 are the same network number, only one of them is used.
+# Returns a list of dictionaries of 'ssid', 'passphrase', 'priority', 'n'.
+def wireless_networks(configfile):
+    import re
+    SECNAME = 'Wireless'
+    networks = []
+    numbers = {}
+    for option in sorted(configfile.options(SECNAME)):
+        m = re.match('^ssid(?P<n>\\d*)$', option)
+        if not m or not configfile.get(SECNAME, option).strip(): continue
+        n = m.group('n')
+        if int(n or '1') in numbers:
+            sys.stderr.write('WARN: [Wireless].SSID' + n + ' conflicts ' + \
+                'with [Wireless].SSID' + numbers[int(n or '1')] + \
+                ', ignored. Number more networks from SSID2. \n')
+            continue
+        numbers[int(n or '1')] = n
+        priority = configfile.get(SECNAME, 'Priority' + n, fallback='0')
+        try:
+            priority = int(priority)
+        except ValueError:
+            sys.stderr.write('WARN: Invalid [Wireless].Priority' + n + \
+                ' value, 0 is used instead. \n')
+            priority = 0
+        networks.append({'ssid': configfile.get(SECNAME, option),
+            'passphrase': configfile.get(SECNAME, 'Passphrase' + n,
+                fallback=''),
+            'priority': priority, 'n': int(n or '1')})
+    networks.sort(key=lambda network: network['n'])
+    return networks
+# end of wireless_networks()
+
+# Scan access points nearby with specific Wi-Fi device. Returns a list of
+#  dictionaries of 'bssid', 'frequency' (MHz), 'signal' (dBm), 'flags'
+#  and 'ssid'.
+def wireless_scan(ethdev):
+    timed_call(['iwlist', ethdev, 'scan'], stdout=open('/dev/null', 'w'))
+    aplist = wpa_cli(ethdev, 'scan_results').split('\n')
+    #  explode each line by tab char, skip head line
+    #  (Note: column title: bssid, frequency, signal level, flags, ssid)
+    results = []
+    for ap in aplist[1:]:
+        ap = ap.split('\t')
+        if len(ap) != 5: continue
+        try:
+            results.append({'bssid': ap[0], 'frequency': int(ap[1]),
+                'signal': int(ap[2]), 'flags': ap[3], 'ssid': ap[4]})
+        except ValueError:
+            continue
+    return results
+# end of wireless_scan()
+
+# Networks already known to wpa_supplicant on Wi-Fi device ethdev, from
+#  wpa_cli list_networks. Returns a dictionary {ssid: [network ids]}.
+def wireless_known(ethdev):
+    known = {}
+    #  (Note: column title: network id, ssid, bssid, flags)
+    for line in wpa_cli(ethdev, 'list_networks').split('\n')[1:]:
+        fields = line.split('\t')
+        if len(fields) >= 2 and fields[0].isdigit():
+            known.setdefault(fields[1], []).append(fields[0])
+    return known
+# end of wireless_known()
+
+# Rank configured networks by: (1) priority in autoconfig.ini, (2) signal
+#  level of the strongest access point, (3) frequency band, 5GHz preferred.
+# Each returned network gets 'bssid', 'frequency', 'signal', 'flags' of its
+#  strongest access point ('bssid' is empty if not found in scan results).
+def wireless_rank(networks, aplist):
+    ranked = []
+    for network in networks:
+        network = dict(network, bssid='', frequency=0, signal=-1000,
+            flags='')
+        for ap in aplist:
+            if ap['ssid'] != network['ssid']: continue
+            if (ap['signal'], ap['frequency']) > (network['signal'],
+                network['frequency']):
+                network.update(bssid=ap['bssid'], frequency=ap['frequency'],
+                    signal=ap['signal'], flags=ap['flags'])
+        ranked.append(network)
+    ranked.sort(key=lambda network: (-network['priority'], -network['signal'],
+        -(network['frequency'] >= 5000), network['n']))
+    return ranked
+# end of wireless_rank()
+
+# Merge config text (autoconfig.ini format) over configfile.
+# [Fleet] section is never changed this way.
+def config_merge(configfile, text):
+    import configparser
+    overlay = configparser.ConfigParser(interpolation=None)
+    overlay.read_string(text)
+    for section in overlay.sections():
+        if section == 'Fleet': continue
+        if not configfile.has_section(section):
+            configfile.add_section(section)
+        for (option, value) in overlay.items(section, raw=True):
+            configfile.set(section, option, value)
+# end of config_merge()
+
+# Fetch autoconfig.ini from provisioning server, with conditional request
+#  (If-None-Match/If-Modified-Since) against the cached copy.
+# Returns (text, changed): text is the fetched or cached config (None if
+#  neither is available), changed is True if server sent a new version.
+def remote_config_fetch(url, timeout=15):
+    import urllib.request, socket, json, os
+    try:
+        meta = json.load(open(RPAC_REMOTE_META, 'r'))
+        cached = open(RPAC_REMOTE_CONFIG, 'r', encoding='UTF-8').read()
+        if meta.get('url') != url: (meta, cached) = ({}, None)
+    except (IOError, OSError, ValueError):
+        (meta, cached) = ({}, None)
+    
+    request = urllib.request.Request(url)
+    if cached is not None:
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        resp = urllib.request.urlopen(request, timeout=timeout)
+        text = resp.read().decode('UTF-8')
+    except urllib.error.HTTPError as err:
+        if err.code == 304 and cached is not None:
+            sys.stdout.write('INFO: Config on provisioning server ' + \
+                'unchanged. \n')
+        else:
+            sys.stderr.write('WARN: Unable to fetch ' + url + ' (HTTP ' + \
+                str(err.code) + '). \n')
+        return (cached, False)
+    except (urllib.error.URLError, socket.error, UnicodeDecodeError) as err:
+        sys.stderr.write('WARN: Unable to fetch ' + url + ' (' + \
+            str(err) + '). \n')
+        return (cached, False)
+    
+    # Check and cache new version
+    import configparser
+    try:
+        configparser.ConfigParser(interpolation=None).read_string(text)
+    except configparser.Error:
+        sys.stderr.write('WARN: Config fetched from ' + url + ' is ' + \
+            'invalid, ignored. \n')
+        return (cached, False)
+    try:
+        if not os.path.isdir(RPAC_STATEDIR):
+            os.makedirs(RPAC_STATEDIR)
+        open(RPAC_REMOTE_CONFIG, 'w', encoding='UTF-8').write(text)
+        open(RPAC_REMOTE_META, 'w').write(json.dumps({'url': url,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified')}))
+    except (IOError, OSError):
+        sys.stderr.write('WARN: Unable to cache config from ' + url + '. \n')
+    sys.stdout.write('INFO: New config fetched from ' + url + '. \n')
+    return (text, text != cached)
+# end of remote_config_fetch()
+
+# Merge cached copy of remote config (from last successful fetch) over
+#  configfile, so it also applies without network.
+def remote_config_cached(configfile):
+    if not configfile.has_option('Fleet', 'ConfigURL'): return
+    import json
+    try:
+        meta = json.load(open(RPAC_REMOTE_META, 'r'))
+        if meta.get('url') != configfile.get('Fleet', 'ConfigURL').strip():
+            return
+        config_merge(configfile, open(RPAC_REMOTE_CONFIG, 'r',
+            encoding='UTF-8').read())
+    except (IOError, OSError, ValueError) as err:
+        return
+    sys.stdout.write('INFO: Cached config of provisioning server loaded. \n')
+# end of remote_config_cached()
+
+# Fetch remote config once network is up and merge it over configfile.
+#  Per-board overrides of fleet manifest are merged again afterwards, so
+#  they still take precedence over fleet-wide config of the server.
+# Returns names of sections changed by the new version.
+def remote_config_update(configfile, configfilepath):
+    if not configfile.has_option('Fleet', 'ConfigURL'): return []
+    url = configfile.get('Fleet', 'ConfigURL').strip()
+    (text, changed) = remote_config_fetch(url, max(1, deadline('network')))
+    if not changed: return []
+    before = dict([(section, dict(configfile.items(section, raw=True))) \
+        for section in configfile.sections()])
+    config_merge(configfile, text)
+    fleet_apply(configfile, configfilepath)
+    return [section for section in configfile.sections() \
+        if before.get(section) != dict(configfile.items(section, raw=True))]
+# end of remote_config_update()
+
+# Sections to configure again after remote_config_update(): sections
+#  changed by provisioning server which were not run yet (added by it), or
+#  which are safe to configure again during a run (RPAC_RERUN_SECTIONS).
+# Parameters:
+#  stepnames: names of steps before network stage, in run order
+#  changed: sections changed, from remote_config_update()
+#  ran: sections run so far
+def remote_config_reruns(stepnames, changed, ran):
+    reruns = []
+    for name in stepnames:
+        if name not in changed: continue
+        if name in ran and name not in RPAC_RERUN_SECTIONS:
+            sys.stderr.write('WARN: [' + name + '] changed on ' + \
+                'provisioning server, not applied (not safe to ' + \
+                'configure again during a run). \n')
+            continue
+        reruns.append(name)
+    return reruns
+# end of remote_config_reruns()
+
 # Find one network card, from a list of ethernet cards like:
 #  [('eth0', 'b8:27:eb:00:00:00'), ('eth1', 'aa:bb:cc:dd:ee:ff')]
 # Sequence:
@@ -185,6 +1091,7 @@ def dhcp_and_ip_setting(interflist, devname, datadict):
 # end of dhcp_and_ip_setting()
 
 # Edit locales to be generated, and default locale.
+# Returns True if everything is done.
 def localization_locales(locales_togenerate=[], defaultlocale=None):
     # Load all supported locales of the system first. 
     try:
@@ -199,8 +1106,10 @@ def localization_locales(locales_togenerate=[], defaultlocale=None):
     
     # Edit locales, completely rewrite `/etc/locale.gen`
     #  (list all supported locales, add leading # before ungenerated ones)
+    done = True
     if locales_togenerate:
         try:
+            artifact_edit('/etc/locale.gen')
             flocalesgen = open("/etc/locale.gen", 'w')
             flocalesgen.write('''\
 # This file lists locales that you wish to have built. You can find a list
@@ -218,32 +1127,39 @@ def localization_locales(locales_togenerate=[], defaultlocale=None):
         except IOError:
             sys.stderr.write('FAILED: Unable to write /etc/locale.gen! \n')
             sys.stderr.write('FAILED: Locales unchanged. \n')
+            done = False
     
     # Edit default locale, write `/etc/default/locale`
     if defaultlocale:
         try:
             if defaultlocale in locales_supported:
+                artifact_edit('/etc/default/locale')
                 fdefaultlocale = open("/etc/default/locale", 'w')
                 fdefaultlocale.write('LANG=' + defaultlocale);
-                flocalesgen.close()
+                fdefaultlocale.close()
             else:
                 sys.stderr.write('FAILED: ' + defaultlocale + ' is not a ' + \
                     'a valid locale! \n')
                 sys.stderr.write('FAILED: Default locale unchanged. \n')
+                done = False
         except IOError:
             sys.stderr.write('FAILED: Unable to write /etc/default/locale! \n')
             sys.stderr.write('FAILED: Default locale unchanged. \n')
+            done = False
     
-    # Run dpkg-reconfigure
+    # Run dpkg-reconfigure (which runs locale-gen)
     if locales_togenerate or defaultlocale:
-        import subprocess
-        subprocess.call(['dpkg-reconfigure', '--frontend=noninteractive', 
+        ret = heavy_call(['dpkg-reconfigure', '--frontend=noninteractive', 
             'locales'])
+        if ret != 0:
+            sys.stderr.write('FAILED: Locales not generated (dpkg-' + \
+                'reconfigure exit code ' + str(ret) + '). \n')
+            done = False
     
-    return
+    return done
 # end of localization_locales()
 
-# Edit keyboard model and/or layout. 
+# Edit keyboard model and/or layout. Returns True if everything is done.
 def localization_keyboard(model=None, layout=None):
     # Load /etc/default/keyboard
     try:
@@ -272,6 +1188,7 @@ def localization_keyboard(model=None, layout=None):
         if n == 0: kbconffile += '\n' + repl
     
     # Write back to /etc/default/keyboard
+    artifact_edit('/etc/default/keyboard')
     try:
         open('/etc/default/keyboard', 'w').write(kbconffile)
     except:
@@ -281,19 +1198,24 @@ def localization_keyboard(model=None, layout=None):
         return
     
     # Run dpkg-reconfigure and invoke-rc.d
-    import subprocess
-    subprocess.call(['dpkg-reconfigure', '--frontend=noninteractive', 
+    ret = timed_call(['dpkg-reconfigure', '--frontend=noninteractive', 
         'keyboard-configuration'])
-    subprocess.call(['invoke-rc.d', 'keyboard-setup', 'start'])
+    if ret != 0:
+        sys.stderr.write('FAILED: Keyboard not reconfigured (dpkg-' + \
+            'reconfigure exit code ' + str(ret) + '). \n')
+        return False
+    if RPAC_MODE != 'bake': # No services started in image chroot
+        timed_call(['invoke-rc.d', 'keyboard-setup', 'start'])
     
-    return
+    return True
 # end of localization_keyboard()
 
-# Edit timezone. 
+# Edit timezone. Returns True if done.
 def localization_timezone(timezone):
     if not timezone: return
     
     # Write timezone to /etc/timezone
+    artifact_edit('/etc/timezone')
     try:
         open('/etc/timezone', 'w').write(timezone)
     except:
@@ -303,14 +1225,17 @@ def localization_timezone(timezone):
         return
     
     # Run dpkg-reconfigure
-    import subprocess
-    subprocess.call(['dpkg-reconfigure', '--frontend=noninteractive', 
+    ret = timed_call(['dpkg-reconfigure', '--frontend=noninteractive', 
         'tzdata'])
+    if ret != 0:
+        sys.stderr.write('FAILED: Timezone not reconfigured (dpkg-' + \
+            'reconfigure exit code ' + str(ret) + '). \n')
+        return False
     
-    return
+    return True
 # end of localization_timezone()
 
-# Edit APT mirror. 
+# Edit APT mirror. Returns True if done (package lists updated).
 def apt_mirror(mirrorurl):
     # URL Verification (1.in right format; 2.reachable)
     import re, urllib.request, socket
@@ -323,7 +1248,8 @@ def apt_mirror(mirrorurl):
         return
     print("Connecting to "  + mirrorurl + "...")
     try:
-        resp = urllib.request.urlopen(mirrorurl, timeout=15)
+        resp = urllib.request.urlopen(mirrorurl,
+            timeout=max(1, deadline('network')))
     except (urllib.error.URLError, socket.error) as err:
         sys.stderr.write('FAILED: Unable to reach ' + mirrorurl + ' ! \n')
         sys.stderr.write('(Check your network connection and mirror URL). \n')
@@ -348,6 +1274,7 @@ def apt_mirror(mirrorurl):
     aptlist.append('deb ' + mirrorurl + ' wheezy main contrib non-free rpi')
     
     # Write back to /etc/apt/sources.list
+    artifact_edit('/etc/apt/sources.list')
     try:
         open('/etc/apt/sources.list', 'w').write('\n'.join(aptlist))
     except:
@@ -357,12 +1284,1261 @@ def apt_mirror(mirrorurl):
         return
     
     # Run apt-get update
-    import subprocess
-    subprocess.call(['apt-get', 'update'])
+    ret = heavy_call(['apt-get', 'update'])
+    if ret != 0:
+        sys.stderr.write('FAILED: apt-get update exit code ' + str(ret) + \
+            ', APT package lists not updated. \n')
+        return False
     
-    return
+    return True
 # end of apt_mirror()
 
+# APT proxy configuration snippet written by apt_proxy()
+RPAC_APT_PROXY_CONF = '/etc/apt/apt.conf.d/01raspi-autoconfig-proxy'
+
+# Default gateway (IPv4 address string) from /proc/net/route, or None.
+def default_gateway():
+    import os, socket, struct
+    try:
+        for line in open(os.path.join(RPAC_SYSROOT, 'proc/net/route'),
+            'r').readlines()[1:]:
+            fields = line.split()
+            if len(fields) >= 4 and fields[1] == '00000000' and \
+                int(fields[3], 16) & 0x2: # RTF_GATEWAY
+                return socket.inet_ntoa(struct.pack('<L',
+                    int(fields[2], 16)))
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+# end of default_gateway()
+
+# Query an SNTP server (RFC 4330), server is host or host:port.
+# Returns offset of local clock in seconds (to be added), or None.
+def sntp_offset(server, timeout=2):
+    import socket, struct, time
+    NTP_DELTA = 2208988800 # 1900-01-01 to 1970-01-01, in seconds
+    (host, sep, port) = server.strip().partition(':')
+    port = int(port) if port.isdigit() else 123
+    sock = None
+    try:
+        addr = socket.getaddrinfo(host, port, socket.AF_INET,
+            socket.SOCK_DGRAM)[0][4]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(timeout)
+        t1 = time.time()
+        txstamp = struct.pack('!II', int(t1) + NTP_DELTA,
+            int((t1 % 1) * 2**32))
+        # LI 0, version 4, mode 3 (client); transmit timestamp at the end
+        sock.sendto(b'\x23' + bytes(39) + txstamp, addr)
+        (data, peer) = sock.recvfrom(512)
+        t4 = time.time()
+    except (socket.error, ValueError):
+        return None
+    finally:
+        if sock: sock.close()
+    # Server mode (4), not kiss-o'-death (stratum 0), answer to our request
+    if len(data) < 48 or data[0] & 0x7 != 4 or data[1] == 0 or \
+        data[24:32] != txstamp:
+        return None
+    (rxsec, rxfrac, txsec, txfrac) = struct.unpack('!IIII', data[32:48])
+    t2 = rxsec - NTP_DELTA + rxfrac / 2.0**32
+    t3 = txsec - NTP_DELTA + txfrac / 2.0**32
+    return ((t2 - t1) + (t3 - t4)) / 2
+# end of sntp_offset()
+
+# Offset of local clock from Date header of an HTTP server (1 second
+#  resolution), or None.
+def http_date_offset(url, timeout=5):
+    import urllib.request, email.utils, socket, time
+    # HEAD request (Request has no method argument before Python 3.3)
+    class HeadRequest(urllib.request.Request):
+        def get_method(self):
+            return 'HEAD'
+    t1 = time.time()
+    try:
+        resp = urllib.request.urlopen(HeadRequest(url), timeout=timeout)
+        date = resp.headers.get('Date')
+    except urllib.error.HTTPError as err: # error pages have a Date too
+        date = err.headers.get('Date')
+    except (urllib.error.URLError, socket.error):
+        return None
+    t4 = time.time()
+    parsed = email.utils.parsedate_tz(date) if date else None
+    if not parsed: return None
+    # Date is truncated to the second: middle of it
+    return email.utils.mktime_tz(parsed) + 0.5 - (t1 + t4) / 2
+# end of http_date_offset()
+
+# Set CLOCK_REALTIME to seconds since epoch through C library, for
+#  Python before 3.3 (no time.clock_settime()).
+def clock_settime(seconds):
+    import ctypes, ctypes.util, os
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    # clock_settime() is in librt before glibc 2.17 (wheezy has 2.13)
+    libname = ctypes.util.find_library('rt') or \
+        ctypes.util.find_library('c')
+    if not libname:
+        raise OSError('clock_settime() not found in C library')
+    libc = ctypes.CDLL(libname, use_errno=True)
+    ts = timespec(int(seconds), int((seconds % 1) * 1e9))
+    if libc.clock_settime(0, ctypes.byref(ts)) != 0: # CLOCK_REALTIME
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+# end of clock_settime()
+
+# Step the clock by offset seconds. Deadlines and progress timestamps are
+#  moved along, they are absolute times.
+def clock_step(offset):
+    import time
+    try:
+        if hasattr(time, 'clock_settime'):
+            time.clock_settime(time.CLOCK_REALTIME, time.time() + offset)
+        else:
+            clock_settime(time.time() + offset)
+    except (OSError, AttributeError) as err:
+        sys.stderr.write('WARN: Unable to set clock (' + str(err) + '). \n')
+        return False
+    for key in ['runend', 'sectionend']:
+        if RPAC_DEADLINES[key]: RPAC_DEADLINES[key] += offset
+    for key in ['started', 'sectionstarted', 'stepstarted']:
+        if RPAC_PROGRESS[key]: RPAC_PROGRESS[key] += offset
+    return True
+# end of clock_step()
+
+# Set clock forward to the time saved on boot partition by clock_save(),
+#  if it is behind (like fake-hwclock).
+def clock_restore():
+    import calendar, time
+    try:
+        saved = calendar.timegm(time.strptime(open(RPAC_CLOCKFILE,
+            'r').read().strip(), '%Y-%m-%d %H:%M:%S'))
+    except (IOError, OSError, ValueError):
+        return
+    if saved > time.time():
+        if clock_step(saved - time.time()):
+            sys.stdout.write('INFO: Clock restored to ' + \
+                time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(saved)) + \
+                ' UTC. \n')
+# end of clock_restore()
+
+def clock_save():
+    import time
+    try:
+        open(RPAC_CLOCKFILE, 'w').write(time.strftime('%Y-%m-%d %H:%M:%S',
+            time.gmtime()) + '\n')
+    except (IOError, OSError):
+        sys.stderr.write('WARN: Unable to write ' + RPAC_CLOCKFILE + '. \n')
+# end of clock_save()
+
+# Synchronise clock once network is up: SNTP first, then Date header of
+#  APT mirror. Returns True if clock is synchronised.
+def time_sync(configfile):
+    import time
+    if default_gateway() is None:
+        sys.stderr.write('WARN: Network not up, clock not ' + \
+            'synchronised. \n')
+        return False
+    started = time.time()
+    servers = configfile.get('Time', 'Servers',
+        fallback=','.join(RPAC_TIME_SERVERS))
+    servers = [server.strip() for server in servers.split(',') \
+        if server.strip()]
+    (offset, source) = (None, None)
+    for server in servers:
+        offset = sntp_offset(server, min(2, max(1, deadline('network'))))
+        if offset is not None:
+            source = server
+            break
+    mirrorurl = configfile.get('APT', 'Mirror', fallback='').strip()
+    if offset is None and mirrorurl:
+        offset = http_date_offset(mirrorurl, max(1, deadline('network')))
+        source = mirrorurl
+    progress_wait('time', time.time() - started)
+    if offset is None:
+        sys.stderr.write('WARN: Unable to synchronise clock, no time ' + \
+            'server reachable. \n')
+        return False
+    if abs(offset) >= 0.5:
+        if not clock_step(offset): return False
+        sys.stdout.write('INFO: Clock stepped by ' + \
+            str(round(offset, 3)) + ' seconds (' + source + '). \n')
+    else:
+        sys.stdout.write('INFO: Clock in sync with ' + source + ' (' + \
+            str(round(offset, 3)) + ' seconds). \n')
+    clock_save()
+    return True
+# end of time_sync()
+
+# Wait for control interface of wpa_supplicant on Wi-Fi device ethdev in
+#  service mode, which starts before networking init. Returns True if
+#  wpa_supplicant is up.
+def wpa_supplicant_wait(ethdev, timeout=RPAC_NETWORK_TIMEOUT):
+    import os, time
+    sockets = [os.path.join(d, ethdev) for d in ['/run/wpa_supplicant',
+        '/var/run/wpa_supplicant']]
+    def up():
+        return any([os.path.exists(path) for path in sockets])
+    started = time.time()
+    if not up():
+        sys.stdout.write('Waiting for wpa_supplicant on ' + ethdev + \
+            '... \n')
+    while not up() and time.time() - started < timeout:
+        time.sleep(1)
+    progress_wait('wpa_supplicant', time.time() - started)
+    if not up():
+        sys.stderr.write('WARN: wpa_supplicant still not running on ' + \
+            ethdev + ' after ' + str(timeout) + ' seconds. \n')
+        return False
+    return True
+# end of wpa_supplicant_wait()
+
+# Wait for network (a default route) in service mode, which starts before
+#  network is configured. Returns True if network is up.
+def network_wait(timeout=RPAC_NETWORK_TIMEOUT):
+    import time
+    started = time.time()
+    up = default_gateway() is not None
+    if not up:
+        sys.stdout.write('Waiting for network... \n')
+    while not up and time.time() - started < timeout:
+        time.sleep(1)
+        up = default_gateway() is not None
+    waited = time.time() - started
+    progress_wait('network', waited)
+    if not up:
+        sys.stderr.write('WARN: Network still not up after ' + \
+            str(timeout) + ' seconds. \n')
+    elif waited >= 1:
+        sys.stdout.write('INFO: Network up after ' + \
+            str(round(waited, 1)) + ' seconds. \n')
+    return up
+# end of network_wait()
+
+# Check an APT proxy: fetch mirrorurl through it (or only connect to it if
+#  no mirror given, or mirror is not http/ftp, which APT downloads directly,
+#  see apt_proxy()). Returns True if proxy is usable.
+def apt_proxy_check(proxyurl, mirrorurl=None, timeout=5):
+    import urllib.request, urllib.parse, socket
+    try:
+        if mirrorurl and urllib.parse.urlparse(mirrorurl).scheme in ('http',
+            'ftp'):
+            opener = urllib.request.build_opener(urllib.request.ProxyHandler(
+                {'http': proxyurl, 'ftp': proxyurl}))
+            opener.open(mirrorurl, timeout=timeout).close()
+        else:
+            parsed = urllib.parse.urlparse(proxyurl)
+            socket.create_connection((parsed.hostname, parsed.port or 80),
+                timeout).close()
+    except (urllib.error.URLError, socket.error, ValueError):
+        return False
+    return True
+# end of apt_proxy_check()
+
+# Local subnet of an IPv4 address, from the most specific non-default
+#  route of /proc/net/route containing it. Returns (network, netmask) as
+#  32-bit integers, or None if not found.
+def local_subnet(localip):
+    import os, socket, struct
+    address = struct.unpack('!L', socket.inet_aton(localip))[0]
+    subnet = None
+    try:
+        for line in open(os.path.join(RPAC_SYSROOT, 'proc/net/route'),
+            'r').readlines()[1:]:
+            fields = line.split()
+            if len(fields) < 8: continue
+            network = struct.unpack('!L', struct.pack('<L',
+                int(fields[1], 16)))[0]
+            netmask = struct.unpack('!L', struct.pack('<L',
+                int(fields[7], 16)))[0]
+            if netmask == 0 or address & netmask != network: continue
+            if subnet is None or netmask > subnet[1]:
+                subnet = (network, netmask)
+    except (IOError, OSError, ValueError):
+        pass
+    return subnet
+# end of local_subnet()
+
+# Discover a caching APT proxy (such as apt-cacher-ng) on local network:
+#  the default gateway first, then every host of local subnet (by its
+#  netmask, at most the 1024 addresses around this board), all probed with
+#  non-blocking connects on specific port. Each batch of probes waits up to
+#  timeout seconds, the whole sweep stops at the network deadline.
+# Returns proxy URL like 'http://192.168.1.10:3142/', or None.
+def apt_proxy_discover(port=3142, timeout=1.0):
+    import socket, select, errno, time, struct
+    gateway = default_gateway()
+    if not gateway: return None
+    # Local address facing the gateway (no packet is sent for UDP connect)
+    try:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.connect((gateway, 9))
+        localip = probe.getsockname()[0]
+        probe.close()
+    except socket.error:
+        return None
+    subnet = local_subnet(localip)
+    if subnet is None: # Unknown, assume /24
+        subnet = (struct.unpack('!L', socket.inet_aton(localip))[0] & \
+            0xffffff00, 0xffffff00)
+    netmask = subnet[1] | 0xfffffc00 # At most /22
+    network = struct.unpack('!L', socket.inet_aton(localip))[0] & netmask
+    broadcast = network | (~netmask & 0xffffffff)
+    hosts = [socket.inet_ntoa(struct.pack('!L', i)) \
+        for i in range(network + 1, broadcast)]
+    hosts = [gateway] + [host for host in hosts \
+        if host not in (gateway, localip)]
+
+    # Probe in batches, keep scan order (gateway first) among responders
+    BATCH = 64
+    sweepend = time.time() + deadline('network')
+    for i in range(0, len(hosts), BATCH):
+        if time.time() >= sweepend:
+            sys.stderr.write('WARN: APT proxy discovery stopped, deadline ' + \
+                'exceeded. \n')
+            break
+        pending = {}
+        for host in hosts[i : i+BATCH]:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            if sock.connect_ex((host, port)) in (0, errno.EINPROGRESS,
+                errno.EWOULDBLOCK):
+                pending[sock] = host
+            else:
+                sock.close()
+        found = []
+        expires = min(time.time() + timeout, sweepend)
+        while pending and time.time() < expires:
+            (r, w, x) = select.select([], list(pending), [],
+                max(0, expires - time.time()))
+            for sock in w:
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    found.append(pending[sock])
+                sock.close()
+                del pending[sock]
+        for sock in pending:
+            sock.close()
+        for host in hosts[i : i+BATCH]:
+            if host in found:
+                return 'http://' + host + ':' + str(port) + '/'
+    return None
+# end of apt_proxy_discover()
+
+# Set (or remove, if proxyurl is None) APT proxy.
+def apt_proxy(proxyurl):
+    import os
+    artifact_edit(RPAC_APT_PROXY_CONF)
+    if not proxyurl:
+        try:
+            os.remove(RPAC_APT_PROXY_CONF)
+        except OSError:
+            pass
+        return
+    try:
+        open(RPAC_APT_PROXY_CONF, 'w').write(
+            'Acquire::http::Proxy "' + proxyurl + '";\n' + \
+            'Acquire::ftp::Proxy "' + proxyurl + '";\n')
+    except IOError:
+        sys.stderr.write('FAILED: Unable to write ' + RPAC_APT_PROXY_CONF + \
+            '! \n')
+        sys.stderr.write('FAILED: APT proxy unchanged. \n')
+# end of apt_proxy()
+
+# True if kernel entropy pool is initialized (getrandom() would not block).
+#  Without getrandom() (Python < 3.6 or kernel < 3.17), entropy_avail is
+#  checked instead.
+def entropy_ready():
+    import os
+    if hasattr(os, 'getrandom'):
+        try:
+            os.getrandom(1, os.GRND_NONBLOCK)
+            return True
+        except BlockingIOError:
+            return False
+        except OSError: # ENOSYS
+            pass
+    try:
+        return int(open('/proc/sys/kernel/random/entropy_avail',
+            'r').read()) >= 128
+    except (IOError, OSError, ValueError):
+        return True # Unable to tell, do not wait
+# end of entropy_ready()
+
+# Add data to kernel entropy pool, crediting specific bits of entropy
+#  (RNDADDENTROPY ioctl of /dev/random, root required).
+def entropy_add(data, bits):
+    import fcntl, struct
+    RNDADDENTROPY = 0x40085203
+    try:
+        with open('/dev/random', 'wb') as frandom:
+            fcntl.ioctl(frandom, RNDADDENTROPY,
+                struct.pack('ii', bits, len(data)) + data)
+    except (IOError, OSError):
+        return False
+    return True
+# end of entropy_add()
+
+# Make sure kernel entropy pool is ready before generating keys or using
+#  TLS. If not ready, feed it from /dev/hwrng (if present) and the seed file
+#  on boot partition, and wait up to timeout seconds. Time spent waiting is
+#  recorded as progress.
+def entropy_stage(timeout=60):
+    import os, time
+    started = time.time()
+    if entropy_ready():
+        progress_wait('entropy', 0)
+        return True
+    sys.stdout.write('Waiting for kernel entropy pool... \n')
+
+    # Seed file: credited only if it was saved by this very board, a seed
+    # file shipped in the image is the same on every board.
+    try:
+        seed = open(RPAC_ENTROPY_SEED, 'rb').read()
+        (header, data) = seed.split(b'\n', 1)
+        owner = header.decode('ascii', 'replace').split()[1:]
+        serial = inventory()['serial']
+        entropy_add(data, 8 * len(data) if serial and owner == [serial] \
+            else 0)
+    except (IOError, OSError, ValueError):
+        pass
+
+    ready = entropy_ready()
+    while not ready and time.time() - started < timeout:
+        if os.path.exists('/dev/hwrng'):
+            try:
+                with open('/dev/hwrng', 'rb') as fhwrng:
+                    data = fhwrng.read(64)
+                entropy_add(data, 4 * len(data)) # credit half of it
+            except (IOError, OSError):
+                pass
+        ready = entropy_ready()
+        if not ready: time.sleep(0.5)
+
+    waited = time.time() - started
+    progress_wait('entropy', waited)
+    if ready:
+        sys.stdout.write('INFO: Entropy pool ready after ' + \
+            str(round(waited, 1)) + ' seconds. \n')
+    else:
+        sys.stderr.write('WARN: Entropy pool still not ready after ' + \
+            str(timeout) + ' seconds. \n')
+    return ready
+# end of entropy_stage()
+
+# Save a new entropy seed file for next boot, tagged with board serial.
+def entropy_seed_save():
+    import os
+    try:
+        data = os.urandom(512)
+        header = 'RPACSEED ' + inventory()['serial'] + '\n'
+        open(RPAC_ENTROPY_SEED + '.tmp', 'wb').write(
+            header.encode('ascii') + data)
+        os.rename(RPAC_ENTROPY_SEED + '.tmp', RPAC_ENTROPY_SEED)
+    except (IOError, OSError):
+        sys.stderr.write('WARN: Unable to save entropy seed file ' + \
+            RPAC_ENTROPY_SEED + '. \n')
+# end of entropy_seed_save()
+
+# Set a setting in /boot/config.txt text. Setting is commented out if value
+#  is None. Returns new text.
+def configtxt_set(cnftxt, name, value):
+    import re
+    if value is None:
+        patt = '^(\\s*' + re.escape(name) + '\\s*=)'; repl = '#\\g<1>'
+        return re.sub(patt, repl, cnftxt, flags=re.M)
+    patt = '^\\s*#?\\s*' + re.escape(name) + '\\s*=.*$'
+    repl = name + '=' + str(value)
+    [cnftxt, n] = re.subn(patt, repl, cnftxt, 1, flags=re.M)
+    if n == 0: cnftxt += '\n' + repl
+    return cnftxt
+# end of configtxt_set()
+
+# Check a performance setting against limits of the board.
+# Returns value to write, None for firmware default, or False if invalid.
+def performance_check(name, value, inv):
+    if value is None: return None
+    family = RPAC_BOARD_FAMILIES.get(inv['model'], 'pi1') # Unknown: safest
+    if name == 'force_turbo':
+        if value not in (0, 1): return False
+        return value
+    if name == 'gpu_mem':
+        ram = inv['ram'] or 256
+        (low, high) = (16, min(ram - 64, 944))
+    else:
+        (low, high) = RPAC_PERFORMANCE_LIMITS[family][name]
+    if value < low or value > high:
+        sys.stderr.write('WARN: ' + name + '=' + str(value) + ' out of ' + \
+            'safe range ' + str(low) + '~' + str(high) + ' for this board ' + \
+            '(model ' + (inv['model'] or 'unknown') + '), ' + \
+            str(max(low, min(value, high))) + ' is used instead. \n')
+        value = max(low, min(value, high))
+    return value
+# end of performance_check()
+
+# Settings of a [Performance] profile for this board. A clock not above
+#  stock clock of the board model is left to firmware default instead (and
+#  so is over_voltage, if ARM clock is). Clocks and voltage are not set at
+#  all on an unknown board model.
+def performance_profile(profile, inv):
+    family = RPAC_BOARD_FAMILIES.get(inv['model'])
+    stock = RPAC_PERFORMANCE_STOCK.get(inv['model'])
+    settings = dict(RPAC_PERFORMANCE_PROFILES[profile][family or 'pi1'])
+    if family is None or stock is None:
+        if profile != 'stock':
+            sys.stderr.write('WARN: Unknown board model, clocks and ' + \
+                'voltage of profile ' + profile + ' not applied. \n')
+        for name in ['arm_freq', 'core_freq', 'sdram_freq', 'over_voltage']:
+            del settings[name]
+        return settings
+    for (name, stockvalue) in zip(['arm_freq', 'core_freq', 'sdram_freq'],
+        stock):
+        if settings[name] is not None and settings[name] <= stockvalue:
+            settings[name] = None
+    if settings['arm_freq'] is None:
+        settings['over_voltage'] = None
+    return settings
+# end of performance_profile()
+
+# config.txt settings of [Performance] section: profile of the board family
+#  first, then explicit overrides. Values are integers, or None for firmware
+#  default.
+def performance_settings(configfile):
+    SECNAME = 'Performance'
+    settings = {}
+    if configfile.has_option(SECNAME, 'Profile'):
+        profile = configfile.get(SECNAME, 'Profile').strip().lower()
+        if profile in RPAC_PERFORMANCE_PROFILES:
+            settings.update(performance_profile(profile, inventory()))
+        else:
+            sys.stderr.write('WARN: Invalid [Performance].Profile value. ' + \
+                '(Available: ' + \
+                ', '.join(sorted(RPAC_PERFORMANCE_PROFILES)) + ') \n')
+            sys.stderr.write('FAILED: Performance profile not applied. \n')
+    for (option, name) in sorted(RPAC_PERFORMANCE_OPTIONS.items()):
+        if not configfile.has_option(SECNAME, option): continue
+        value = configfile.get(SECNAME, option).strip().lower()
+        if value == 'default':
+            settings[name] = None
+            continue
+        try:
+            settings[name] = int(value)
+        except ValueError:
+            sys.stderr.write('WARN: Invalid [Performance].' + option + \
+                ' value. \n')
+            sys.stderr.write('FAILED: ' + name + ' unchanged. \n')
+    return settings
+# end of performance_settings()
+
+# Load /proc/meminfo into a dictionary, values in kB.
+def meminfo():
+    info = {}
+    try:
+        for line in open('/proc/meminfo', 'r'):
+            fields = line.split()
+            if len(fields) >= 2 and fields[1].isdigit():
+                info[fields[0].rstrip(':')] = int(fields[1])
+    except (IOError, OSError):
+        pass
+    return info
+# end of meminfo()
+
+# Memory available for new processes, in MB. Kernels older than 3.14 have
+#  no MemAvailable, estimated from free memory and page cache instead.
+def mem_available():
+    info = meminfo()
+    if 'MemAvailable' in info:
+        return info['MemAvailable'] // 1024
+    return (info.get('MemFree', 0) + info.get('Buffers', 0) + \
+        info.get('Cached', 0)) // 1024
+# end of mem_available()
+
+# Memory pressure from PSI (/proc/pressure/memory, kernel 4.20 or later):
+#  share of time (%) some tasks stalled on memory in last 10 seconds.
+# Returns None if PSI not supported.
+def mem_pressure():
+    try:
+        for line in open('/proc/pressure/memory', 'r'):
+            if line.startswith('some'):
+                for field in line.split():
+                    if field.startswith('avg10='):
+                        return float(field[len('avg10='):])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+# end of mem_pressure()
+
+# Load memory guard settings from [Memory] section:
+#  GuardMinAvailable: minimum available memory (MB) to start a heavy step
+#  GuardMaxPressure: maximum memory pressure (PSI some avg10, %)
+#  GuardWait: maximum seconds to hold off a heavy step for memory
+#  GuardSwap: size (MB) of temporary swapfile, 0 to disable
+def memguard_setup(configfile):
+    SECNAME = 'Memory'
+    if not configfile.has_section(SECNAME): return
+    for (option, key, conv) in [('GuardMinAvailable', 'minavailable', int),
+        ('GuardMaxPressure', 'maxpressure', float), ('GuardWait', 'wait', int),
+        ('GuardSwap', 'swapsize', int)]:
+        if configfile.has_option(SECNAME, option):
+            try:
+                RPAC_MEMGUARD[key] = conv(configfile.get(SECNAME, option))
+            except ValueError:
+                sys.stderr.write('WARN: Invalid [Memory].' + option + \
+                    ' value, default is used instead. \n')
+# end of memguard_setup()
+
+# True if there is enough memory headroom to run a heavy step.
+def memguard_ok():
+    if mem_available() < RPAC_MEMGUARD['minavailable']:
+        return False
+    pressure = mem_pressure()
+    return pressure is None or pressure <= RPAC_MEMGUARD['maxpressure']
+# end of memguard_ok()
+
+# Enable temporary swapfile, removed by memguard_cleanup(). Does nothing if
+#  enough swap is free already.
+def memguard_swapon():
+    import os
+    if RPAC_MEMGUARD['swapon'] or RPAC_MEMGUARD['swapsize'] <= 0: return
+    if meminfo().get('SwapFree', 0) // 1024 >= RPAC_MEMGUARD['swapsize']:
+        return
+    swapfile = RPAC_MEMGUARD['swapfile']
+    sys.stdout.write('Low memory, enabling temporary swapfile (' + \
+        str(RPAC_MEMGUARD['swapsize']) + ' MB)... \n')
+    try:
+        fswap = open(swapfile, 'wb')
+        os.chmod(swapfile, 0o600)
+        block = bytes(1024 * 1024)
+        for i in range(RPAC_MEMGUARD['swapsize']):
+            fswap.write(block)
+        fswap.close()
+    except (IOError, OSError):
+        sys.stderr.write('WARN: Unable to create temporary swapfile. \n')
+        return
+    devnull = open('/dev/null', 'w')
+    if timed_call(['mkswap', swapfile], stdout=devnull) == 0 and \
+        timed_call(['swapon', swapfile]) == 0:
+        RPAC_MEMGUARD['swapon'] = True
+    else:
+        sys.stderr.write('WARN: Unable to enable temporary swapfile. \n')
+        os.remove(swapfile)
+# end of memguard_swapon()
+
+# Disable and remove temporary swapfile, if any.
+def memguard_cleanup():
+    import os
+    if not RPAC_MEMGUARD['swapon']: return
+    timed_call(['swapoff', RPAC_MEMGUARD['swapfile']])
+    try:
+        os.remove(RPAC_MEMGUARD['swapfile'])
+    except OSError:
+        pass
+    RPAC_MEMGUARD['swapon'] = False
+# end of memguard_cleanup()
+
+# Seconds left for a step of given kind ('command', 'heavy', 'network'),
+#  limited by current section and total deadlines. 0 if none left.
+def deadline(kind):
+    import time
+    now = time.time()
+    limits = [RPAC_DEADLINES[kind]]
+    for end in [RPAC_DEADLINES['sectionend'], RPAC_DEADLINES['runend']]:
+        if end: limits.append(end - now)
+    return max(0, min(limits))
+# end of deadline()
+
+# Load deadlines from [Deadlines] section of autoconfig.ini and start the
+#  clock of the whole run:
+#  Command, Heavy, Network: deadline of each step of that kind
+#  Total: deadline of the whole run
+#  <section name>: deadline of that section, e.g. APT=1200
+def deadline_setup(configfile):
+    import time
+    SECNAME = 'Deadlines'
+    if configfile.has_section(SECNAME):
+        for (option, value) in configfile.items(SECNAME):
+            value = value.strip()
+            if not value.isdigit() or int(value) == 0:
+                sys.stderr.write('WARN: Invalid [Deadlines].' + option + \
+                    ' value, ignored. \n')
+            elif option in ['command', 'heavy', 'network', 'total']:
+                RPAC_DEADLINES[option] = int(value)
+            elif option == 'watchdogtimeout':
+                RPAC_WATCHDOG['timeout'] = int(value)
+            elif option == 'attempts':
+                RPAC_WATCHDOG['attempts'] = int(value)
+            else:
+                RPAC_DEADLINES['sections'][option] = int(value)
+    RPAC_DEADLINES['runend'] = time.time() + RPAC_DEADLINES['total']
+# end of deadline_setup()
+
+# Start the deadline of a section (none if not set in [Deadlines]).
+def deadline_section(secname):
+    import time
+    seconds = RPAC_DEADLINES['sections'].get(secname.lower())
+    RPAC_DEADLINES['sectionend'] = time.time() + seconds if seconds else 0.0
+# end of deadline_section()
+
+# Drop section and total deadlines at the end of a run, so cleanup steps
+#  are still done.
+def deadline_finish():
+    RPAC_DEADLINES['sectionend'] = 0.0
+    RPAC_DEADLINES['runend'] = 0.0
+# end of deadline_finish()
+
+# Start a command in a new session (so it can be killed with its children,
+#  see deadline_kill()), like subprocess.Popen(). Command line is kept in
+#  proc.cmdline (Popen.args is Python 3.3 or later).
+def timed_popen(args, **kwargs):
+    import subprocess
+    proc = subprocess.Popen(args, start_new_session=True, **kwargs)
+    proc.cmdline = list(args)
+    return proc
+# end of timed_popen()
+
+# Kill a command which ran out of its deadline, with its children (it is
+#  started by timed_popen() in a new session), and record the failure.
+def deadline_kill(proc, timeout):
+    import os, signal
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError: # ESRCH, already exited
+        pass
+    proc.wait()
+    sys.stderr.write('FAILED: ' + ' '.join(proc.cmdline) + ' killed, ' + \
+        'deadline of ' + str(int(timeout)) + ' seconds exceeded. \n')
+# end of deadline_kill()
+
+# Run a command like subprocess.call(), killed if not finished before its
+#  deadline. A command is not started at all if no time is left.
+# (Polled like heavy_call(): Popen.wait() has no timeout before Python 3.3)
+# Returns exit code (negative signal number if killed).
+def timed_call(args, kind='command', **kwargs):
+    import signal, time
+    timeout = deadline(kind)
+    if timeout <= 0:
+        sys.stderr.write('FAILED: ' + ' '.join(args) + ' not run, ' + \
+            'deadline exceeded. \n')
+        return -signal.SIGKILL
+    proc = timed_popen(args, **kwargs)
+    (started, interval) = (time.time(), 0.01)
+    while proc.poll() is None:
+        if time.time() - started > timeout:
+            deadline_kill(proc, timeout)
+            break
+        time.sleep(interval)
+        interval = min(interval * 2, 0.5)
+    return proc.returncode
+# end of timed_call()
+
+# proc.communicate() with deadline, proc started by timed_popen().
+#  (Run in a thread: Popen.communicate() has no timeout before Python 3.3)
+# Returns (stdout, stderr), empty if killed.
+def timed_communicate(proc, data=None, kind='command'):
+    import threading
+    timeout = max(1, deadline(kind))
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        proc.communicate(data)))
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        deadline_kill(proc, timeout)
+        thread.join()
+        return (b'', b'')
+    return result[0] if result else (b'', b'')
+# end of timed_communicate()
+
+# Run a memory-heavy command (locale-gen, apt-get, dpkg, ssh-keygen) under
+#  memory guard, like timed_call():
+#  - before starting: wait up to GuardWait seconds for enough headroom,
+#    enable temporary swap if there is still not enough;
+#  - while running: enable temporary swap if headroom gets too small;
+#  - afterwards: log peak RSS of the command.
+# Command is killed (with its children) when running out of its deadline.
+# Returns exit code (negative signal number if killed).
+def heavy_call(args, **kwargs):
+    import os, signal, subprocess, time
+    label = os.path.basename(args[0])
+    waited = 0
+    while not memguard_ok() and waited < RPAC_MEMGUARD['wait']:
+        if waited == 0:
+            sys.stdout.write('Waiting for free memory before ' + label + \
+                '... \n')
+        time.sleep(2)
+        waited += 2
+    if not memguard_ok():
+        memguard_swapon()
+
+    timeout = deadline('heavy')
+    if timeout <= 0:
+        sys.stderr.write('FAILED: ' + ' '.join(args) + ' not run, ' + \
+            'deadline exceeded. \n')
+        return -signal.SIGKILL
+    proc = timed_popen(args, **kwargs)
+    started = time.time()
+    while True:
+        (pid, status, rusage) = os.wait4(proc.pid, os.WNOHANG)
+        if pid: break
+        if not RPAC_MEMGUARD['swapon'] and not memguard_ok():
+            memguard_swapon()
+        if time.time() - started > timeout:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError: # ESRCH, exited meanwhile
+                pass
+            sys.stderr.write('FAILED: ' + ' '.join(args) + ' killed, ' + \
+                'deadline of ' + str(int(timeout)) + ' seconds ' + \
+                'exceeded. \n')
+            (pid, status, rusage) = os.wait4(proc.pid, 0)
+            break
+        time.sleep(0.5)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    sys.stdout.write('INFO: ' + label + ' finished (exit code ' + \
+        str(proc.returncode) + ', peak RSS ' + \
+        str(rusage.ru_maxrss // 1024) + ' MB). \n')
+    return proc.returncode
+# end of heavy_call()
+
+# Fingerprint of settings of a step, to tell if a baked step is still
+#  valid for current autoconfig.ini.
+def bake_fingerprint(settings):
+    import hashlib
+    return hashlib.sha1(repr(settings).encode('UTF-8')).hexdigest()
+# end of bake_fingerprint()
+
+# Load record of baked steps: {step: {'fingerprint': ..., 'time': ...}}
+def bake_record():
+    import json
+    try:
+        return json.load(open(RPAC_BAKEFILE, 'r'))
+    except (IOError, OSError, ValueError):
+        return {}
+# end of bake_record()
+
+# True if a device-independent step has been done at image build time with
+#  the same settings, so it's skipped at first boot.
+# Parameters:
+#  step: step name, like 'Localization.Timezone'
+#  settings: settings of the step from autoconfig.ini
+def baked(step, settings):
+    if RPAC_MODE == 'bake': return False
+    record = bake_record().get(step)
+    if record and record.get('fingerprint') == bake_fingerprint(settings):
+        sys.stdout.write('INFO: ' + step + ' already done at image ' + \
+            'build time, skipped. \n')
+        return True
+    return False
+# end of baked()
+
+# Record a device-independent step done successfully in bake mode.
+def bake_done(step, settings):
+    if RPAC_MODE != 'bake': return
+    import json, os, time
+    record = bake_record()
+    record[step] = {'fingerprint': bake_fingerprint(settings),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    try:
+        if not os.path.isdir(RPAC_STATEDIR):
+            os.makedirs(RPAC_STATEDIR)
+        open(RPAC_BAKEFILE + '.tmp', 'w').write(json.dumps(record,
+            indent=1, sort_keys=True))
+        os.rename(RPAC_BAKEFILE + '.tmp', RPAC_BAKEFILE)
+    except (IOError, OSError):
+        sys.stderr.write('WARN: Unable to record baked step ' + step + \
+            ' in ' + RPAC_BAKEFILE + '. \n')
+        return
+    sys.stdout.write('INFO: ' + step + ' baked. \n')
+# end of bake_done()
+
+# Manifest of artifacts, loaded once: {'files': {path: backup path, or None
+#  if created}, 'initscripts': [names], 'services': {name: enabled before},
+#  'packages': [names installed]}
+def artifacts():
+    global RPAC_ARTIFACTS
+    if RPAC_ARTIFACTS is None:
+        import json
+        try:
+            RPAC_ARTIFACTS = json.load(open(RPAC_MANIFEST, 'r'))
+        except (IOError, OSError, ValueError):
+            RPAC_ARTIFACTS = {}
+        for (key, empty) in [('files', {}), ('initscripts', []),
+            ('services', {}), ('packages', [])]:
+            RPAC_ARTIFACTS.setdefault(key, empty)
+    return RPAC_ARTIFACTS
+# end of artifacts()
+
+def artifacts_save():
+    import json, os
+    try:
+        if not os.path.isdir(RPAC_STATEDIR):
+            os.makedirs(RPAC_STATEDIR)
+        open(RPAC_MANIFEST + '.tmp', 'w').write(json.dumps(artifacts(),
+            indent=1, sort_keys=True))
+        os.rename(RPAC_MANIFEST + '.tmp', RPAC_MANIFEST)
+    except (IOError, OSError):
+        sys.stderr.write('WARN: Unable to write ' + RPAC_MANIFEST + '. \n')
+# end of artifacts_save()
+
+# Record a file about to be written (or removed). First time only: an
+#  existing file is backed up, a new one is recorded as created.
+def artifact_edit(path):
+    import os, shutil
+    path = os.path.abspath(path)
+    files = artifacts()['files']
+    if path in files: return
+    if os.path.exists(path):
+        backup = RPAC_BACKUPDIR + path
+        try:
+            if not os.path.isdir(os.path.dirname(backup)):
+                os.makedirs(os.path.dirname(backup))
+            shutil.copy2(path, backup)
+        except (IOError, OSError):
+            sys.stderr.write('WARN: Unable to back up ' + path + '. \n')
+            return
+        files[path] = backup
+    else:
+        files[path] = None
+    artifacts_save()
+# end of artifact_edit()
+
+# Record a service about to be enabled/disabled, with its state before.
+def artifact_service(name):
+    services = artifacts()['services']
+    if name in services: return
+    services[name] = service_enabled(name)
+    artifacts_save()
+# end of artifact_service()
+
+# Record packages about to be installed, the ones not installed yet.
+def artifact_packages(packages):
+    recorded = artifacts()['packages']
+    installed = dpkg_installed()
+    for package in packages:
+        if package not in installed and package not in recorded:
+            recorded.append(package)
+    artifacts_save()
+# end of artifact_packages()
+
+# Remove everything recorded in the manifest: init scripts (with their rc.d
+#  links), packages and created files. With rollback, also restore edited
+#  files from backups and services to their previous state.
+# Returns True if everything is done.
+def artifacts_uninstall(rollback=False):
+    import os, shutil
+    manifest = artifacts()
+    done = True
+    for name in list(manifest['initscripts']):
+        sys.stdout.write('Removing init script ' + name + '... \n')
+        initscript_remove(name)
+    if manifest['packages']:
+        sys.stdout.write('Removing packages ' + \
+            ' '.join(manifest['packages']) + '... \n')
+        if heavy_call(['apt-get', '-y', 'remove'] + \
+            manifest['packages']) == 0:
+            manifest['packages'] = []
+        else:
+            done = False
+    for (path, backup) in sorted(manifest['files'].items(), reverse=True):
+        try:
+            if backup is None:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    os.rmdir(path) # only if empty
+                elif os.path.lexists(path):
+                    os.remove(path)
+                del manifest['files'][path]
+            elif rollback:
+                shutil.copy2(backup, path)
+                sys.stdout.write('INFO: ' + path + ' restored. \n')
+                del manifest['files'][path]
+        except (IOError, OSError) as err:
+            sys.stderr.write('FAILED: Unable to remove/restore ' + path + \
+                ' (' + str(err) + '). \n')
+            done = False
+    if rollback:
+        for (name, enabled) in sorted(manifest['services'].items()):
+            timed_call(['update-rc.d', name, 'enable' if enabled else \
+                'disable'])
+        manifest['services'] = {}
+    artifacts_save()
+    if rollback and done:
+        shutil.rmtree(RPAC_BACKUPDIR, ignore_errors=True)
+    return done
+# end of artifacts_uninstall()
+
+# Install an init script into /etc/init.d/ and enable it (update-rc.d).
+def initscript_install(name, content):
+    import os, stat
+    scriptpath = os.path.join('/etc/init.d/', name)
+    artifact_edit(scriptpath)
+    if artifacts()['files'].get(scriptpath, '') is not None:
+        # Script not created by raspi-autoconfig (e.g. shipped by a
+        # package): not removed by --uninstall, its rc.d links are restored
+        # by --rollback
+        artifact_service(name)
+    elif name not in artifacts()['initscripts']:
+        artifacts()['initscripts'].append(name)
+        artifacts_save()
+    try:
+        open(scriptpath, 'w').write(content)
+        os.chmod(scriptpath, os.stat(scriptpath).st_mode | stat.S_IEXEC)
+    except (IOError, OSError):
+        sys.stderr.write('FAILED: Unable to write ' + scriptpath + '! \n')
+        return False
+    return timed_call(['update-rc.d', name, 'defaults']) == 0
+# end of initscript_install()
+
+# Disable and remove an init script (installed by initscript_install(), or
+#  recorded in manifest otherwise).
+def initscript_remove(name):
+    import os
+    scriptpath = os.path.join('/etc/init.d/', name)
+    if name in artifacts()['initscripts']:
+        artifacts()['initscripts'].remove(name)
+        if artifacts()['files'].get(scriptpath, '') is None:
+            del artifacts()['files'][scriptpath]
+        artifacts_save()
+    elif os.path.exists(scriptpath):
+        # Not created by raspi-autoconfig: backed up for --rollback
+        artifact_service(name)
+        artifact_edit(scriptpath)
+    if not os.path.exists(scriptpath): return
+    timed_call([scriptpath, 'stop'])
+    os.remove(scriptpath)
+    timed_call(['update-rc.d', name, 'remove'])
+# end of initscript_remove()
+
+# Set a kernel parameter at once (via /proc/sys), like `sysctl -w`.
+# Returns False if the parameter does not exist in running kernel.
+def sysctl_set(name, value):
+    import os
+    path = os.path.join('/proc/sys', name.replace('.', '/'))
+    if not os.path.exists(path):
+        return False
+    try:
+        open(path, 'w').write(str(value))
+    except (IOError, OSError):
+        return False
+    return True
+# end of sysctl_set()
+
+# Persist kernel parameters in /etc/sysctl.d/<filename>, applied on boot.
+# Parameters:
+#  settings: list of (name, value)
+def sysctl_persist(filename, settings):
+    import os
+    path = os.path.join('/etc/sysctl.d', filename)
+    artifact_edit(path)
+    try:
+        if not settings:
+            if os.path.exists(path): os.remove(path)
+            return True
+        open(path, 'w').write('# Written by raspi-autoconfig\n' + \
+            ''.join([name + ' = ' + str(value) + '\n' \
+            for (name, value) in settings]))
+    except (IOError, OSError):
+        sys.stderr.write('FAILED: Unable to write ' + path + '! \n')
+        return False
+    return True
+# end of sysctl_persist()
+
+# Kernel parameters of [Tuning].SysctlProfile, overridden by
+#  [Tuning].Sysctl items. Returns a list of (name, value).
+def sysctl_settings(configfile):
+    import re
+    SECNAME = 'Tuning'
+    settings = []
+    if configfile.has_option(SECNAME, 'SysctlProfile'):
+        value = configfile.get(SECNAME, 'SysctlProfile').strip().lower()
+        if value in RPAC_SYSCTL_PROFILES:
+            settings.extend(RPAC_SYSCTL_PROFILES[value])
+        elif value != 'none':
+            sys.stderr.write('WARN: Invalid [Tuning].SysctlProfile value. ' + \
+                '(Available: ' + ', '.join(sorted(RPAC_SYSCTL_PROFILES)) + \
+                ', none) \n')
+            sys.stderr.write('FAILED: Sysctl profile not applied. \n')
+        # [Memory].Swappiness takes precedence
+        if configfile.has_option('Memory', 'Swappiness'):
+            settings = [(name, v) for (name, v) in settings \
+                if name != 'vm.swappiness']
+    if configfile.has_option(SECNAME, 'Sysctl'):
+        # Comma separated name=value list, overriding profile
+        for item in configfile.get(SECNAME, 'Sysctl').split(','):
+            m = re.match('^\\s*(?P<name>[\\w.]+)\\s*=\\s*(?P<value>.+?)\\s*$',
+                item)
+            if not m:
+                sys.stderr.write('WARN: Invalid [Tuning].Sysctl item: ' + \
+                    item.strip() + '. \n')
+                continue
+            settings = [(name, v) for (name, v) in settings \
+                if name != m.group('name')]
+            settings.append((m.group('name'), m.group('value')))
+    return settings
+# end of sysctl_settings()
+
+# Choices of a sysfs setting, like scaling_available_governors or
+#  queue/scheduler ("noop deadline [cfq]"). Returns (choices, current),
+#  ([], None) if not available.
+def sysfs_choices(path):
+    try:
+        text = open(path, 'r').read()
+    except (IOError, OSError):
+        return ([], None)
+    current = None
+    choices = []
+    for choice in text.split():
+        if choice.startswith('[') and choice.endswith(']'):
+            choice = choice[1:-1]
+            current = choice
+        choices.append(choice)
+    return (choices, current)
+# end of sysfs_choices()
+
+# Parse /etc/fstab text into a list of entries. Each entry is a dictionary:
+#  'line': original line text
+#  'fields': [spec, file, vfstype, mntops, freq, passno], or None for
+#            comment and blank lines
+#  'changed': True if fields are modified (line is rebuilt on format)
+def fstab_parse(text):
+    entries = []
+    for line in text.split('\n'):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            fields = None
+        else:
+            fields = (fields + ['defaults', '0', '0'])[:6] \
+                if len(fields) >= 3 else None
+        entries.append({'line': line, 'fields': fields, 'changed': False})
+    return entries
+# end of fstab_parse()
+
+# Build /etc/fstab text from entries of fstab_parse().
+def fstab_format(entries):
+    lines = []
+    for entry in entries:
+        if entry['changed']:
+            f = entry['fields']
+            lines.append(f[0].ljust(15) + ' ' + f[1].ljust(15) + ' ' + \
+                f[2].ljust(7) + ' ' + f[3].ljust(25) + ' ' + f[4] + \
+                '       ' + f[5])
+        else:
+            lines.append(entry['line'])
+    return '\n'.join(lines)
+# end of fstab_format()
+
+# Check fstab entries of fstab_parse() before writing /etc/fstab: field
+#  count, numeric dump/pass fields and duplicate mount points, and for
+#  changed entries, existing mount point and filesystem type known to the
+#  kernel (/proc/filesystems). Returns a list of problems, empty if none.
+def fstab_check(entries):
+    import os
+    try:
+        fstypes = ['swap', 'auto'] + [line.split()[-1] for line in \
+            open(os.path.join(RPAC_SYSROOT, 'proc/filesystems'),
+            'r').readlines() if line.strip()]
+    except (IOError, OSError):
+        fstypes = None
+    problems = []
+    mountpoints = []
+    for (n, entry) in enumerate(entries):
+        where = 'line ' + str(n + 1) + ': '
+        fields = entry['line'].split()
+        if entry['fields'] is None:
+            if fields and not fields[0].startswith('#'):
+                problems.append(where + 'too few fields')
+            continue
+        (spec, mountpoint, vfstype, mntops, freq, passno) = entry['fields']
+        if not entry['changed'] and len(fields) > 6:
+            problems.append(where + 'too many fields')
+        if not freq.isdigit() or not passno.isdigit():
+            problems.append(where + 'dump and pass fields must be numbers')
+        if mountpoint in ('none', 'swap'):
+            pass
+        elif not mountpoint.startswith('/'):
+            problems.append(where + 'invalid mount point ' + mountpoint)
+        elif mountpoint in mountpoints:
+            problems.append(where + 'duplicate mount point ' + mountpoint)
+        else:
+            mountpoints.append(mountpoint)
+        if not entry['changed']: continue
+        if mountpoint.startswith('/') and not os.path.isdir(mountpoint):
+            problems.append(where + 'mount point ' + mountpoint + \
+                ' does not exist')
+        if fstypes is not None and vfstype not in fstypes:
+            problems.append(where + 'unknown filesystem type ' + vfstype)
+    return problems
+# end of fstab_check()
+
+# Find fstab entry of specific mount point, or None.
+def fstab_find(entries, mountpoint):
+    for entry in entries:
+        if entry['fields'] and entry['fields'][1] == mountpoint:
+            return entry
+    return None
+# end of fstab_find()
+
+# Set a mount option of fstab entry, like "noatime" or "commit=60".
+# Options named in 'replaces' (e.g. atime/relatime) are removed as well.
+def fstab_set_option(entry, option, replaces=()):
+    name = option.split('=', 1)[0]
+    options = [o for o in entry['fields'][3].split(',') \
+        if o and o != 'defaults' and o.split('=', 1)[0] != name and \
+        o.split('=', 1)[0] not in replaces]
+    options.append(option)
+    newoptions = ','.join(options)
+    if newoptions != entry['fields'][3]:
+        entry['fields'][3] = newoptions
+        entry['changed'] = True
+# end of fstab_set_option()
+
+# Add or update a tmpfs mount of fstab, or remove it (size None).
+def fstab_set_tmpfs(entries, mountpoint, size, mode):
+    entry = fstab_find(entries, mountpoint)
+    if size is None:
+        if entry and entry['fields'][2] == 'tmpfs':
+            entries.remove(entry)
+        return
+    fields = ['tmpfs', mountpoint, 'tmpfs',
+        'defaults,noatime,nosuid,nodev,mode=' + mode + ',size=' + size,
+        '0', '0']
+    if entry is None:
+        if entries and entries[-1]['line'] == '':
+            entries.insert(len(entries) - 1, {'line': '', 'fields': fields,
+                'changed': True})
+        else:
+            entries.append({'line': '', 'fields': fields, 'changed': True})
+    elif entry['fields'] != fields:
+        entry['fields'] = fields
+        entry['changed'] = True
+# end of fstab_set_tmpfs()
+
+# Size of zram swap in MB, from [Memory].ZramSize value: size in MB, or
+#  percentage of RAM like 50%. Returns None for an invalid value.
+def zram_size(sizeraw):
+    import re
+    m = re.match('^\\s*(?P<size>\\d+)\\s*(?P<percent>%?)\\s*$', sizeraw)
+    if not m: return None
+    if not m.group('percent'): return int(m.group('size'))
+    memtotal = inventory()['memtotal'] or meminfo().get('MemTotal', 0) // 1024
+    return memtotal * int(m.group('size')) // 100
+# end of zram_size()
+
+# Active swap areas from /proc/swaps: {path: size in kB}
+def active_swaps():
+    swaps = {}
+    try:
+        for line in open('/proc/swaps', 'r').readlines()[1:]:
+            fields = line.split()
+            if len(fields) >= 3 and fields[2].isdigit():
+                swaps[fields[0]] = int(fields[2])
+    except (IOError, OSError):
+        pass
+    return swaps
+# end of active_swaps()
+
 # Install vnc server autorun script. 
 def remote_vnc_autorun_install(resolutionwidth=800, resolutionheight=600):
     # exception handling pending for this function!!!
@@ -406,53 +2582,394 @@ str(resolutionwidth) + 'x' + str(resolutionheight) + \
 esac
 exit 0
 '''
-    SCRIPTPATH = '/etc/init.d/'
-    SCRIPTFILENAME = 'tightvncserver'
+    # Write script file in /etc/init.d/, run update-rc.d
+    return initscript_install('tightvncserver', SCRIPTCONTENT)
+# end of remote_vnc_autorun_install()
+
+# Uninstall vnc server autorun script. Only the one installed by
+#  remote_vnc_autorun_install() (recorded in manifest) is removed.
+def remote_vnc_autorun_uninst():
     import os
-    SCRIPTFULLPATH = os.path.join(SCRIPTPATH, SCRIPTFILENAME)
+    if 'tightvncserver' not in artifacts()['initscripts']:
+        if os.path.exists('/etc/init.d/tightvncserver'):
+            sys.stderr.write('WARN: /etc/init.d/tightvncserver was not ' + \
+                'installed by raspi-autoconfig, left unchanged. \n')
+        return
+    initscript_remove('tightvncserver')
+# end of remote_vnc_autorun_uninst()
+
+def restore_inittab():
+    # No /etc/inittab with systemd
+    try:
+        inittab_text = open('/etc/inittab', 'r').read()
+    except IOError:
+        return
     
-    # Write script file in /etc/init.d/
-    open(SCRIPTFULLPATH, 'w').write(SCRIPTCONTENT)
-    # Chmod +x
-    import os, stat
-    filestat = os.stat(SCRIPTFULLPATH)
-    os.chmod(SCRIPTFULLPATH, filestat.st_mode | stat.S_IEXEC)
-    # Run update-rc.d
-    import subprocess
-    subprocess.call(['update-rc.d', SCRIPTFILENAME, 'defaults'])
+    import re
+    patt = '^(\\s*#)(?P<cmd>.*)(#\\s*RPICFG_TO_ENABLE).*$'
+    repl = '\g<cmd>'
+    inittab_text = re.sub(patt, repl, inittab_text, flags=re.M)
     
-    return
-# end of remote_vnc_autorun_install()
+    patt = '\\n(.*)(#\\s*RPICFG_TO_DISABLE).*'
+    repl = ''
+    inittab_text = re.sub(patt, repl, inittab_text)
+    
+    artifact_edit('/etc/inittab')
+    open('/etc/inittab', 'w').write(inittab_text)
+# end of restore_inittab()
+
+# Make sure only one instance runs (e.g. service started at boot, and the
+#  /etc/profile.d hook of an interactive login). Lock is held until exit.
+def run_lock():
+    global RPAC_LOCK
+    import fcntl
+    try:
+        RPAC_LOCK = open(RPAC_LOCKFILE, 'w')
+    except (IOError, OSError):
+        return True # e.g. no /run in image chroot, run without lock
+    try:
+        fcntl.flock(RPAC_LOCK.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        return False
+    return True
+# end of run_lock()
+
+# Disable and remove the early-boot service (init script and systemd
+#  unit). The init script is not stopped: that would stop this very run.
+def service_remove():
+    import os
+    scriptpath = os.path.join('/etc/init.d/', RPAC_SERVICE_NAME)
+    if os.path.exists(scriptpath):
+        os.remove(scriptpath)
+        timed_call(['update-rc.d', RPAC_SERVICE_NAME, 'remove'])
+    unitname = RPAC_SERVICE_NAME + '.service'
+    for unitdir in ['/etc/systemd/system/', '/lib/systemd/system/']:
+        if not os.path.exists(os.path.join(unitdir, unitname)): continue
+        if os.path.isdir('/run/systemd/system'): # systemd is running
+            timed_call(['systemctl', 'disable', unitname])
+        else:
+            linkpath = os.path.join('/etc/systemd/system/', 
+                'multi-user.target.wants', unitname)
+            if os.path.lexists(linkpath): os.remove(linkpath)
+        os.remove(os.path.join(unitdir, unitname))
+    sys.stdout.write('INFO: ' + RPAC_SERVICE_NAME + ' service removed. \n')
+# end of service_remove()
+
+# Open hardware watchdog and pet it from a thread until the total deadline
+#  (see deadline_setup()). Past the deadline, the board is reset.
+def watchdog_start():
+    import fcntl, struct, threading, time
+    timed_call(['modprobe', 'bcm2708_wdog'], stderr=open('/dev/null', 'w'))
+    try:
+        wdt = open(RPAC_WATCHDOG['device'], 'wb', buffering=0)
+    except (IOError, OSError):
+        sys.stderr.write('WARN: Hardware watchdog not available, a ' + \
+            'wedged run will not be reset. \n')
+        return False
+    timeout = RPAC_WATCHDOG['timeout']
+    try:
+        # WDIOC_SETTIMEOUT, driver may round it or keep its own maximum
+        timeout = struct.unpack('i', fcntl.ioctl(wdt, 0xc0045706,
+            struct.pack('i', timeout)))[0]
+    except (IOError, OSError):
+        pass
+    stop = threading.Event()
+    def pet():
+        while not stop.wait(max(1, timeout // 3)):
+            end = RPAC_DEADLINES['runend']
+            if end and time.time() > end:
+                sys.stderr.write('ERROR: Total deadline exceeded, board ' + \
+                    'will be reset by watchdog. \n')
+                return
+            wdt.write(b'\0')
+    thread = threading.Thread(target=pet)
+    thread.daemon = True
+    thread.start()
+    RPAC_WATCHDOG.update({'file': wdt, 'stop': stop, 'thread': thread})
+    sys.stdout.write('INFO: Hardware watchdog armed (' + str(timeout) + \
+        ' seconds). \n')
+    return True
+# end of watchdog_start()
+
+# Stop petting and disarm hardware watchdog (magic close).
+def watchdog_stop():
+    if not RPAC_WATCHDOG['file']: return
+    RPAC_WATCHDOG['stop'].set()
+    RPAC_WATCHDOG['thread'].join()
+    try:
+        RPAC_WATCHDOG['file'].write(b'V')
+        RPAC_WATCHDOG['file'].close()
+    except (IOError, OSError):
+        sys.stderr.write('WARN: Unable to disarm hardware watchdog. \n')
+    RPAC_WATCHDOG['file'] = None
+# end of watchdog_stop()
+
+# Load record of an interrupted run (e.g. reset by watchdog), if made for
+#  the same config: {'fingerprint': ..., 'done': [sections completed],
+#  'reboot': reboot needed by them, 'attempts': runs so far}.
+def resume_load(configfile):
+    import json
+    fingerprint = bake_fingerprint([(section, sorted(configfile.items(
+        section, raw=True))) for section in configfile.sections()])
+    try:
+        record = json.load(open(RPAC_RESUMEFILE, 'r'))
+    except (IOError, OSError, ValueError):
+        record = {}
+    if record.get('fingerprint') != fingerprint:
+        record = {'fingerprint': fingerprint, 'done': [], 'reboot': False,
+            'attempts': 0}
+    return record
+# end of resume_load()
+
+def resume_save(record):
+    import json, os
+    try:
+        if not os.path.isdir(RPAC_STATEDIR):
+            os.makedirs(RPAC_STATEDIR)
+        open(RPAC_RESUMEFILE + '.tmp', 'w').write(json.dumps(record))
+        os.rename(RPAC_RESUMEFILE + '.tmp', RPAC_RESUMEFILE)
+        # On disk before the watchdog may reset the board
+        fd = os.open(RPAC_STATEDIR, os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+    except (IOError, OSError):
+        sys.stderr.write('WARN: Unable to write ' + RPAC_RESUMEFILE + '. \n')
+# end of resume_save()
+
+def resume_clear():
+    import os
+    try:
+        os.remove(RPAC_RESUMEFILE)
+    except OSError:
+        pass
+# end of resume_clear()
+
+# Output stream wrapper which keeps RPAC_PROGRESS up to date: every line
+#  written to stdout becomes the current step, every "FAILED:"/"ERROR:" line
+#  written to stderr is recorded as a failure.
+class ProgressStream:
+    def __init__(self, stream, iserr):
+        self.stream = stream
+        self.iserr = iserr
+
+    def write(self, text):
+        ret = self.stream.write(text)
+        progress_note(text, self.iserr)
+        return ret
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+# end of class ProgressStream
 
-# Uninstall vnc server autorun script. 
-def remote_vnc_autorun_uninst():
-    search_path = '/etc/init.d/'
-    # Find all scripts including 'vncserver' and delete them
-    import os
-    filelist = os.listdir(search_path)
-    for filename in filelist:
-        full_path = os.path.join(search_path, filename)
-        if not os.path.isfile(full_path):
-            continue;
-        filecontent = open(full_path, 'r').read()
-        if 'vncserver' in filecontent:
-            os.remove(full_path)
-# end of remote_vnc_autorun_uninst()
+# Record a chunk of text written to stdout/stderr into RPAC_PROGRESS.
+def progress_note(text, iserr):
+    import time
+    changed = False
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        if iserr:
+            if line.startswith('FAILED:') or line.startswith('ERROR:'):
+                RPAC_PROGRESS['failures'].append({'section':
+                    RPAC_PROGRESS['section'], 'message': line})
+                changed = True
+        elif not line.startswith('*'): # skip splash screen
+            if line.startswith('INFO: '):
+                line = line[len('INFO: '):]
+            RPAC_PROGRESS['step'] = line
+            RPAC_PROGRESS['stepstarted'] = time.time()
+            changed = True
+    if changed:
+        progress_publish(throttle=True)
+# end of progress_note()
 
-def restore_inittab():
-    inittab_text = open('/etc/inittab', 'r').read()
-    
-    import re
-    patt = '^(\\s*#)(?P<cmd>.*)(#\\s*RPICFG_TO_ENABLE).*$'
-    repl = '\g<cmd>'
-    inittab_text = re.sub(patt, repl, inittab_text, flags=re.M)
-    
-    patt = '\\n(.*)(#\\s*RPICFG_TO_DISABLE).*'
-    repl = ''
-    inittab_text = re.sub(patt, repl, inittab_text)
-    
-    open('/etc/inittab', 'w').write(inittab_text)
-# end of restore_inittab()
+# Start the progress exporter, as configured in [Progress] section:
+#  HTTPPort: port of the HTTP/JSON endpoint (0 to disable)
+#  HTTPAddress: address to listen on (127.0.0.1 for default)
+#  Textfile: node_exporter textfile collector output (empty to disable)
+# Parameters:
+#  configfile: loaded autoconfig.ini
+#  sections: names of sections going to be configured in this run
+def progress_start(configfile, sections):
+    import time
+    RPAC_PROGRESS['started'] = time.time()
+    RPAC_PROGRESS['pending'] = list(sections)
+
+    SECNAME = 'Progress'
+    if not configfile.has_section(SECNAME): return
+
+    RPAC_PROGRESS['textfile'] = configfile.get(SECNAME, 'Textfile',
+        fallback='').strip() or None
+
+    port = configfile.get(SECNAME, 'HTTPPort', fallback='0').strip()
+    address = configfile.get(SECNAME, 'HTTPAddress',
+        fallback='').strip() or '127.0.0.1'
+    if port.isdigit() and int(port) > 0:
+        import http.server, threading
+        try:
+            server = http.server.HTTPServer((address, int(port)),
+                ProgressHandler)
+        except (OSError, IOError) as err:
+            sys.stderr.write('WARN: Unable to start progress HTTP server ' + \
+                'on port ' + port + ' (' + str(err) + '). \n')
+        else:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            RPAC_PROGRESS['server'] = server
+    elif port != '0':
+        sys.stderr.write('WARN: Invalid [Progress].HTTPPort value. \n')
+
+    # Wrap stdout and stderr to follow current step and failures
+    sys.stdout = ProgressStream(sys.stdout, False)
+    sys.stderr = ProgressStream(sys.stderr, True)
+    progress_publish()
+# end of progress_start()
+
+# Mark the beginning of a section.
+def progress_section(secname):
+    import time
+    if RPAC_PROGRESS['section']:
+        RPAC_PROGRESS['done'].append(RPAC_PROGRESS['section'])
+    if secname in RPAC_PROGRESS['pending']:
+        RPAC_PROGRESS['pending'].remove(secname)
+    RPAC_PROGRESS['section'] = secname
+    RPAC_PROGRESS['sectionstarted'] = time.time()
+    progress_publish()
+# end of progress_section()
+
+# Record time spent waiting for a stage (like entropy), in seconds.
+def progress_wait(stage, seconds):
+    RPAC_PROGRESS['waits'][stage] = round(seconds, 2)
+    progress_publish()
+# end of progress_wait()
+
+# Mark the end of the whole run. The HTTP endpoint is kept until the
+#  program exits, so the final state can still be polled.
+def progress_finish():
+    if RPAC_PROGRESS['section']:
+        RPAC_PROGRESS['done'].append(RPAC_PROGRESS['section'])
+    RPAC_PROGRESS['section'] = ''
+    RPAC_PROGRESS['finished'] = True
+    progress_publish()
+# end of progress_finish()
+
+# Snapshot of RPAC_PROGRESS as a JSON-serializable dictionary.
+# Remaining time is estimated from RPAC_SECTION_ESTIMATES.
+def progress_status():
+    import time
+    now = time.time()
+    remaining = 0
+    if RPAC_PROGRESS['section']:
+        remaining += max(0, RPAC_SECTION_ESTIMATES.get(
+            RPAC_PROGRESS['section'], 0) - \
+            (now - RPAC_PROGRESS['sectionstarted']))
+    for secname in RPAC_PROGRESS['pending']:
+        remaining += RPAC_SECTION_ESTIMATES.get(secname, 0)
+    return {
+        'section': RPAC_PROGRESS['section'],
+        'step': RPAC_PROGRESS['step'],
+        'step_seconds': round(now - RPAC_PROGRESS['stepstarted'], 1) \
+            if RPAC_PROGRESS['stepstarted'] else 0.0,
+        'elapsed_seconds': round(now - RPAC_PROGRESS['started'], 1),
+        'remaining_seconds': round(remaining, 1),
+        'sections_done': list(RPAC_PROGRESS['done']),
+        'sections_pending': list(RPAC_PROGRESS['pending']),
+        'failures': list(RPAC_PROGRESS['failures']),
+        'waits': dict(RPAC_PROGRESS['waits']),
+        'finished': RPAC_PROGRESS['finished'],
+    }
+# end of progress_status()
+
+# Progress in Prometheus text exposition format.
+def progress_metrics():
+    import time
+    status = progress_status()
+    def esc(s):
+        return s.replace('\\', '\\\\').replace('"', '\\"')
+    return ''.join([
+        '# HELP raspi_autoconfig_running 1 while provisioning is running.\n',
+        '# TYPE raspi_autoconfig_running gauge\n',
+        'raspi_autoconfig_running ' + \
+            ('0' if status['finished'] else '1') + '\n',
+        '# HELP raspi_autoconfig_step_info Current section and step.\n',
+        '# TYPE raspi_autoconfig_step_info gauge\n',
+        'raspi_autoconfig_step_info{section="' + esc(status['section']) + \
+            '",step="' + esc(status['step']) + '"} 1\n',
+        '# TYPE raspi_autoconfig_step_seconds gauge\n',
+        'raspi_autoconfig_step_seconds ' + str(status['step_seconds']) + '\n',
+        '# TYPE raspi_autoconfig_elapsed_seconds gauge\n',
+        'raspi_autoconfig_elapsed_seconds ' + \
+            str(status['elapsed_seconds']) + '\n',
+        '# TYPE raspi_autoconfig_remaining_seconds gauge\n',
+        'raspi_autoconfig_remaining_seconds ' + \
+            str(status['remaining_seconds']) + '\n',
+        '# TYPE raspi_autoconfig_sections_done gauge\n',
+        'raspi_autoconfig_sections_done ' + \
+            str(len(status['sections_done'])) + '\n',
+        '# TYPE raspi_autoconfig_sections_pending gauge\n',
+        'raspi_autoconfig_sections_pending ' + \
+            str(len(status['sections_pending'])) + '\n',
+        '# TYPE raspi_autoconfig_failures gauge\n',
+        'raspi_autoconfig_failures ' + str(len(status['failures'])) + '\n',
+        '# HELP raspi_autoconfig_wait_seconds Time spent waiting for ' + \
+            'a stage.\n',
+        '# TYPE raspi_autoconfig_wait_seconds gauge\n',
+        ''.join(['raspi_autoconfig_wait_seconds{stage="' + esc(stage) + \
+            '"} ' + str(seconds) + '\n' for (stage, seconds) in \
+            sorted(status['waits'].items())]),
+        '# TYPE raspi_autoconfig_last_update_seconds gauge\n',
+        'raspi_autoconfig_last_update_seconds ' + \
+            str(int(RPAC_PROGRESS['updated'] or time.time())) + '\n',
+    ])
+# end of progress_metrics()
+
+# Write node_exporter textfile (atomically, via rename).
+# Parameters:
+#  throttle: skip writing if last write is less than
+#            RPAC_PROGRESS_INTERVAL seconds ago
+def progress_publish(throttle=False):
+    import time, os
+    RPAC_PROGRESS['updated'] = time.time()
+    textfile = RPAC_PROGRESS['textfile']
+    if not textfile: return
+    if throttle and RPAC_PROGRESS['updated'] - RPAC_PROGRESS['written'] < \
+        RPAC_PROGRESS_INTERVAL:
+        return
+    RPAC_PROGRESS['written'] = RPAC_PROGRESS['updated']
+    try:
+        open(textfile + '.tmp', 'w').write(progress_metrics())
+        os.rename(textfile + '.tmp', textfile)
+    except (OSError, IOError):
+        pass # Progress reporting never breaks provisioning
+# end of progress_publish()
+
+# HTTP request handler of progress endpoint:
+#  GET /         progress as JSON
+#  GET /metrics  progress in Prometheus text format
+class ProgressHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        import json
+        if self.path.split('?')[0] == '/metrics':
+            body = progress_metrics()
+            ctype = 'text/plain; version=0.0.4'
+        elif self.path.split('?')[0] in ('/', '/progress'):
+            body = json.dumps(progress_status())
+            ctype = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep tty1 clean
+# end of class ProgressHandler
 
 ############################################################
 ############# C O N F I G   F U N C T I O N S  #############
@@ -472,18 +2989,24 @@ def setup_system(configfile):
             # Get start sector of /dev/mmcblk0p2
             sys.stdout.write('Expand root filesystem to fill the SD card' + \
                 '... \n')
-            ptable = subprocess.check_output(['fdisk', '-l', '/dev/mmcblk0'], 
-                universal_newlines=True)
-            precord = (ptable.split('\n')[-2]).split()
-            pstartsector = precord[1]
+            fdisk_proc = timed_popen(['fdisk', '-l', '/dev/mmcblk0'], 
+                stdout=subprocess.PIPE)
+            ptable = timed_communicate(fdisk_proc)[0].decode('ascii',
+                'replace')
+            precord = (ptable.split('\n')[-2]).split() if ptable else []
+            pstartsector = precord[1] if len(precord) > 1 else ''
             # Launch fdisk
-            fdisk_stdin = bytes('p\nd\n2\nn\np\n2\n' + pstartsector + \
-                '\n\np\nw\n', 'ascii')
-            fdisk_proc = subprocess.Popen(['fdisk', '/dev/mmcblk0'], 
-                stdin=subprocess.PIPE)
-            fdisk_proc.communicate(fdisk_stdin)
-            # set up an init.d script
-            SCRIPTCONTENT = '''\
+            if pstartsector:
+                fdisk_stdin = bytes('p\nd\n2\nn\np\n2\n' + \
+                    pstartsector + '\n\np\nw\n', 'ascii')
+                fdisk_proc = timed_popen(['fdisk', '/dev/mmcblk0'], 
+                    stdin=subprocess.PIPE)
+                timed_communicate(fdisk_proc, fdisk_stdin)
+            if not pstartsector or fdisk_proc.returncode < 0:
+                sys.stderr.write('FAILED: Root filesystem not expanded. \n')
+            else:
+                # set up an init.d script
+                SCRIPTCONTENT = '''\
 #!/bin/sh
 ### BEGIN INIT INFO
 # Provides: resize2fs_once
@@ -511,12 +3034,9 @@ exit 3
 ;;
 esac
 '''
-            SCRIPTPATH = '/etc/init.d/resize2fs_once'
-            open(SCRIPTPATH, 'w').write(SCRIPTCONTENT)
-            subprocess.call(['chmod', '+x', '/etc/init.d/resize2fs_once'])
-            subprocess.call(['update-rc.d', 'resize2fs_once', 'defaults'])
-            # Reboot needed
-            reboot = True
+                initscript_install('resize2fs_once', SCRIPTCONTENT)
+                # Reboot needed
+                reboot = True
         elif Expandrootfs == '0':
             pass
         else:
@@ -527,11 +3047,12 @@ esac
     if configfile.has_option(SECNAME, 'BootBehavior'):
         BootBehavior = configfile.get(SECNAME, 'BootBehavior').strip().lower()
         import subprocess
+        artifact_service('lightdm')
         if BootBehavior == 'commandlinelogin':
-            subprocess.call(['update-rc.d', 'lightdm', 'disable', '2'])
+            timed_call(['update-rc.d', 'lightdm', 'disable', '2'])
             reboot = True
         elif BootBehavior == 'desktopauto':
-            subprocess.call(['update-rc.d', 'lightdm', 'enable', '2'])
+            timed_call(['update-rc.d', 'lightdm', 'enable', '2'])
             # Edit /etc/lightdm/lightdm.conf
             import re
             cnftxt = open('/etc/lightdm/lightdm.conf', 'r').read()
@@ -539,6 +3060,7 @@ esac
             repl = 'autologin-user=pi'
             [cnftxt, n] = re.subn(patt, repl, cnftxt, 1, flags=re.M)
             if n == 0: cnftxt += '\n' + repl
+            artifact_edit('/etc/lightdm/lightdm.conf')
             open('/etc/lightdm/lightdm.conf', 'w').write(cnftxt)
             reboot = True
         else:
@@ -650,12 +3172,359 @@ def setup_screen(configfile):
     # end of[Screen].Output
     
     # Write back config.txt
+    artifact_edit('/boot/config.txt')
     open('/boot/config.txt', 'w').write(cnftxt)
     
     sys.stdout.write('INFO: Screen config complete. \n')
     return reboot
 # end of setup_screen()
 
+def setup_performance(configfile):
+    SECNAME = 'Performance'
+    # Run only if proper section exists in autoconfig.ini
+    if not configfile.has_section(SECNAME): return False
+    sys.stdout.write('INFO: Configuring performance settings... \n')
+    
+    settings = performance_settings(configfile)
+    if not settings:
+        sys.stdout.write('INFO: Performance config complete. \n')
+        return False
+    
+    # Load config.txt
+    try:
+        cnftxt = open('/boot/config.txt', 'r').read()
+    except IOError:
+        cnftxt = ''
+    
+    # Check each setting against board limits, then edit config.txt
+    inv = inventory()
+    for name in sorted(settings):
+        value = performance_check(name, settings[name], inv)
+        if value is False:
+            sys.stderr.write('WARN: Invalid value for ' + name + '. \n')
+            sys.stderr.write('FAILED: ' + name + ' unchanged. \n')
+            continue
+        cnftxt = configtxt_set(cnftxt, name, value)
+    if settings.get('force_turbo') == 1 and settings.get('over_voltage'):
+        sys.stderr.write('WARN: force_turbo=1 with over_voltage sets the ' + \
+            'warranty bit of this board permanently! \n')
+    
+    # Write back config.txt
+    artifact_edit('/boot/config.txt')
+    try:
+        open('/boot/config.txt', 'w').write(cnftxt)
+    except IOError:
+        sys.stderr.write('FAILED: Unable to write /boot/config.txt! \n')
+        sys.stderr.write('FAILED: All performance settings unchanged. \n')
+        return False
+    
+    sys.stdout.write('INFO: Performance config complete. \n')
+    return True
+# end of setup_performance()
+
+def setup_memory(configfile):
+    SECNAME = 'Memory'
+    # Run only if proper section exists in autoconfig.ini
+    if not configfile.has_section(SECNAME): return False
+    sys.stdout.write('INFO: Configuring memory settings... \n')
+    
+    import re
+    devnull = open('/dev/null', 'w')
+    
+    # [Memory].Zram: compressed swap in RAM
+    if configfile.has_option(SECNAME, 'Zram'):
+        value = configfile.get(SECNAME, 'Zram').strip()
+        if value == '1':
+            size = zram_size(configfile.get(SECNAME, 'ZramSize', raw=True,
+                fallback='50%'))
+            if size is None:
+                sys.stderr.write('WARN: Invalid [Memory].ZramSize value, ' + \
+                    '50% is used instead. \n')
+                size = zram_size('50%')
+            algorithm = configfile.get(SECNAME, 'ZramAlgorithm',
+                fallback='').strip()
+            if not re.match('^[a-z0-9-]*$', algorithm):
+                sys.stderr.write('WARN: Invalid [Memory].ZramAlgorithm ' + \
+                    'value, kernel default is used instead. \n')
+                algorithm = ''
+            # Check algorithm against running kernel, if it tells
+            timed_call(['modprobe', 'zram'], stderr=devnull)
+            try:
+                available = open('/sys/block/zram0/comp_algorithm',
+                    'r').read().replace('[', '').replace(']', '').split()
+            except (IOError, OSError):
+                available = None
+            if algorithm and available is not None and \
+                algorithm not in available:
+                sys.stderr.write('WARN: zram compression ' + algorithm + \
+                    ' not supported by kernel (available: ' + \
+                    ', '.join(available) + '), kernel default is used ' + \
+                    'instead. \n')
+                algorithm = ''
+            # Install init script and start it now
+            initscript_remove('zram-swap') # stop, for new size/algorithm
+            if initscript_install('zram-swap', RPAC_ZRAM_SCRIPT % {
+                'size': size, 'algorithm': algorithm, 'priority': 100}):
+                timed_call(['/etc/init.d/zram-swap', 'start'])
+            if '/dev/zram0' in active_swaps():
+                sys.stdout.write('INFO: zram swap active (' + str(size) + \
+                    ' MB). \n')
+            else:
+                sys.stderr.write('FAILED: zram swap is not active. \n')
+        elif value == '0':
+            initscript_remove('zram-swap')
+        else:
+            sys.stderr.write('WARN: Only 1 or 0 for option [Memory].Zram ' + \
+                'please. \n')
+            sys.stderr.write('WARN: zram swap unchanged. \n')
+    
+    # [Memory].SwapFile: dphys-swapfile on SD card, 0 to disable
+    if configfile.has_option(SECNAME, 'SwapFile'):
+        value = configfile.get(SECNAME, 'SwapFile').strip()
+        if value == '0':
+            timed_call(['dphys-swapfile', 'swapoff'])
+            timed_call(['dphys-swapfile', 'uninstall'])
+            artifact_service('dphys-swapfile')
+            timed_call(['update-rc.d', 'dphys-swapfile', 'disable'])
+            if '/var/swap' in active_swaps():
+                sys.stderr.write('FAILED: dphys-swapfile still active. \n')
+            else:
+                sys.stdout.write('INFO: Swapfile on SD card disabled. \n')
+        elif value.isdigit():
+            try:
+                conf = open('/etc/dphys-swapfile', 'r').read()
+            except IOError:
+                conf = ''
+            patt = '^\\s*#?\\s*CONF_SWAPSIZE\\s*=.*$'
+            repl = 'CONF_SWAPSIZE=' + value
+            [conf, n] = re.subn(patt, repl, conf, 1, flags=re.M)
+            if n == 0: conf += '\n' + repl + '\n'
+            try:
+                artifact_edit('/etc/dphys-swapfile')
+                open('/etc/dphys-swapfile', 'w').write(conf)
+            except IOError:
+                sys.stderr.write('FAILED: Unable to write ' + \
+                    '/etc/dphys-swapfile! \n')
+            else:
+                artifact_service('dphys-swapfile')
+                timed_call(['update-rc.d', 'dphys-swapfile', 'enable'])
+                timed_call(['dphys-swapfile', 'swapoff'])
+                timed_call(['dphys-swapfile', 'setup'])
+                timed_call(['dphys-swapfile', 'swapon'])
+                if '/var/swap' in active_swaps():
+                    sys.stdout.write('INFO: Swapfile on SD card resized ' + \
+                        'to ' + value + ' MB. \n')
+                else:
+                    sys.stderr.write('FAILED: dphys-swapfile is not ' + \
+                        'active. \n')
+        else:
+            sys.stderr.write('WARN: Invalid [Memory].SwapFile value. \n')
+            sys.stderr.write('WARN: Swapfile unchanged. \n')
+    
+    # [Memory].Swappiness
+    if configfile.has_option(SECNAME, 'Swappiness'):
+        value = configfile.get(SECNAME, 'Swappiness').strip()
+        if value.isdigit() and int(value) <= 100:
+            sysctl_persist('90-raspi-autoconfig-memory.conf',
+                [('vm.swappiness', value)])
+            if not sysctl_set('vm.swappiness', value):
+                sys.stderr.write('FAILED: Unable to set vm.swappiness. \n')
+        else:
+            sys.stderr.write('WARN: Only 0~100 for option ' + \
+                '[Memory].Swappiness please. \n')
+            sys.stderr.write('WARN: Swappiness unchanged. \n')
+    
+    sys.stdout.write('INFO: Memory config complete. \n')
+    return False
+# end of setup_memory()
+
+def setup_tuning(configfile):
+    SECNAME = 'Tuning'
+    # Run only if proper section exists in autoconfig.ini
+    if not configfile.has_section(SECNAME): return False
+    sys.stdout.write('INFO: Configuring system tuning... \n')
+    
+    import os
+    CPUFREQDIR = '/sys/devices/system/cpu/cpu0/cpufreq/'
+    blockdev = configfile.get(SECNAME, 'BlockDevice',
+        fallback='mmcblk0').strip()
+    QUEUEDIR = os.path.join('/sys/block', blockdev, 'queue')
+    script = {'governor': '', 'blockdev': blockdev, 'scheduler': '',
+        'readahead': ''}
+    
+    # [Tuning].Governor, checked against available cpufreq governors
+    if configfile.has_option(SECNAME, 'Governor'):
+        value = configfile.get(SECNAME, 'Governor').strip().lower()
+        (governors, current) = sysfs_choices(os.path.join(CPUFREQDIR,
+            'scaling_available_governors'))
+        if value in governors:
+            script['governor'] = value
+        else:
+            sys.stderr.write('WARN: CPU governor ' + value + ' not ' + \
+                'supported by kernel (available: ' + ', '.join(governors) + \
+                '). \n')
+            sys.stderr.write('FAILED: CPU governor unchanged. \n')
+    
+    # [Tuning].IOScheduler, checked against available I/O schedulers
+    if configfile.has_option(SECNAME, 'IOScheduler'):
+        value = configfile.get(SECNAME, 'IOScheduler').strip().lower()
+        (schedulers, current) = sysfs_choices(os.path.join(QUEUEDIR,
+            'scheduler'))
+        if value in schedulers:
+            script['scheduler'] = value
+        else:
+            sys.stderr.write('WARN: I/O scheduler ' + value + ' not ' + \
+                'available for ' + blockdev + ' (available: ' + \
+                ', '.join(schedulers) + '). \n')
+            sys.stderr.write('FAILED: I/O scheduler unchanged. \n')
+    
+    # [Tuning].ReadAhead, in kB
+    if configfile.has_option(SECNAME, 'ReadAhead'):
+        value = configfile.get(SECNAME, 'ReadAhead').strip()
+        if not value.isdigit() or int(value) > 16384:
+            sys.stderr.write('WARN: Only 0~16384 (kB) for option ' + \
+                '[Tuning].ReadAhead please. \n')
+            sys.stderr.write('FAILED: Read-ahead unchanged. \n')
+        elif not os.path.exists(os.path.join(QUEUEDIR, 'read_ahead_kb')):
+            sys.stderr.write('WARN: Block device ' + blockdev + \
+                ' not found. \n')
+            sys.stderr.write('FAILED: Read-ahead unchanged. \n')
+        else:
+            script['readahead'] = value
+    
+    # Install init script for next boots, and apply at once
+    if script['governor'] or script['scheduler'] or script['readahead']:
+        if initscript_install('raspi-tuning', RPAC_TUNING_SCRIPT % script):
+            timed_call(['/etc/init.d/raspi-tuning', 'start'])
+        # Check result
+        if script['governor'] and open(os.path.join(CPUFREQDIR,
+            'scaling_governor'), 'r').read().strip() != script['governor']:
+            sys.stderr.write('FAILED: CPU governor is not applied. \n')
+        if script['scheduler'] and sysfs_choices(os.path.join(QUEUEDIR,
+            'scheduler'))[1] != script['scheduler']:
+            sys.stderr.write('FAILED: I/O scheduler is not applied. \n')
+    
+    # [Tuning].SysctlProfile and [Tuning].Sysctl
+    if configfile.has_option(SECNAME, 'SysctlProfile') or \
+        configfile.has_option(SECNAME, 'Sysctl'):
+        # Only parameters existing in running kernel are kept
+        applied = []
+        for (name, value) in sysctl_settings(configfile):
+            if sysctl_set(name, value):
+                applied.append((name, value))
+            else:
+                sys.stderr.write('WARN: Kernel parameter ' + name + \
+                    ' not supported, skipped. \n')
+        sysctl_persist('91-raspi-autoconfig-tuning.conf', applied)
+    
+    sys.stdout.write('INFO: System tuning complete. \n')
+    return False
+# end of setup_tuning()
+
+def setup_storage(configfile):
+    SECNAME = 'Storage'
+    # Run only if proper section exists in autoconfig.ini
+    if not configfile.has_section(SECNAME): return False
+    sys.stdout.write('INFO: Configuring storage settings... \n')
+    
+    import os, re
+    
+    # Load and parse /etc/fstab
+    try:
+        fstabtext = open('/etc/fstab', 'r').read()
+    except IOError:
+        sys.stderr.write('FAILED: Unable to read /etc/fstab! \n')
+        sys.stderr.write('FAILED: All storage settings unchanged. \n')
+        return False
+    fstab = fstab_parse(fstabtext)
+    rootentry = fstab_find(fstab, '/')
+    
+    # [Storage].NoAtime, [Storage].Commit: root filesystem mount options
+    remount = []
+    if configfile.has_option(SECNAME, 'NoAtime'):
+        value = configfile.get(SECNAME, 'NoAtime').strip()
+        if value == '1' and rootentry:
+            fstab_set_option(rootentry, 'noatime', ('atime', 'relatime',
+                'strictatime', 'nodiratime'))
+            remount.append('noatime')
+        elif value == '1':
+            sys.stderr.write('WARN: No root filesystem in /etc/fstab. \n')
+            sys.stderr.write('FAILED: noatime not set. \n')
+        elif value != '0':
+            sys.stderr.write('WARN: Only 1 or 0 for option ' + \
+                '[Storage].NoAtime please. \n')
+    if configfile.has_option(SECNAME, 'Commit'):
+        value = configfile.get(SECNAME, 'Commit').strip()
+        if not value.isdigit() or not 1 <= int(value) <= 600:
+            sys.stderr.write('WARN: Only 1~600 (seconds) for option ' + \
+                '[Storage].Commit please. \n')
+            sys.stderr.write('FAILED: Commit interval unchanged. \n')
+        elif not rootentry or rootentry['fields'][2] not in ('ext3', 'ext4'):
+            sys.stderr.write('WARN: Root filesystem is not ext3/ext4. \n')
+            sys.stderr.write('FAILED: Commit interval unchanged. \n')
+        else:
+            fstab_set_option(rootentry, 'commit=' + value)
+            remount.append('commit=' + value)
+    
+    # [Storage].TmpfsTmp, [Storage].TmpfsVarLog: size cap like 64M or 10%,
+    # 0 to remove the tmpfs mount
+    for (option, mountpoint, mode) in [('TmpfsTmp', '/tmp', '1777'),
+        ('TmpfsVarLog', '/var/log', '0755')]:
+        if not configfile.has_option(SECNAME, option): continue
+        value = configfile.get(SECNAME, option, raw=True).strip()
+        if value == '0':
+            fstab_set_tmpfs(fstab, mountpoint, None, mode)
+        elif re.match('^\\d+[kKmMgG%]?$', value):
+            fstab_set_tmpfs(fstab, mountpoint, value, mode)
+        else:
+            sys.stderr.write('WARN: Invalid [Storage].' + option + \
+                ' value. \n')
+            sys.stderr.write('FAILED: ' + mountpoint + ' unchanged. \n')
+    
+    # Check new fstab, then replace /etc/fstab
+    newfstab = fstab_format(fstab)
+    reboot = False
+    if newfstab != fstabtext:
+        problems = fstab_check(fstab)
+        for problem in problems:
+            sys.stderr.write('ERROR: New /etc/fstab ' + problem + '! \n')
+        if problems:
+            sys.stderr.write('FAILED: All storage settings unchanged. \n')
+            return False
+        CHECKPATH = '/etc/fstab.raspi-autoconfig'
+        open(CHECKPATH, 'w').write(newfstab)
+        # Dry-run mount check as well, if mount has --fstab option
+        #  (util-linux 2.23 or later, wheezy has 2.20)
+        import subprocess
+        devnull = open('/dev/null', 'w')
+        checkret = 0
+        try:
+            helptext = timed_communicate(timed_popen(['mount', '--help'],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT))[0]
+        except OSError:
+            helptext = b''
+        if b'--fstab' in helptext:
+            checkret = timed_call(['mount', '--fake', '--no-mtab',
+                '--all', '--fstab', CHECKPATH], stdout=devnull,
+                stderr=devnull)
+        if checkret != 0:
+            os.remove(CHECKPATH)
+            sys.stderr.write('ERROR: New /etc/fstab failed dry-run mount ' + \
+                'check! \n')
+            sys.stderr.write('FAILED: All storage settings unchanged. \n')
+            return False
+        artifact_edit('/etc/fstab')
+        os.rename(CHECKPATH, '/etc/fstab')
+        reboot = True # tmpfs mounts take effect on next boot
+        # Root filesystem options take effect at once
+        if remount:
+            timed_call(['mount', '-o', 'remount,' + ','.join(remount),
+                '/'])
+    
+    sys.stdout.write('INFO: Storage config complete. \n')
+    return reboot
+# end of setup_storage()
+
 def setup_wired(configfile):
     SECNAME = 'Wired'
     # Run only if proper section exists in autoconfig.ini
@@ -672,17 +3541,9 @@ def setup_wired(configfile):
     # Regex lib needed for editing text file
     import re
     
-    # Show all wired ethernet network cards (eth*)
-    # Fetch `ip link show` command stdout
-    import subprocess
-    ipoutput = subprocess.check_output(['ip', 'link', 'show'],
-        universal_newlines=True)
-    # Find device name (eth*) and mac address from output
-    import re
-    patt = '^\d+:\s(?P<dev>eth\d+).*\n' + \
-        '\s*link/ether\s+(?P<hwaddr>(?:[0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2})'
-    eths = re.findall(patt, ipoutput, flags=re.M) 
+    # All wired ethernet network cards
     # eg: [('eth0', 'b8:27:eb:00:00:00'), ('eth1', 'aa:bb:cc:dd:ee:ff')]
+    eths = inventory_wired()
     
     # Count NIC, get device name and MAC address. 
     if len(eths) == 1: 
@@ -717,11 +3578,12 @@ def setup_wired(configfile):
             sys.stderr.write('FAILED: DHCP for ' + ethdev + ' unchanged. \n')
     
     # Write back changes to /etc/network/interfaces
+    artifact_edit('/etc/network/interfaces')
     open('/etc/network/interfaces', 'w').write('\n'.join(interf)) 
     
     # Down and up (reset) ethernet device
-    subprocess.call(['ifdown', ethdev])
-    subprocess.call(['ifup', ethdev])
+    timed_call(['ifdown', ethdev])
+    timed_call(['ifup', ethdev])
     
     sys.stdout.write('INFO: Wired network config complete. \n')
     return False
@@ -733,37 +3595,30 @@ def setup_wireless(configfile):
     if not configfile.has_section(SECNAME): return False
     sys.stdout.write('INFO: Configuring wireless network... \n')
     
-    # Requires [Wireless].SSID option. 
-    if configfile.has_option(SECNAME, 'SSID'):
-        ssid = configfile.get(SECNAME, 'SSID');
-    else:
+    # Requires at least one [Wireless].SSID option. 
+    networks = wireless_networks(configfile)
+    if not networks:
         sys.stderr.write('WARN: SSID option required for configuring ' + \
             'wireless network! \n')
         sys.stderr.write('FAILED: All wireless network settings unchanged. \n')
         return False
     
-    # Show all wireless ethernet network cards (eth*)
-    # Fetch `iwconfig` command stdout
-    import subprocess
-    ipoutput = subprocess.check_output(['iwconfig'], universal_newlines=True, \
-        stderr=open('/dev/null', 'w'))
-    # Find device name (wlan*) from output
-    import re
-    patt = '^(?P<dev>\\w+)\\s+IEEE\s*802\\.11'
-    eths = re.findall(patt, ipoutput, flags=re.M) # eg: ['wlan0', 'wlan1']
+    # All wireless network cards
+    # eg: [('wlan0', '00:11:22:33:44:55')]
+    eths = inventory_wireless()
     
     # Count NIC, get device name. 
     if len(eths) == 1: 
         # One NIC, use it directly.
-        ethdev = eths[0]
+        (ethdev, ethmac) = eths[0]
     elif len(eths) > 1:
         # Multi NIC, wlan0 preferred
         sys.stderr.write('WARN: ' + str(len(eths)) + \
             ' Wi-Fi devices found. \n')
-        if 'wlan0' in eths:
-            ethdev = 'wlan0'
-        else:
-            ethdev = eths[0]
+        (ethdev, ethmac) = eths[0]
+        for eth in eths:
+            if eth[0] == 'wlan0':
+                (ethdev, ethmac) = eth
         sys.stderr.write('INFO: Configuring ' + ethdev + \
             ' (' + ethmac + '). \n')
     else:
@@ -772,81 +3627,114 @@ def setup_wireless(configfile):
         sys.stderr.write('FAILED: All wireless network settings unchanged. \n')
         return False
     
-    # Scan networks
-    subprocess.call(['iwlist', ethdev, 'scan'], stdout=open('/dev/null', 'w'))
-    aplist = subprocess.check_output(['wpa_cli', '-i'+ethdev, 
-        'scan_results'], universal_newlines=True).split('\n')
-    #  strip leading head line and trailing newline
-    aplist.remove(aplist[0])
-    if '' in aplist: aplist.remove('')
-    #  explode each line by tab char
-    #  (Note: column title: bssid, frequency, signal level, flags, ssid)
-    aplist = [ap.split('\t') for ap in aplist]
-    #  find record with specific ssid
-    apinfo = list(filter(lambda ap: len(ap)==5 and ap[4]==ssid, aplist))
-    if not apinfo: # AP Not found in current area
-        sys.stderr.write('ERROR: Access point \"' + ssid + '\" not found! \n')
-        sys.stderr.write('FAILED: All wireless network settings unchanged. \n')
-        return False
-    #  analyze encryption method
-    if 'wpa' in apinfo[0][3].lower(): # WPA/WPA2 Encryption
-        encryptmethod = 'wpa'
-    elif 'wep' in apinfo[0][3].lower(): # WEP Encryption
-        encryptmethod = 'wep'
-    else:
-        encryptmethod = 'none'
+    # Early-boot service starts before wpa_supplicant (started by ifup of
+    # networking init)
+    if RPAC_MODE == 'service':
+        wpa_supplicant_wait(ethdev)
     
-    # Configure wireless network with wpa_cli
-    cliOK = {};
-    #  config data check: must exists [Wireless].Paraphrase for any encryption
-    if not encryptmethod == 'none':
-        if not configfile.has_option(SECNAME, 'Passphrase'):
-            sys.stderr.write('ERROR: No passphrase provided for ' + \
-                ' WPA/WPA2 encrypted access point \"' + ssid + '\"! \n')
-            sys.stderr.write('FAILED: All wireless network settings unchanged. \n')
-            return False
+    import subprocess
+    try:
+        wireless_configure(configfile, ethdev, networks)
+    except subprocess.CalledProcessError as err:
+        sys.stderr.write('ERROR: wpa_cli ' + ' '.join(err.cmd[2:3]) + \
+            ' failed (exit code ' + str(err.returncode) + '), ' + \
+            'wpa_supplicant not running on ' + ethdev + '? \n')
+        sys.stderr.write('FAILED: Wireless network settings not saved. \n')
+    except OSError as err: # wpa_cli not installed
+        sys.stderr.write('ERROR: Unable to run wpa_cli (' + str(err) + \
+            ')! \n')
+        sys.stderr.write('FAILED: Wireless network settings not saved. \n')
+    return False
+# end of setup_wireless()
+
+# Scan, rank and register configured networks on Wi-Fi device ethdev, with
+#  wpa_cli. Raises CalledProcessError if a wpa_cli command fails.
+def wireless_configure(configfile, ethdev, networks):
+    SECNAME = 'Wireless'
+    # Scan networks, rank configured networks by priority and signal
+    candidates = wireless_rank(networks, wireless_scan(ethdev))
+    for network in candidates:
+        if not network['bssid']: # AP Not found in current area
+            sys.stderr.write('WARN: Access point \"' + network['ssid'] + \
+                '\" not found, registered for later use. \n')
         else:
-            passphrase = configfile.get(SECNAME, 'Passphrase');
-    #  create network in wpa_cli
-    netid = subprocess.check_output(['wpa_cli', '-i'+ethdev, 'add_network'], 
-        universal_newlines=True)
-    #  set ssid
-    cliOK['ssid'] = subprocess.check_output(['wpa_cli', '-i'+ethdev, 
-        'set_network', netid, 'ssid', '\"' + ssid + '\"'], 
-        universal_newlines=True)
-    # cliOK['scan_ssid'] = subprocess.check_output(['wpa_cli', '-i'+ethdev, 
-        # 'set_network', netid, 'scan_ssid', '1'], universal_newlines=True)
-    #  set wpa/wpa2/wep encryption
-    if 'wpa' in apinfo[0][3].lower(): # WPA/WPA2 Encryption
-        # only wpa-psk supported in current version
-        cliOK['key_mgmt'] = subprocess.check_output(['wpa_cli', '-i'+ethdev, 
-            'set_network', netid, 'key_mgmt', 'WPA-PSK'], 
-             universal_newlines=True)
-        cliOK['psk'] = subprocess.check_output(['wpa_cli', '-i'+ethdev, 
-            'set_network', netid, 'psk', '"' + passphrase + '"'], 
-             universal_newlines=True)
-    elif 'wep' in apinfo[0][3].lower(): # WEP Encryption
-        cliOK['key_mgmt'] = subprocess.check_output(['wpa_cli', '-i'+ethdev, 
-            'set_network', netid, 'key_mgmt', 'NONE'], 
-             universal_newlines=True)
-        for i in range(4):
-            cliOK['wep_key'+str(i)] = subprocess.check_output(['wpa_cli', 
-                '-i'+ethdev, 'set_network', netid, 'wep_key'+str(i), 
-                '' + passphrase + ''], universal_newlines=True)
-    else: # Open, no encryption
-        pass
+            sys.stdout.write('Found \"' + network['ssid'] + '\" (' + \
+                network['bssid'] + ', ' + str(network['frequency']) + \
+                ' MHz, ' + str(network['signal']) + ' dBm). \n')
     
-    # Enable network (connect to it automatically)
-    cliOK['enable_network'] = subprocess.check_output(['wpa_cli', '-i'+ethdev, 
-        'enable_network', netid], universal_newlines=True)
+    # Configure each network with wpa_cli, in ranking order. Priority of
+    # wpa_supplicant is the configured one, not the ranking: networks of
+    # the same priority are chosen by live signal level when roaming.
+    # Networks of the same SSID from an earlier run are replaced.
+    bgscan = configfile.get(SECNAME, 'BGScan', fallback='').strip()
+    known = wireless_known(ethdev)
+    configured = 0
+    for network in candidates:
+        ssid = network['ssid']
+        passphrase = network['passphrase']
+        #  analyze encryption method
+        if 'wpa' in network['flags'].lower(): # WPA/WPA2 Encryption
+            encryptmethod = 'wpa'
+        elif 'wep' in network['flags'].lower(): # WEP Encryption
+            encryptmethod = 'wep'
+        elif not network['bssid'] and passphrase: # Not scanned, assume WPA
+            encryptmethod = 'wpa'
+        else:
+            encryptmethod = 'none'
+        #  config data check: must exists passphrase for any encryption
+        if not encryptmethod == 'none' and not passphrase:
+            sys.stderr.write('ERROR: No passphrase provided for ' + \
+                ' encrypted access point \"' + ssid + '\"! \n')
+            sys.stderr.write('FAILED: \"' + ssid + '\" not configured. \n')
+            continue
+        #  derive WPA key, so the passphrase is never stored and
+        #  wpa_supplicant does not run PBKDF2 again on association
+        if encryptmethod == 'wpa':
+            psk = wpa_psk(ssid, passphrase)
+            if not psk:
+                sys.stderr.write('ERROR: WPA passphrase of \"' + ssid + \
+                    '\" must be 8~63 characters or 64 hex digits! \n')
+                sys.stderr.write('FAILED: \"' + ssid + '\" not ' + \
+                    'configured. \n')
+                continue
+        #  remove old network of same SSID, create network in wpa_cli
+        for oldid in known.pop(ssid, []):
+            wpa_cli(ethdev, 'remove_network', oldid)
+        netid = wpa_cli(ethdev, 'add_network')
+        #  set ssid and priority
+        wpa_cli(ethdev, 'set_network', netid, 'ssid', '\"' + ssid + '\"')
+        wpa_cli(ethdev, 'set_network', netid, 'priority',
+            str(network['priority']))
+        if bgscan:
+            wpa_cli(ethdev, 'set_network', netid, 'bgscan',
+                '\"' + bgscan + '\"')
+        #  set wpa/wpa2/wep encryption
+        if encryptmethod == 'wpa':
+            # only wpa-psk supported in current version
+            wpa_cli(ethdev, 'set_network', netid, 'key_mgmt', 'WPA-PSK')
+            wpa_cli(ethdev, 'set_network', netid, 'psk', psk)
+        elif encryptmethod == 'wep':
+            wpa_cli(ethdev, 'set_network', netid, 'key_mgmt', 'NONE')
+            for i in range(4):
+                wpa_cli(ethdev, 'set_network', netid, 'wep_key' + str(i),
+                    passphrase)
+        else: # Open, no encryption
+            wpa_cli(ethdev, 'set_network', netid, 'key_mgmt', 'NONE')
+        # Enable network (connect to it automatically)
+        wpa_cli(ethdev, 'enable_network', netid)
+        configured += 1
+    if not configured:
+        sys.stderr.write('FAILED: All wireless network settings unchanged. \n')
+        return
     
     # Save config for next boot up - don't forget this!
-    subprocess.call(['wpa_cli', '-i'+ethdev, 'save_config'], 
-        stdout=open('/dev/null', 'w'))
+    artifact_edit('/etc/wpa_supplicant/wpa_supplicant.conf')
+    wpa_cli(ethdev, 'save_config')
+    # Pick the best network now
+    wpa_cli(ethdev, 'reassociate')
     
     sys.stdout.write('INFO: Wireless network config complete. \n')
-    return False
-# end of setup_wireless()
+# end of wireless_configure()
 
 def setup_localization(configfile):
     SECNAME = 'Localization'
@@ -869,18 +3757,26 @@ def setup_localization(configfile):
             defaultlocale = configfile.get(SECNAME, 'DefaultLocale')
         else:
             defaultlocale = ''
-        localization_locales(localeslist, defaultlocale)
+        if not baked('Localization.Locales', [localeslist, defaultlocale]):
+            if localization_locales(localeslist, defaultlocale):
+                bake_done('Localization.Locales', [localeslist,
+                    defaultlocale])
     
     # Edit keyboard model and layout 
     if configfile.has_option(SECNAME, 'KeyboardModel') or \
         configfile.has_option(SECNAME, 'KeyboardLayout'):
         model = configfile.get(SECNAME, 'KeyboardModel', fallback=None)
         layout = configfile.get(SECNAME, 'KeyboardLayout', fallback=None)
-        localization_keyboard(model, layout)
+        if not baked('Localization.Keyboard', [model, layout]):
+            if localization_keyboard(model, layout):
+                bake_done('Localization.Keyboard', [model, layout])
     
     # Edit timezone
     if configfile.has_option(SECNAME, 'TimeZone'):
-        localization_timezone(configfile.get(SECNAME, 'TimeZone'))
+        timezone = configfile.get(SECNAME, 'TimeZone')
+        if not baked('Localization.Timezone', timezone):
+            if localization_timezone(timezone):
+                bake_done('Localization.Timezone', timezone)
     
     sys.stdout.write('INFO: Localization config complete. \n')
     return False
@@ -892,9 +3788,48 @@ def setup_apt(configfile):
     if not configfile.has_section(SECNAME): return False
     sys.stdout.write('INFO: Configuring APT settings... \n')
     
+    # APT proxy: configured one first, then auto discovery if it is omitted
+    # or not reachable. Not reachable proxy is not used (direct download
+    # instead).
+    # (Proxy is a per-site setting, not configured at image build time.)
+    mirrorurl = configfile.get(SECNAME, 'Mirror', fallback='').strip()
+    discover = configfile.get(SECNAME, 'ProxyDiscover', fallback='0').strip()
+    def check(candidate):
+        sys.stdout.write('Checking APT proxy ' + candidate + '... \n')
+        if apt_proxy_check(candidate, mirrorurl and \
+            mirrorurl.rstrip('/') + '/dists/wheezy/Release'):
+            return True
+        sys.stderr.write('WARN: APT proxy ' + candidate + \
+            ' is not reachable. \n')
+        return False
+    if RPAC_MODE == 'bake':
+        pass
+    elif configfile.has_option(SECNAME, 'Proxy') or discover == '1':
+        proxyurl = configfile.get(SECNAME, 'Proxy', fallback='').strip()
+        if proxyurl and not check(proxyurl):
+            proxyurl = None
+        if not proxyurl and discover == '1':
+            sys.stdout.write('Looking for APT proxy on local network... \n')
+            port = configfile.get(SECNAME, 'ProxyPort',
+                fallback='3142').strip()
+            if port.isdigit():
+                proxyurl = apt_proxy_discover(int(port))
+                if proxyurl and not check(proxyurl):
+                    proxyurl = None
+            else:
+                sys.stderr.write('WARN: Invalid [APT].ProxyPort value. \n')
+        if proxyurl:
+            sys.stdout.write('INFO: Using APT proxy ' + proxyurl + '. \n')
+        else:
+            sys.stderr.write('WARN: No APT proxy usable, packages are ' + \
+                'downloaded directly. \n')
+        apt_proxy(proxyurl)
+    
     # Edit APT mirror
     if configfile.has_option(SECNAME, 'Mirror'):
-        apt_mirror(configfile.get(SECNAME, 'Mirror'))
+        if not baked('APT.Mirror', mirrorurl):
+            if apt_mirror(configfile.get(SECNAME, 'Mirror')):
+                bake_done('APT.Mirror', mirrorurl)
     
     sys.stdout.write('INFO: APT config complete. \n')
     return False
@@ -909,15 +3844,16 @@ def setup_remote(configfile):
     # Required during ssh and vnc setup
     import subprocess
     
-    # SSH
-    if configfile.has_option(SECNAME, 'SSH'):
+    # SSH (per-device, host keys must not be shared by all boards)
+    if configfile.has_option(SECNAME, 'SSH') and RPAC_MODE != 'bake':
         sys.stdout.write('Setting up SSH... \n')
         SSHonoff = configfile.get(SECNAME, 'SSH').strip()
+        if SSHonoff in ['0', '1']: artifact_service('ssh')
         if SSHonoff == '1':
-            subprocess.call(['update-rc.d', 'ssh', 'enable'])
-            subprocess.call(['invoke-rc.d', 'ssh', 'start'])
+            timed_call(['update-rc.d', 'ssh', 'enable'])
+            timed_call(['invoke-rc.d', 'ssh', 'start'])
         elif SSHonoff == '0':
-            subprocess.call(['update-rc.d', 'ssh', 'disable'])
+            timed_call(['update-rc.d', 'ssh', 'disable'])
         else:
             sys.stderr.write('WARN: Only 1 or 0 for option [Remote].SSH ' + \
                 'please. \n')
@@ -929,17 +3865,17 @@ def setup_remote(configfile):
                 sys.stdout.write('Generating SSH fingerprint... \n')
                 import os
                 try:
-                    os.remove('/etc/ssh/ssh_host_dsa_key')
-                    os.remove('/etc/ssh/ssh_host_dsa_key.pub')
-                    os.remove('/etc/ssh/ssh_host_ecdsa_key')
-                    os.remove('/etc/ssh/ssh_host_ecdsa_key.pub')
-                    os.remove('/etc/ssh/ssh_host_rsa_key')
-                    os.remove('/etc/ssh/ssh_host_rsa_key.pub')
+                    for keytype in ['dsa', 'ecdsa', 'rsa']:
+                        for suffix in ['', '.pub']:
+                            keyfile = '/etc/ssh/ssh_host_' + keytype + \
+                                '_key' + suffix
+                            artifact_edit(keyfile)
+                            os.remove(keyfile)
                 except:
                     pass
-                subprocess.call(['ssh-keygen', '-t', 'dsa', '-f', '/etc/ssh/ssh_host_dsa_key', '-N', '']) 
-                subprocess.call(['ssh-keygen', '-t', 'ecdsa', '-f', '/etc/ssh/ssh_host_ecdsa_key', '-N', '']) 
-                subprocess.call(['ssh-keygen', '-t', 'rsa', '-f', '/etc/ssh/ssh_host_rsa_key', '-N', '']) 
+                heavy_call(['ssh-keygen', '-t', 'dsa', '-f', '/etc/ssh/ssh_host_dsa_key', '-N', '']) 
+                heavy_call(['ssh-keygen', '-t', 'ecdsa', '-f', '/etc/ssh/ssh_host_ecdsa_key', '-N', '']) 
+                heavy_call(['ssh-keygen', '-t', 'rsa', '-f', '/etc/ssh/ssh_host_rsa_key', '-N', '']) 
             elif SSHkeyregen == '0':
                 pass
             else:
@@ -949,35 +3885,50 @@ def setup_remote(configfile):
     if configfile.has_option(SECNAME, 'VNC'):
         sys.stdout.write('Setting up VNC... \n')
         VNConoff = configfile.get(SECNAME, 'VNC').strip()
-        if VNConoff == '1':
+        vncsettings = [configfile.get(SECNAME, 'VNCPassword', fallback=None),
+            configfile.get(SECNAME, 'VNCResolution', fallback=None)]
+        if VNConoff == '1' and baked('Remote.VNC', vncsettings):
+            timed_call(['/etc/init.d/tightvncserver', 'start'])
+        elif VNConoff == '1':
             # [Remote].VNCPassword required on installing VNC
             if configfile.has_option(SECNAME, 'VNCPassword'):
                 # Install tightvncserver via APT
-                aptret = subprocess.call(['apt-get', '-y', 'install', 
+                artifact_packages(['tightvncserver'])
+                aptret = heavy_call(['apt-get', '-y', 'install', 
                     'tightvncserver'])
                 if aptret == 0:
                     # Set VNC Password via vncpasswd command
                     vncpasswd_unencry = configfile.get(SECNAME, 'VNCPassword')
-                    vncpasswd_proc = subprocess.Popen(['vncpasswd', '-f'], 
+                    vncpasswd_proc = timed_popen(['vncpasswd', '-f'], 
                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-                    vncpasswd_encry = vncpasswd_proc.communicate(bytes(
-                        vncpasswd_unencry, 'ascii'))[0]
+                    vncpasswd_encry = timed_communicate(vncpasswd_proc,
+                        bytes(vncpasswd_unencry, 'ascii'))[0]
+                    vncdone = vncpasswd_proc.returncode == 0 and \
+                        bool(vncpasswd_encry)
                     vncpasswd_proc = None
                     import os, os.path
                     try:
+                        artifact_edit(os.path.join(os.path.expanduser('~pi'),
+                            '.vnc'))
                         os.mkdir(os.path.join(os.path.expanduser('~pi'), 
                             '.vnc'))
-                        subprocess.call(['chown', 'pi:pi', os.path.join(
+                        timed_call(['chown', 'pi:pi', os.path.join(
                             os.path.expanduser('~pi'), '.vnc')])
-                        subprocess.call(['chmod', '644', os.path.join(
+                        timed_call(['chmod', '644', os.path.join(
                             os.path.expanduser('~pi'), '.vnc')])
                     except:
                         pass
                     vncpasswd_filepath = os.path.join(os.path.expanduser(
                         '~pi'), '.vnc/passwd')
-                    open(vncpasswd_filepath, 'wb').write(vncpasswd_encry)
-                    subprocess.call(['chown', 'pi:pi', vncpasswd_filepath])
-                    subprocess.call(['chmod', '600', vncpasswd_filepath])
+                    artifact_edit(vncpasswd_filepath)
+                    try:
+                        open(vncpasswd_filepath, 'wb').write(vncpasswd_encry)
+                    except IOError:
+                        sys.stderr.write('FAILED: Unable to write ' + \
+                            vncpasswd_filepath + '! \n')
+                        vncdone = False
+                    timed_call(['chown', 'pi:pi', vncpasswd_filepath])
+                    timed_call(['chmod', '600', vncpasswd_filepath])
                     # Read VNC Resolution
                     vnc_resolution = [None, None]
                     if configfile.has_option(SECNAME, 'VNCResolution'):
@@ -995,10 +3946,17 @@ def setup_remote(configfile):
                                 'value is in wrong format. \n' + \
                                 '(Default resolution is used instead.) \n')
                     # Setup VNC autorun
-                    remote_vnc_autorun_install(vnc_resolution[0], 
-                        vnc_resolution[1])
+                    if not remote_vnc_autorun_install(vnc_resolution[0], 
+                        vnc_resolution[1]):
+                        vncdone = False
                     # Start up VNC server
-                    subprocess.call(['/etc/init.d/tightvncserver', 'start'])
+                    if RPAC_MODE != 'bake':
+                        timed_call(['/etc/init.d/tightvncserver',
+                            'start'])
+                    if vncdone:
+                        bake_done('Remote.VNC', vncsettings)
+                    else:
+                        sys.stderr.write('FAILED: VNC setup incomplete. \n')
                 else:
                     sys.stderr.write('ERROR: Error occured on installing ' + \
                         'tightvncserver via apt-get!. \n')
@@ -1009,7 +3967,10 @@ def setup_remote(configfile):
                     '(Please specify a [Remote].VNCPassword value.) \n')
                 sys.stderr.write('FAILED: VNC server is not installed. \n')
         elif VNConoff == '0':
-            subprocess.call(['apt-get', '-y', 'remove', 'tightvncserver'])
+            if heavy_call(['apt-get', '-y', 'remove', 'tightvncserver']) == 0 \
+                and 'tightvncserver' in artifacts()['packages']:
+                artifacts()['packages'].remove('tightvncserver')
+                artifacts_save()
             remote_vnc_autorun_uninst()
         else:
             sys.stderr.write('WARN: Only 1 or 0 for option [Remote].VNC ' + \
@@ -1028,14 +3989,17 @@ def setup_simpchinese(configfile):
         ' settings... \n')
     
     # Required for using apt-get
-    import subprocess
     
     # Wenquanyi Font
     if configfile.has_option(SECNAME, 'WQYFont'):
         sys.stdout.write('Installing Wenquanyi Chinese font... \n')
         WQYinst = configfile.get(SECNAME, 'WQYFont').strip()
         if WQYinst == '1':
-            subprocess.call(['apt-get', '-y', 'install', 'ttf-wqy-zenhei'])
+            if not baked('SimpChinese.WQYFont', WQYinst):
+                artifact_packages(['ttf-wqy-zenhei'])
+                if heavy_call(['apt-get', '-y', 'install',
+                    'ttf-wqy-zenhei']) == 0:
+                    bake_done('SimpChinese.WQYFont', WQYinst)
         else:
             sys.stderr.write('WARN: Only 1 for option [SimpChinese].' + \
                 'WQYFont please. \n')
@@ -1048,15 +4012,21 @@ def setup_simpchinese(configfile):
         SCIMWubi_inst = configfile.get(SECNAME, 'SCIMWubi').strip()
         sys.stdout.write('Installing SCIM Chinese input method... \n')
         if SCIMPinyin_inst == '1':
-            subprocess.call(['apt-get', '-y', 'install', 'scim', 
-                'scim-pinyin'])
+            if not baked('SimpChinese.SCIMPinyin', SCIMPinyin_inst):
+                artifact_packages(['scim', 'scim-pinyin'])
+                if heavy_call(['apt-get', '-y', 'install', 'scim', 
+                    'scim-pinyin']) == 0:
+                    bake_done('SimpChinese.SCIMPinyin', SCIMPinyin_inst)
         else:
             sys.stderr.write('WARN: Only 1 for option [SimpChinese].' + \
                 'SCIMPinyin please. \n')
             sys.stderr.write('WARN: SCIM(Pinyin) not installed. \n')
         if SCIMWubi_inst == '1':
-            subprocess.call(['apt-get', '-y', 'install', 'scim', 
-                'scim-tables-zh'])
+            if not baked('SimpChinese.SCIMWubi', SCIMWubi_inst):
+                artifact_packages(['scim', 'scim-tables-zh'])
+                if heavy_call(['apt-get', '-y', 'install', 'scim', 
+                    'scim-tables-zh']) == 0:
+                    bake_done('SimpChinese.SCIMWubi', SCIMWubi_inst)
         else:
             sys.stderr.write('WARN: Only 1 for option [SimpChinese].' + \
                 'SCIMWubi please. \n')
@@ -1067,23 +4037,751 @@ def setup_simpchinese(configfile):
     return False
 # end of setup_simpchinese()
 
+# SD card benchmark on a scratch file of sizemb MB in directory: sequential
+#  write/read (MB/s), then 4K random write/read (IOPS) for up to duration
+#  seconds each. Page cache is dropped before reads, random writes are
+#  synchronous (O_DSYNC). Returns results measured.
+def benchmark_disk(directory, sizemb, duration=5):
+    import os, time, random
+    # Drop cached pages of the scratch file, so reads hit the SD card.
+    # Without posix_fadvise() (Python 3.2), the whole page cache is dropped.
+    def dropcache(fd):
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        else:
+            os.fsync(fd)
+            open('/proc/sys/vm/drop_caches', 'w').write('1')
+    # os.pwrite()/os.pread(), Python 3.3 or later
+    def pwrite(fd, data, offset):
+        if hasattr(os, 'pwrite'):
+            return os.pwrite(fd, data, offset)
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+    def pread(fd, size, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(fd, size, offset)
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+    results = {}
+    scratch = os.path.join(directory, '.raspi-autoconfig-benchmark')
+    block = os.urandom(1024 * 1024)
+    offsets = list(range(sizemb * 256)) # 4K blocks
+    try:
+        fd = os.open(scratch, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        started = time.time()
+        for i in range(sizemb):
+            os.write(fd, block)
+        os.fsync(fd)
+        results['seqwrite'] = sizemb / (time.time() - started)
+        os.close(fd)
+        
+        fd = os.open(scratch, os.O_RDONLY)
+        dropcache(fd)
+        started = time.time()
+        while os.read(fd, len(block)):
+            pass
+        results['seqread'] = sizemb / (time.time() - started)
+        os.close(fd)
+        
+        fd = os.open(scratch, os.O_WRONLY | os.O_DSYNC)
+        random.shuffle(offsets)
+        (count, started) = (0, time.time())
+        for offset in offsets:
+            if time.time() - started >= duration: break
+            pwrite(fd, block[:4096], offset * 4096)
+            count += 1
+        results['randwrite'] = count / (time.time() - started)
+        os.close(fd)
+        
+        fd = os.open(scratch, os.O_RDONLY)
+        dropcache(fd)
+        random.shuffle(offsets)
+        (count, started) = (0, time.time())
+        for offset in offsets:
+            if time.time() - started >= duration: break
+            pread(fd, 4096, offset * 4096)
+            count += 1
+        results['randread'] = count / (time.time() - started)
+        os.close(fd)
+    except (IOError, OSError) as err:
+        sys.stderr.write('WARN: SD card benchmark in ' + directory + \
+            ' aborted (' + str(err) + '). \n')
+    finally:
+        try:
+            os.remove(scratch)
+        except OSError:
+            pass
+    return results
+# end of benchmark_disk()
+
+# CPU and memory microbenchmark on a sizemb MB buffer: SHA-256 hashing and
+#  memory copy, both in MB/s.
+def benchmark_cpu(sizemb=16):
+    import hashlib, time
+    source = bytes(sizemb * 1024 * 1024)
+    started = time.time()
+    hashlib.sha256(source).digest()
+    results = {'cpu': sizemb / (time.time() - started)}
+    target = bytearray(len(source))
+    started = time.time()
+    for i in range(4):
+        target[:] = source
+    results['membw'] = 4 * sizemb / (time.time() - started)
+    return results
+# end of benchmark_cpu()
+
+# Network benchmark: ping latency (ms) and loss (%) to gateway, download
+#  throughput (MB/s) from url for up to duration seconds. Either may be None.
+def benchmark_network(gateway, url, duration=10):
+    import re, subprocess, time
+    results = {}
+    if gateway:
+        try:
+            output = timed_communicate(timed_popen(['ping', '-c', '10',
+                '-i', '0.2', '-q', gateway],
+                stdout=subprocess.PIPE))[0].decode('ascii', 'replace')
+        except OSError:
+            output = ''
+        m = re.search('(?P<loss>[\\d.]+)% packet loss', output)
+        if m: results['pingloss'] = float(m.group('loss'))
+        m = re.search('= [\\d.]+/(?P<avg>[\\d.]+)/', output)
+        if m: results['ping'] = float(m.group('avg'))
+    if url:
+        import urllib.request, socket
+        received = 0
+        try:
+            resp = urllib.request.urlopen(url,
+                timeout=max(1, deadline('network')))
+            started = time.time()
+            while time.time() - started < duration:
+                chunk = resp.read(65536)
+                if not chunk: break
+                received += len(chunk)
+            resp.close()
+            results['throughput'] = received / 1048576.0 / \
+                (time.time() - started)
+        except (urllib.error.URLError, socket.error) as err:
+            sys.stderr.write('WARN: Unable to download ' + url + ' (' + \
+                str(err) + '). \n')
+    return results
+# end of benchmark_network()
+
+def setup_benchmark(configfile):
+    SECNAME = 'Benchmark'
+    # Run only if proper section exists in autoconfig.ini
+    if not configfile.has_section(SECNAME): return False
+    sys.stdout.write('INFO: Running burn-in benchmark... \n')
+    
+    import os, time
+    
+    # [Benchmark].ScratchDir, ScratchSize: scratch file on SD card
+    directory = configfile.get(SECNAME, 'ScratchDir',
+        fallback='/var/tmp').strip()
+    sizemb = configfile.get(SECNAME, 'ScratchSize', fallback='64').strip()
+    if not sizemb.isdigit() or int(sizemb) == 0:
+        sys.stderr.write('WARN: Invalid [Benchmark].ScratchSize value, ' + \
+            '64 is used instead. \n')
+        sizemb = '64'
+    results = {}
+    sys.stdout.write('INFO: Benchmarking SD card... \n')
+    results.update(benchmark_disk(directory, int(sizemb)))
+    sys.stdout.write('INFO: Benchmarking CPU and memory... \n')
+    results.update(benchmark_cpu())
+    sys.stdout.write('INFO: Benchmarking network... \n')
+    gateway = default_gateway()
+    if not gateway:
+        sys.stderr.write('WARN: No gateway, ping benchmark skipped. \n')
+    results.update(benchmark_network(gateway,
+        configfile.get(SECNAME, 'ThroughputURL', fallback='').strip()))
+    
+    # Check thresholds and write report
+    board = inventory()
+    report = ['# raspi-autoconfig benchmark report',
+        'Date: ' + time.strftime('%Y-%m-%d %H:%M:%S'),
+        'Model: ' + board['model'], 'Serial: ' + board['serial'], '']
+    flagged = []
+    for (key, desc, unit, option, kind) in RPAC_BENCHMARK_TESTS:
+        if key not in results:
+            report.append(desc + ': not measured')
+            continue
+        line = desc + ': ' + str(round(results[key], 2)) + ' ' + unit
+        if configfile.has_option(SECNAME, option):
+            try:
+                threshold = float(configfile.get(SECNAME, option))
+            except ValueError:
+                sys.stderr.write('WARN: Invalid [Benchmark].' + option + \
+                    ' value, ignored. \n')
+            else:
+                if (kind == 'min' and results[key] < threshold) or \
+                    (kind == 'max' and results[key] > threshold):
+                    line += ' (' + kind + ' ' + str(threshold) + ') FLAGGED'
+                    flagged.append(desc)
+                else:
+                    line += ' (' + kind + ' ' + str(threshold) + ') OK'
+        report.append(line)
+        sys.stdout.write('INFO: ' + line + ' \n')
+    report += ['', 'Result: ' + ('FLAGGED' if flagged else 'PASS'), '']
+    reportpath = configfile.get(SECNAME, 'Report',
+        fallback=RPAC_BENCHMARK_REPORT).strip()
+    artifact_edit(reportpath)
+    try:
+        open(reportpath, 'w').write('\n'.join(report))
+    except (IOError, OSError):
+        sys.stderr.write('FAILED: Unable to write benchmark report ' + \
+            reportpath + '! \n')
+    
+    if flagged:
+        sys.stderr.write('FAILED: Board below benchmark thresholds: ' + \
+            ', '.join(flagged) + '. \n')
+    else:
+        sys.stdout.write('INFO: Benchmark passed, report in ' + \
+            reportpath + '. \n')
+    return False
+# end of setup_benchmark()
+
+# Read-only drift check (raspi-autoconfig.py --verify): verify_<section>()
+#  reads back the live state of what setup_<section>() configures. Nothing
+#  is written and no heavy command is run.
+# Each returns a list of differences: (option, setting, expected, actual).
+
+# Active value of a setting in config.txt text (last one wins), or None.
+def configtxt_get(cnftxt, name):
+    import re
+    values = re.findall('^\\s*' + re.escape(name) + '\\s*=\\s*(.*?)\\s*$',
+        cnftxt, flags=re.M)
+    return values[-1] if values else None
+# end of configtxt_get()
+
+# Names of packages installed, from /var/lib/dpkg/status.
+def dpkg_installed():
+    installed = set()
+    package = None
+    try:
+        for line in open('/var/lib/dpkg/status', 'r', encoding='UTF-8',
+            errors='replace'):
+            if line.startswith('Package:'):
+                package = line.split(':', 1)[1].strip()
+            elif line.startswith('Status:') and package and \
+                line.split()[-1] == 'installed':
+                installed.add(package)
+    except (IOError, OSError):
+        pass
+    return installed
+# end of dpkg_installed()
+
+# True if a service is enabled: under systemd, a native unit is enabled
+#  (linked in a .wants directory) and not masked; otherwise its init script
+#  has a start link in a runlevel.
+def service_enabled(name, runlevel='2'):
+    import glob, os
+    unit = name + '.service'
+    if os.path.isdir('/run/systemd/system') and any([os.path.exists(
+        os.path.join(unitdir, unit)) for unitdir in ['/etc/systemd/system',
+        '/lib/systemd/system']]):
+        if os.path.realpath('/etc/systemd/system/' + unit) == '/dev/null':
+            return False
+        return bool(glob.glob('/etc/systemd/system/*.wants/' + unit))
+    return bool(glob.glob('/etc/rc' + runlevel + '.d/S[0-9][0-9]' + name))
+# end of service_enabled()
+
+# Settings of a device in /etc/network/interfaces lines: 'inet' method and
+#  'address', 'netmask', 'gateway'.
+def interfaces_get(interflist, devname):
+    import re
+    settings = {}
+    current = None
+    for line in interflist:
+        if re.match('^\\s*#', line): continue
+        m = re.match('^\\s*iface\\s+(?P<dev>\\S+)\\s+inet\\s+(?P<method>\\S+)',
+            line)
+        if m:
+            current = m.group('dev')
+            if current == devname: settings['inet'] = m.group('method')
+            continue
+        if re.match('^\\s*(?:auto|allow-\\S+|mapping|source)\\b', line):
+            current = None
+            continue
+        m = re.match('^\\s*(?P<name>address|netmask|gateway)' + \
+            '\\s+(?P<value>\\S+)', line)
+        if m and current == devname:
+            settings[m.group('name')] = m.group('value')
+    return settings
+# end of interfaces_get()
+
+# Network blocks of wpa_supplicant.conf, as a list of dictionaries.
+def wpa_supplicant_networks(
+    conffile='/etc/wpa_supplicant/wpa_supplicant.conf'):
+    import re
+    try:
+        conf = open(conffile, 'r', encoding='UTF-8', errors='replace').read()
+    except (IOError, OSError):
+        return []
+    networks = []
+    for block in re.findall('^\\s*network\\s*=\\s*\\{(.*?)^\\s*\\}', conf,
+        flags=re.M | re.S):
+        network = {}
+        for m in re.finditer('^\\s*(?P<name>\\w+)\\s*=\\s*(?P<value>.*?)\\s*$',
+            block, flags=re.M):
+            network[m.group('name')] = m.group('value')
+        networks.append(network)
+    return networks
+# end of wpa_supplicant_networks()
+
+def verify_system(configfile):
+    SECNAME = 'System'
+    diffs = []
+    if configfile.has_option(SECNAME, 'BootBehavior'):
+        value = configfile.get(SECNAME, 'BootBehavior').strip().lower()
+        if value in ['commandlinelogin', 'desktopauto']:
+            expected = value == 'desktopauto'
+            actual = service_enabled('lightdm')
+            if actual != expected:
+                diffs.append(('BootBehavior', 'lightdm enabled', expected,
+                    actual))
+        if value == 'desktopauto':
+            try:
+                cnftxt = open('/etc/lightdm/lightdm.conf', 'r').read()
+            except (IOError, OSError):
+                cnftxt = ''
+            actual = configtxt_get(cnftxt, 'autologin-user')
+            if actual != 'pi':
+                diffs.append(('BootBehavior', 'lightdm.conf autologin-user',
+                    'pi', actual))
+    return diffs
+# end of verify_system()
+
+def verify_screen(configfile):
+    SECNAME = 'Screen'
+    import re
+    expected = {}
+    if configfile.has_option(SECNAME, 'Resolution'):
+        value = configfile.get(SECNAME, 'Resolution')
+        m = re.match('^(?P<hdmigroup>1|2),\\s*(?P<hdmimode>\\d+)$', value)
+        if value.lower() == 'auto':
+            expected.update({'hdmi_group': None, 'hdmi_mode': None,
+                'hdmi_ignore_edid': None})
+        elif m:
+            expected.update({'hdmi_group': str(int(m.group('hdmigroup'))),
+                'hdmi_mode': str(int(m.group('hdmimode'))),
+                'hdmi_ignore_edid': '0xa5000080'})
+    if configfile.has_option(SECNAME, 'Output'):
+        value = configfile.get(SECNAME, 'Output').lower()
+        if value in ['auto', 'hdmi', 'comp']:
+            expected['hdmi_force_hotplug'] = '1' if value == 'hdmi' else None
+            expected['hdmi_ignore_hotplug'] = '1' if value == 'comp' else None
+    try:
+        cnftxt = open('/boot/config.txt', 'r').read()
+    except (IOError, OSError):
+        cnftxt = ''
+    diffs = []
+    for name in sorted(expected):
+        actual = configtxt_get(cnftxt, name)
+        if actual != expected[name]:
+            diffs.append(('Output' if 'hotplug' in name else 'Resolution',
+                'config.txt ' + name, expected[name], actual))
+    return diffs
+# end of verify_screen()
+
+def verify_performance(configfile):
+    try:
+        cnftxt = open('/boot/config.txt', 'r').read()
+    except (IOError, OSError):
+        cnftxt = ''
+    settings = performance_settings(configfile)
+    inv = inventory()
+    diffs = []
+    for name in sorted(settings):
+        expected = performance_check(name, settings[name], inv)
+        if expected is False: continue
+        if expected is not None: expected = str(expected)
+        actual = configtxt_get(cnftxt, name)
+        if actual != expected:
+            diffs.append(('Profile', 'config.txt ' + name, expected, actual))
+    return diffs
+# end of verify_performance()
+
+def verify_memory(configfile):
+    SECNAME = 'Memory'
+    diffs = []
+    swaps = active_swaps()
+    value = configfile.get(SECNAME, 'Zram', fallback='').strip()
+    if value in ['0', '1']:
+        actual = '/dev/zram0' in swaps
+        if actual != (value == '1'):
+            diffs.append(('Zram', 'zram swap active', value == '1', actual))
+    if value == '1':
+        expected = zram_size(configfile.get(SECNAME, 'ZramSize', raw=True,
+            fallback='50%'))
+        try:
+            actual = int(open('/sys/block/zram0/disksize',
+                'r').read()) // 1048576
+        except (IOError, OSError, ValueError):
+            actual = None
+        if expected is not None and actual != expected:
+            diffs.append(('ZramSize', 'zram0 disksize (MB)', expected,
+                actual))
+    value = configfile.get(SECNAME, 'SwapFile', fallback='').strip()
+    if value.isdigit():
+        actual = '/var/swap' in swaps
+        if actual != (value != '0'):
+            diffs.append(('SwapFile', 'swapfile active', value != '0',
+                actual))
+        actual = service_enabled('dphys-swapfile')
+        if actual != (value != '0'):
+            diffs.append(('SwapFile', 'dphys-swapfile enabled',
+                value != '0', actual))
+    if value.isdigit() and value != '0':
+        try:
+            conf = open('/etc/dphys-swapfile', 'r').read()
+        except (IOError, OSError):
+            conf = ''
+        actual = configtxt_get(conf, 'CONF_SWAPSIZE')
+        if actual != value:
+            diffs.append(('SwapFile', 'dphys-swapfile CONF_SWAPSIZE', value,
+                actual))
+    value = configfile.get(SECNAME, 'Swappiness', fallback='').strip()
+    if value.isdigit():
+        try:
+            actual = open('/proc/sys/vm/swappiness', 'r').read().strip()
+        except (IOError, OSError):
+            actual = None
+        if actual != value:
+            diffs.append(('Swappiness', 'vm.swappiness', value, actual))
+    return diffs
+# end of verify_memory()
+
+def verify_tuning(configfile):
+    SECNAME = 'Tuning'
+    import os
+    CPUFREQDIR = '/sys/devices/system/cpu/cpu0/cpufreq/'
+    QUEUEDIR = os.path.join('/sys/block', configfile.get(SECNAME,
+        'BlockDevice', fallback='mmcblk0').strip(), 'queue')
+    def read(path):
+        try:
+            return open(path, 'r').read().strip()
+        except (IOError, OSError):
+            return None
+    diffs = []
+    value = configfile.get(SECNAME, 'Governor', fallback='').strip().lower()
+    if value:
+        actual = read(os.path.join(CPUFREQDIR, 'scaling_governor'))
+        if actual != value:
+            diffs.append(('Governor', 'scaling_governor', value, actual))
+    value = configfile.get(SECNAME, 'IOScheduler',
+        fallback='').strip().lower()
+    if value:
+        actual = sysfs_choices(os.path.join(QUEUEDIR, 'scheduler'))[1]
+        if actual != value:
+            diffs.append(('IOScheduler', 'queue/scheduler', value, actual))
+    value = configfile.get(SECNAME, 'ReadAhead', fallback='').strip()
+    if value.isdigit():
+        actual = read(os.path.join(QUEUEDIR, 'read_ahead_kb'))
+        if actual != value:
+            diffs.append(('ReadAhead', 'queue/read_ahead_kb', value, actual))
+    # Parameters not existing in running kernel are skipped by setup
+    for (name, value) in sysctl_settings(configfile):
+        actual = read(os.path.join('/proc/sys', name.replace('.', '/')))
+        if actual is not None and actual.split() != str(value).split():
+            diffs.append(('Sysctl', name, value, ' '.join(actual.split())))
+    return diffs
+# end of verify_tuning()
+
+def verify_storage(configfile):
+    SECNAME = 'Storage'
+    import re
+    try:
+        fstab = fstab_parse(open('/etc/fstab', 'r').read())
+    except (IOError, OSError):
+        fstab = []
+    rootentry = fstab_find(fstab, '/')
+    rootoptions = rootentry['fields'][3].split(',') if rootentry else []
+    diffs = []
+    if configfile.get(SECNAME, 'NoAtime', fallback='').strip() == '1':
+        if 'noatime' not in rootoptions:
+            diffs.append(('NoAtime', 'fstab / options', 'noatime',
+                ','.join(rootoptions) or None))
+    value = configfile.get(SECNAME, 'Commit', fallback='').strip()
+    if value.isdigit() and 'commit=' + value not in rootoptions:
+        diffs.append(('Commit', 'fstab / options', 'commit=' + value,
+            ','.join(rootoptions) or None))
+    for (option, mountpoint) in [('TmpfsTmp', '/tmp'),
+        ('TmpfsVarLog', '/var/log')]:
+        value = configfile.get(SECNAME, option, raw=True,
+            fallback='').strip()
+        if not re.match('^\\d+[kKmMgG%]?$', value): continue
+        entry = fstab_find(fstab, mountpoint)
+        if entry and entry['fields'][2] == 'tmpfs':
+            actual = [o.split('=', 1)[1] for o in \
+                entry['fields'][3].split(',') if o.startswith('size=')]
+            actual = actual[-1] if actual else ''
+        else:
+            actual = None
+        expected = None if value == '0' else value
+        if actual != expected:
+            diffs.append((option, 'fstab tmpfs ' + mountpoint + ' size',
+                expected, actual))
+    return diffs
+# end of verify_storage()
+
+def verify_wired(configfile):
+    SECNAME = 'Wired'
+    eths = inventory_wired()
+    if not eths or not configfile.has_option(SECNAME, 'DHCP'): return []
+    (ethdev, ethmac) = choose_eth(eths)
+    try:
+        interf = open('/etc/network/interfaces', 'r').read().split('\n')
+    except (IOError, OSError):
+        interf = []
+    actual = interfaces_get(interf, ethdev)
+    value = configfile.get(SECNAME, 'DHCP')
+    if value == '1':
+        expected = {'inet': 'dhcp'}
+    elif value == '0':
+        expected = {'inet': 'static',
+            'address': configfile.get(SECNAME, 'IP', fallback='').strip(),
+            'netmask': configfile.get(SECNAME, 'Subnet', fallback='').strip(),
+            'gateway': configfile.get(SECNAME, 'Gateway', fallback='').strip()}
+    else:
+        return []
+    diffs = []
+    for name in ['inet', 'address', 'netmask', 'gateway']:
+        if expected.get(name) != actual.get(name):
+            diffs.append(('DHCP' if name == 'inet' else {'address': 'IP',
+                'netmask': 'Subnet', 'gateway': 'Gateway'}[name],
+                ethdev + ' ' + name, expected.get(name), actual.get(name)))
+    return diffs
+# end of verify_wired()
+
+# Keys are compared, never reported (PSK is derived the way setup_wireless()
+#  does, see wpa_psk()).
+def verify_wireless(configfile):
+    saved = wpa_supplicant_networks()
+    diffs = []
+    for network in wireless_networks(configfile):
+        option = 'SSID' + (str(network['n']) if network['n'] > 1 else '')
+        ssid = network['ssid']
+        block = None
+        for candidate in saved:
+            if candidate.get('ssid') == '"' + ssid + '"': block = candidate
+        if block is None:
+            diffs.append((option, 'wpa_supplicant.conf network', ssid, None))
+            continue
+        passphrase = network['passphrase']
+        if not passphrase:
+            actual = 'psk' in block or 'wep_key0' in block
+            if actual:
+                diffs.append((option, ssid + ' key', 'open', 'encrypted'))
+            continue
+        if 'psk' in block:
+            matched = block['psk'] in [wpa_psk(ssid, passphrase),
+                '"' + passphrase + '"']
+        else:
+            matched = block.get('wep_key0') == passphrase
+        if not matched:
+            diffs.append((option.replace('SSID', 'Passphrase'), ssid + \
+                ' key', 'matching passphrase', 'different'))
+    return diffs
+# end of verify_wireless()
+
+def verify_localization(configfile):
+    SECNAME = 'Localization'
+    def readfile(path):
+        try:
+            return open(path, 'r').read()
+        except (IOError, OSError):
+            return ''
+    diffs = []
+    if configfile.has_option(SECNAME, 'Locales'):
+        # Only supported ones are written by localization_locales()
+        expected = [l.strip() for l in configfile.get(SECNAME,
+            'Locales').split(',') if l.strip()]
+        supported = readfile('/usr/share/i18n/SUPPORTED').split('\n')
+        expected = sorted(set([l for l in expected if l in supported]))
+        actual = sorted(set([l.strip() for l in readfile(
+            '/etc/locale.gen').split('\n') if l.strip() and \
+            not l.strip().startswith('#')]))
+        if expected != actual:
+            diffs.append(('Locales', '/etc/locale.gen', expected, actual))
+    if configfile.has_option(SECNAME, 'DefaultLocale'):
+        expected = configfile.get(SECNAME, 'DefaultLocale').strip()
+        actual = configtxt_get(readfile('/etc/default/locale'), 'LANG')
+        if actual and actual[0] == '"': actual = actual.strip('"')
+        if actual != expected:
+            diffs.append(('DefaultLocale', '/etc/default/locale LANG',
+                expected, actual))
+    keyboard = readfile('/etc/default/keyboard')
+    for (option, name) in [('KeyboardModel', 'XKBMODEL'),
+        ('KeyboardLayout', 'XKBLAYOUT')]:
+        if not configfile.has_option(SECNAME, option): continue
+        expected = configfile.get(SECNAME, option).strip()
+        actual = configtxt_get(keyboard, name)
+        if actual: actual = actual.strip('"')
+        if actual != expected:
+            diffs.append((option, '/etc/default/keyboard ' + name, expected,
+                actual))
+    if configfile.has_option(SECNAME, 'TimeZone'):
+        expected = configfile.get(SECNAME, 'TimeZone').strip()
+        actual = readfile('/etc/timezone').strip() or None
+        if actual != expected:
+            diffs.append(('TimeZone', '/etc/timezone', expected, actual))
+    return diffs
+# end of verify_localization()
+
+def verify_apt(configfile):
+    SECNAME = 'APT'
+    import re
+    if not configfile.has_option(SECNAME, 'Mirror'): return []
+    mirrorurl = configfile.get(SECNAME, 'Mirror').strip()
+    try:
+        aptlist = open('/etc/apt/sources.list', 'r').read()
+    except (IOError, OSError):
+        aptlist = ''
+    mirrors = re.findall('^\\s*deb\\s+(?:\\[[^\\]]*\\]\\s+)?(\\S+)', aptlist,
+        flags=re.M)
+    if mirrors == [mirrorurl]: return []
+    return [('Mirror', '/etc/apt/sources.list', [mirrorurl], mirrors)]
+# end of verify_apt()
+
+def verify_remote(configfile):
+    SECNAME = 'Remote'
+    import os
+    diffs = []
+    value = configfile.get(SECNAME, 'SSH', fallback='').strip()
+    if value in ['0', '1']:
+        actual = service_enabled('ssh')
+        if actual != (value == '1'):
+            diffs.append(('SSH', 'ssh enabled', value == '1', actual))
+    value = configfile.get(SECNAME, 'VNC', fallback='').strip()
+    if value in ['0', '1']:
+        actual = 'tightvncserver' in dpkg_installed()
+        if actual != (value == '1'):
+            diffs.append(('VNC', 'tightvncserver installed', value == '1',
+                actual))
+        actual = os.path.exists('/etc/init.d/tightvncserver') and \
+            service_enabled('tightvncserver')
+        if actual != (value == '1'):
+            diffs.append(('VNC', 'tightvncserver enabled', value == '1',
+                actual))
+    return diffs
+# end of verify_remote()
+
+def verify_simpchinese(configfile):
+    SECNAME = 'SimpChinese'
+    installed = dpkg_installed()
+    diffs = []
+    for (option, packages) in [('WQYFont', ['ttf-wqy-zenhei']),
+        ('SCIMPinyin', ['scim', 'scim-pinyin']),
+        ('SCIMWubi', ['scim', 'scim-tables-zh'])]:
+        if configfile.get(SECNAME, option, fallback='').strip() != '1':
+            continue
+        for package in packages:
+            if package not in installed:
+                diffs.append((option, package + ' installed', True, False))
+    return diffs
+# end of verify_simpchinese()
+
+# Run verify_<section>() of every section in configfile. Returns a report
+#  (JSON-serializable dictionary), 'ok' is True if no difference found.
+def verify(configfile, configfilepath):
+    import time
+    verifysteps = [('System', verify_system), ('Screen', verify_screen),
+        ('Performance', verify_performance), ('Memory', verify_memory),
+        ('Tuning', verify_tuning), ('Storage', verify_storage),
+        ('Wired', verify_wired), ('Wireless', verify_wireless),
+        ('Localization', verify_localization), ('APT', verify_apt),
+        ('Remote', verify_remote), ('SimpChinese', verify_simpchinese)]
+    report = {'config': configfilepath, 'serial': inventory()['serial'],
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'sections': [],
+        'drift': []}
+    for (secname, verifyfunc) in verifysteps:
+        if not configfile.has_section(secname): continue
+        report['sections'].append(secname)
+        for (option, setting, expected, actual) in verifyfunc(configfile):
+            report['drift'].append({'section': secname, 'option': option,
+                'setting': setting, 'expected': expected, 'actual': actual})
+    report['ok'] = not report['drift']
+    return report
+# end of verify()
+
 ############################################################
 ################ M A I N   R O U T L I N E  ################
 ############################################################
 
 def main(argv):
+    global RPAC_MODE
+    
+    # Build fleet manifest index, usually on the computer preparing the
+    # SD card images: raspi-autoconfig.py --fleet-index <manifest>
+    if len(argv) >= 2 and argv[1] == '--fleet-index':
+        if len(argv) != 3:
+            sys.stderr.write('Usage: ' + argv[0] + ' --fleet-index ' + \
+                '<manifest> \n')
+            return 2
+        try:
+            count = fleet_build_index(argv[2])
+        except (OSError, IOError) as err:
+            sys.stderr.write('ERROR: Unable to index fleet manifest (' + \
+                str(err) + '). \n')
+            return 1
+        sys.stdout.write('INFO: ' + str(count) + ' board(s) indexed in ' + \
+            argv[2] + '.idx \n')
+        return 0
+
+    # Bake mode: run device-independent steps only, inside a chroot of the
+    # image at image build time: raspi-autoconfig.py --bake [config file]
+    # Service mode: started by init script/systemd unit at early boot,
+    # with no terminal: raspi-autoconfig.py --service [config file]
+    args = argv[1:]
+    if args and args[0] == '--bake':
+        RPAC_MODE = 'bake'
+        args = args[1:]
+    elif args and args[0] == '--service':
+        RPAC_MODE = 'service'
+        args = args[1:]
+        import os
+        os.environ['DEBIAN_FRONTEND'] = 'noninteractive'
+    
+    # Verify mode: read-only check of live system against config file, JSON
+    # report on stdout (messages go to stderr): 
+    # raspi-autoconfig.py --verify [config file]
+    # Exit code is 0 if no difference found, 1 otherwise.
+    reportout = sys.stdout
+    if args and args[0] == '--verify':
+        RPAC_MODE = 'verify'
+        args = args[1:]
+        sys.stdout = sys.stderr
+    
     # System requirements check
     if not envreq():
         sys.stderr.write('ERROR: System requirements are not satisfied! \n')
         return 1
     
+    # Only one instance at a time
+    if RPAC_MODE != 'verify' and not run_lock():
+        sys.stderr.write('Notice: raspi-autoconfig is already running. \n')
+        return 2
+    
+    # Remove everything recorded in manifest (init scripts, packages, files
+    # created): raspi-autoconfig.py --uninstall
+    # Also restore edited files and services: raspi-autoconfig.py --rollback
+    if args and args[0] in ['--uninstall', '--rollback']:
+        rollback = args[0] == '--rollback'
+        if not artifacts_uninstall(rollback):
+            sys.stderr.write('ERROR: Some items could not be removed, ' + \
+                'run again to retry. \n')
+            return 1
+        if rollback:
+            sys.stdout.write('NOTICE: Reboot is needed for restored ' + \
+                'configuration to take effect. \n')
+        return 0
+    
     # Load config file
     # `/boot/autoconfig.ini` for default,
     # but can also be customized via command line.
-    if (len(sys.argv) < 2):
+    if not args:
         configfilepath = '/boot/autoconfig.ini'
     else:
-        configfilepath = sys.argv[1]
+        configfilepath = args[0]
     configfile = loadconfig(configfilepath)
     if not configfile:
         sys.stderr.write('Notice: autoconfig.ini file not found or ' + \
@@ -1091,9 +4789,17 @@ def main(argv):
         return 2
     else:
         pass
-    
-    # Exit if config file empty
-    configfileempty = True
+
+    # Merge last known config from provisioning server, then per-board
+    # overrides from fleet manifest
+    if RPAC_MODE != 'bake':
+        remote_config_cached(configfile)
+        fleet_apply(configfile, configfilepath)
+
+    # Exit if config file empty (config from provisioning server still to
+    # be fetched is not empty)
+    configfileempty = RPAC_MODE == 'bake' or \
+        not configfile.has_option('Fleet', 'ConfigURL')
     for sectionname in RPAC_SECTIONS:
         if configfile.has_section(sectionname):
             configfileempty = False
@@ -1103,22 +4809,116 @@ def main(argv):
             'autoconfig.ini file is empty. \n')
         return 2
     
+    if RPAC_MODE == 'verify':
+        import json
+        report = verify(configfile, configfilepath)
+        reportout.write(json.dumps(report, indent=1, sort_keys=True) + '\n')
+        return 0 if report['ok'] else 1
+    
     # Else, start program
     sys.stdout.write(RPAC_SPLASH_STRING)
     
     # Config routline
-    reboot = False
-    reboot = setup_system(configfile) or reboot
-    reboot = setup_screen(configfile) or reboot
-    reboot = setup_wired(configfile) or reboot
-    reboot = setup_wireless(configfile) or reboot
-    reboot = setup_localization(configfile) or reboot
-    reboot = setup_apt(configfile) or reboot
-    reboot = setup_remote(configfile) or reboot
-    reboot = setup_simpchinese(configfile) or reboot
+    setupsteps = [('System', setup_system), ('Screen', setup_screen),
+        ('Performance', setup_performance), ('Memory', setup_memory),
+        ('Tuning', setup_tuning), ('Storage', setup_storage),
+        ('Wired', setup_wired), ('Wireless', setup_wireless),
+        ('Localization', setup_localization), ('APT', setup_apt),
+        ('Remote', setup_remote), ('SimpChinese', setup_simpchinese),
+        ('Benchmark', setup_benchmark)]
+    if RPAC_MODE == 'bake':
+        setupsteps = [(secname, setupfunc) for (secname, setupfunc) in \
+            setupsteps if secname in RPAC_BAKE_SECTIONS]
+    if RPAC_MODE != 'bake':
+        clock_restore()
+    progress_start(configfile, [secname for (secname, setupfunc) in \
+        setupsteps if configfile.has_section(secname)])
+    memguard_setup(configfile)
+    deadline_setup(configfile)
+    
+    # Resume a run interrupted by watchdog reset (or power loss): sections
+    # completed are skipped. Watchdog is not used any more after too many
+    # attempts, not to reset the board forever.
+    resume = None
+    if RPAC_MODE != 'bake':
+        resume = resume_load(configfile)
+        resume['attempts'] += 1
+        if resume['done']:
+            sys.stdout.write('INFO: Resuming interrupted run (attempt ' + \
+                str(resume['attempts']) + '). \n')
+        resume_save(resume)
+        if resume['attempts'] <= RPAC_WATCHDOG['attempts']:
+            watchdog_start()
+        else:
+            sys.stderr.write('WARN: Run interrupted ' + \
+                str(resume['attempts'] - 1) + ' times, hardware ' + \
+                'watchdog not used. \n')
+    reboot = resume['reboot'] if resume else False
+    entropychecked = RPAC_MODE == 'bake' # No entropy stage in image chroot
+    networkstaged = RPAC_MODE == 'bake'
+    ran = []
+    for (secname, setupfunc) in setupsteps:
+        # Network stage, as soon as network is configured: wait for network
+        # (service mode), clock sync, new config from provisioning server.
+        # Sections added by the server are run now, sections already done
+        # are run again if changed and safe to repeat.
+        if secname not in RPAC_PRENETWORK_SECTIONS and not networkstaged:
+            networkstaged = True
+            # Clock is synchronised whenever network is up, even if no
+            # section needs it: waited for only if some section does.
+            needed = configfile.has_option('Fleet', 'ConfigURL') or \
+                configfile.has_section('Time') or \
+                any([configfile.has_section(name) \
+                for name in RPAC_NETWORK_SECTIONS])
+            if needed and RPAC_MODE == 'service':
+                network_wait()
+            time_sync(configfile)
+            changed = remote_config_update(configfile, configfilepath)
+            stepnames = [name for (name, func) in setupsteps]
+            for rerunname in remote_config_reruns(
+                stepnames[:stepnames.index(secname)], changed, ran):
+                rerunfunc = dict(setupsteps)[rerunname]
+                sys.stdout.write('INFO: [' + rerunname + '] ' + \
+                    ('changed' if rerunname in ran else 'added') + ' on ' + \
+                    'provisioning server, configuring with new settings. \n')
+                progress_section(rerunname)
+                deadline_section(rerunname)
+                reboot = rerunfunc(configfile) or reboot
+                ran.append(rerunname)
+        if not configfile.has_section(secname): continue
+        progress_section(secname)
+        ran.append(secname)
+        if resume and secname in resume['done']:
+            sys.stdout.write('INFO: [' + secname + '] already done before ' + \
+                'interruption, skipped. \n')
+            continue
+        deadline_section(secname)
+        if secname in RPAC_ENTROPY_SECTIONS and not entropychecked:
+            entropy_stage()
+            entropychecked = True
+        reboot = setupfunc(configfile) or reboot
+        if resume:
+            resume['done'].append(secname)
+            resume['reboot'] = reboot
+            resume_save(resume)
+
+    memguard_cleanup()
+    watchdog_stop()
+    deadline_finish()
+    
+    # Bake mode exit: first boot script is kept for per-device steps
+    if RPAC_MODE == 'bake':
+        sys.stdout.write('All device-independent configuration baked ' + \
+            'into image. \n')
+        progress_finish()
+        return 0
     
     # Normal Exit
+    resume_clear()
+    entropy_seed_save()
+    clock_save()
     sys.stdout.write('All configuration completed. \n')
+    progress_finish()
     
     # Restore raspi-config customized /etc/inittab to normal
     # (Enable RPICFG_TO_ENABLE line, disable RPICFG_TO_DISABLE line)
@@ -1131,15 +4931,18 @@ def main(argv):
     except:
         pass
     
+    # Remove early-boot service
+    if RPAC_MODE == 'service':
+        service_remove()
+    
     # Reboot
     if reboot:
         sys.stdout.write('NOTICE: Reboot is needed for some configuration ' + \
             'steps!!! \n')
         sys.stdout.write('SYSTEM IS GOING TO REBOOT IN 5 SECONDS. \n')
-        import subprocess
-        subprocess.call(['sleep', '5'])
-        subprocess.call(['sync'])
-        subprocess.call(['reboot'])
+        timed_call(['sleep', '5'])
+        timed_call(['sync'])
+        timed_call(['reboot'])
         return 0
     
     return 0
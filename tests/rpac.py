@@ -0,0 +1,27 @@
+# Loads raspi-autoconfig.py (not importable by its file name) as module
+# "rpac" for tests:
+#  from rpac import rpac
+
+import os
+
+RPAC_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'raspi-autoconfig.py')
+
+# Directory of test fixtures
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'fixtures')
+
+def load():
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('rpac', RPAC_SCRIPT)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except AttributeError: # Python 3.3 or earlier
+        import importlib.machinery
+        module = importlib.machinery.SourceFileLoader('rpac',
+            RPAC_SCRIPT).load_module()
+    return module
+# end of load()
+
+rpac = load()
@@ -0,0 +1,126 @@
+# APT proxy: check against a loopback stand-in caching proxy
+# (apt_proxy_check()), local subnet from the fake procfs tree
+# (local_subnet()), and discovery on loopback addresses
+# (apt_proxy_discover())
+
+import http.server
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from rpac import rpac, FIXTURES
+
+SYSROOT = os.path.join(FIXTURES, 'sysroot')
+
+MIRROR = 'http://mirror.invalid/raspbian'
+RELEASE = MIRROR + '/dists/wheezy/Release'
+
+# Caching proxy, which has the Release file of the mirror only
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        body = b'Origin: Raspbian\n'
+        self.send_response(200 if self.path == RELEASE else 404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def free_port(host='127.0.0.1'):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class ProxyTest(unittest.TestCase):
+    def start(self, host='127.0.0.1'):
+        self.server = http.server.HTTPServer((host, 0), ProxyHandler)
+        self.server.paths = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        return self.server.server_address[1]
+
+    def test_check(self):
+        proxyurl = 'http://127.0.0.1:' + str(self.start()) + '/'
+        self.assertTrue(rpac.apt_proxy_check(proxyurl, RELEASE))
+        self.assertEqual(self.server.paths, [RELEASE])
+        # Proxy answers, but has no such mirror
+        self.assertFalse(rpac.apt_proxy_check(proxyurl,
+            MIRROR + '/dists/jessie/Release'))
+        # https mirror is not proxied: connection check only
+        self.assertTrue(rpac.apt_proxy_check(proxyurl,
+            'https://mirror.invalid/raspbian/dists/wheezy/Release'))
+
+    def test_check_refused(self):
+        proxyurl = 'http://127.0.0.1:' + str(free_port()) + '/'
+        self.assertFalse(rpac.apt_proxy_check(proxyurl, RELEASE, timeout=1))
+        self.assertFalse(rpac.apt_proxy_check(proxyurl, timeout=1))
+
+    def test_local_subnet(self):
+        saved = rpac.RPAC_SYSROOT
+        try:
+            rpac.RPAC_SYSROOT = SYSROOT
+            # 192.168.0.0/23 of eth0
+            self.assertEqual(rpac.local_subnet('192.168.1.23'),
+                (0xc0a80000, 0xfffffe00))
+            # Most specific of 10.20.0.0/16 and 10.20.30.0/24 of wlan0
+            self.assertEqual(rpac.local_subnet('10.20.30.5'),
+                (0x0a141e00, 0xffffff00))
+            self.assertEqual(rpac.local_subnet('10.20.31.5'),
+                (0x0a140000, 0xffff0000))
+            # Default route is not a local subnet
+            self.assertIsNone(rpac.local_subnet('172.16.0.1'))
+        finally:
+            rpac.RPAC_SYSROOT = saved
+
+class DiscoverTest(unittest.TestCase):
+    # Loopback network 127.0.0.0/8 with gateway 127.0.0.1, proxy on
+    # 127.0.0.5 (any 127.x.x.x address is local on Linux)
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, 'proc/net'))
+        open(os.path.join(self.tmpdir, 'proc/net/route'), 'w').write(
+            'Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\t' + \
+            'Mask\t\tMTU\tWindow\tIRTT\n' + \
+            'lo\t0000007F\t00000000\t0001\t0\t0\t0\t000000FF\t0\t0\t0\n')
+        self.saved = (rpac.RPAC_SYSROOT, rpac.default_gateway,
+            rpac.RPAC_DEADLINES['runend'])
+        rpac.RPAC_SYSROOT = self.tmpdir
+        rpac.default_gateway = lambda: '127.0.0.1'
+
+    def tearDown(self):
+        (rpac.RPAC_SYSROOT, rpac.default_gateway,
+            rpac.RPAC_DEADLINES['runend']) = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def test_discover(self):
+        try:
+            server = http.server.HTTPServer(('127.0.0.5', 0), ProxyHandler)
+        except socket.error:
+            self.skipTest('127.0.0.5 not usable')
+        try:
+            port = server.server_address[1]
+            self.assertEqual(rpac.apt_proxy_discover(port),
+                'http://127.0.0.5:' + str(port) + '/')
+        finally:
+            server.server_close()
+
+    def test_discover_none(self):
+        self.assertIsNone(rpac.apt_proxy_discover(free_port(), 0.2))
+
+    def test_discover_deadline(self):
+        rpac.RPAC_DEADLINES['runend'] = time.time() - 1
+        self.assertIsNone(rpac.apt_proxy_discover(free_port()))
+
+if __name__ == '__main__':
+    unittest.main()
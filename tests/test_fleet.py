@@ -0,0 +1,107 @@
+# Fleet manifest: index (fleet_build_index(), fleet_index_lookup()) and
+# per-board overrides (fleet_apply()), board keys from the fake sysfs tree
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from rpac import rpac, FIXTURES
+
+SYSROOT = os.path.join(FIXTURES, 'sysroot')
+
+# Rows of other boards around the one of the fixture board (serial
+# abcdef01), in the middle of a manifest larger than the blocks checked
+# by the index header
+def manifest_csv(ip='10.0.0.42'):
+    lines = ['Key,Wired.DHCP,Wired.IP,Memory.ZramSize']
+    for n in range(10000):
+        lines.append('b8:27:eb:00:%02x:%02x,true,,' % (n // 256, n % 256))
+    lines.insert(5000, '00000000abcdef01,false,' + ip + ',50%')
+    return '\n'.join(lines) + '\n'
+
+MANIFEST_INI = '''\
+[b8:27:eb:00:00:01]
+Wired.DHCP = true
+
+[B8-27-EB-12-34-56]
+Wired.DHCP = false
+Wired.IP = 10.0.0.43
+'''
+
+class FleetTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = (rpac.RPAC_SYSROOT, rpac.RPAC_INVENTORY)
+        (rpac.RPAC_SYSROOT, rpac.RPAC_INVENTORY) = (SYSROOT, None)
+
+    def tearDown(self):
+        (rpac.RPAC_SYSROOT, rpac.RPAC_INVENTORY) = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        open(path, 'w').write(text)
+        return path
+
+    def apply(self, manifest):
+        configfilepath = self.write('autoconfig.ini',
+            '[Fleet]\nManifest = ' + manifest + '\n\n[Wired]\nDHCP = true\n')
+        configfile = rpac.loadconfig(configfilepath)
+        rpac.fleet_apply(configfile, configfilepath)
+        return configfile
+
+    def test_index_lookup(self):
+        path = self.write('fleet.csv', manifest_csv())
+        self.assertEqual(rpac.fleet_build_index(path), 10001)
+        offset = rpac.fleet_index_lookup(path, 'abcdef01')
+        self.assertGreater(offset, 0)
+        self.assertEqual(rpac.fleet_row_key(path, offset), 'abcdef01')
+        self.assertEqual(rpac.fleet_read_row(path, offset)[('Wired', 'IP')],
+            '10.0.0.42')
+        self.assertEqual(rpac.fleet_index_lookup(path, 'b8:27:eb:ff:ff:ff'),
+            -1)
+
+    def test_apply(self):
+        path = self.write('fleet.csv', manifest_csv())
+        rpac.fleet_build_index(path)
+        configfile = self.apply('fleet.csv')
+        self.assertEqual(configfile.get('Wired', 'DHCP'), 'false')
+        self.assertEqual(configfile.get('Wired', 'IP'), '10.0.0.42')
+        self.assertEqual(configfile.get('Memory', 'ZramSize'), '50%')
+
+    def test_apply_ini(self):
+        self.write('fleet.ini', MANIFEST_INI)
+        configfile = self.apply('fleet.ini')
+        self.assertEqual(configfile.get('Wired', 'IP'), '10.0.0.43')
+
+    def test_stale_index(self):
+        path = self.write('fleet.csv', manifest_csv())
+        rpac.fleet_build_index(path)
+        # Longer row: size and offsets of later rows change
+        self.write('fleet.csv', manifest_csv('10.0.100.142'))
+        self.assertIsNone(rpac.fleet_index_lookup(path, 'abcdef01'))
+        configfile = self.apply('fleet.csv')
+        self.assertEqual(configfile.get('Wired', 'IP'), '10.0.100.142')
+
+    def test_stale_index_same_size(self):
+        path = self.write('fleet.csv', manifest_csv())
+        rpac.fleet_build_index(path)
+        # Row moved in the middle of the manifest, same size: index header
+        # still matches, but the row found has another key
+        lines = manifest_csv().splitlines(True)
+        row = lines.pop(5000)
+        lines.insert(4000, row)
+        self.write('fleet.csv', ''.join(lines))
+        self.assertIsNotNone(rpac.fleet_index_lookup(path, 'abcdef01'))
+        configfile = self.apply('fleet.csv')
+        self.assertEqual(configfile.get('Wired', 'IP'), '10.0.0.42')
+
+    def test_not_listed(self):
+        self.write('fleet.ini', MANIFEST_INI.replace('12-34-56', '65-43-21'))
+        configfile = self.apply('fleet.ini')
+        self.assertEqual(configfile.get('Wired', 'DHCP'), 'true')
+        self.assertFalse(configfile.has_option('Wired', 'IP'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# /etc/fstab editing (fstab_parse(), fstab_set_tmpfs(), fstab_format()) and
+# checking (fstab_check()), filesystem types from the fake procfs tree
+
+import os
+import unittest
+
+from rpac import rpac, FIXTURES
+
+SYSROOT = os.path.join(FIXTURES, 'sysroot')
+
+FSTAB = '''\
+proc            /proc           proc    defaults          0       0
+/dev/mmcblk0p1  /boot           vfat    defaults          0       2
+/dev/mmcblk0p2  /               ext4    defaults,noatime  0       1
+# a swapfile is not a swap partition, so no using swapon|off from here on
+'''
+
+class FstabTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = rpac.RPAC_SYSROOT
+        rpac.RPAC_SYSROOT = SYSROOT
+
+    def tearDown(self):
+        rpac.RPAC_SYSROOT = self.saved
+
+    def test_tmpfs(self):
+        entries = rpac.fstab_parse(FSTAB)
+        rpac.fstab_set_tmpfs(entries, '/tmp', '10%', '1777')
+        self.assertEqual(rpac.fstab_check(entries), [])
+        text = rpac.fstab_format(entries)
+        self.assertIn('size=10%', text)
+        self.assertTrue(text.startswith(FSTAB.rstrip('\n')))
+        rpac.fstab_set_tmpfs(entries, '/tmp', None, '1777')
+        self.assertEqual(rpac.fstab_format(entries), FSTAB)
+
+    def test_original(self):
+        self.assertEqual(rpac.fstab_check(rpac.fstab_parse(FSTAB)), [])
+
+    def test_invalid_lines(self):
+        problems = rpac.fstab_check(rpac.fstab_parse(FSTAB + \
+            '/dev/sda1 /mnt\n' + \
+            '/dev/sda2 /mnt/usb ext4 defaults 0 2 extra\n' + \
+            '/dev/sda3 /boot vfat defaults 0 x\n'))
+        self.assertEqual(len(problems), 4)
+        self.assertTrue(problems[0].startswith('line 5: too few'))
+        self.assertTrue(problems[1].startswith('line 6: too many'))
+        self.assertTrue(problems[2].startswith('line 7: dump and pass'))
+        self.assertTrue(problems[3].startswith('line 7: duplicate'))
+
+    def test_changed_entries(self):
+        entries = rpac.fstab_parse(FSTAB)
+        rpac.fstab_set_tmpfs(entries, '/nonexistent/raspi-autoconfig',
+            '64M', '0755')
+        rpac.fstab_set_option(rpac.fstab_find(entries, '/'), 'commit=60')
+        rpac.fstab_find(entries, '/')['fields'][2] = 'ext5'
+        problems = rpac.fstab_check(entries)
+        self.assertEqual(len(problems), 2)
+        self.assertIn('unknown filesystem type ext5', problems[0])
+        self.assertIn('/nonexistent/raspi-autoconfig does not exist',
+            problems[1])
+
+if __name__ == '__main__':
+    unittest.main()
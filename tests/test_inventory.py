@@ -0,0 +1,74 @@
+# Hardware inventory (inventory_load()) against a fake sysfs/procfs tree
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from rpac import rpac, FIXTURES
+
+SYSROOT = os.path.join(FIXTURES, 'sysroot')
+
+class InventoryTest(unittest.TestCase):
+    def test_nics(self):
+        inv = rpac.inventory_load(SYSROOT)
+        nics = dict((nic['name'], nic) for nic in inv['nics'])
+        self.assertEqual(sorted(nics), ['eth0', 'lo', 'wlan0'])
+        self.assertEqual(nics['eth0']['mac'], 'b8:27:eb:12:34:56')
+        self.assertEqual(nics['eth0']['type'], 1)
+        self.assertTrue(nics['eth0']['physical'])
+        self.assertFalse(nics['eth0']['wireless'])
+        self.assertEqual(nics['wlan0']['mac'], 'b8:27:eb:ab:cd:ef')
+        self.assertTrue(nics['wlan0']['wireless'])
+        self.assertEqual(nics['lo']['mac'], '')
+        self.assertFalse(nics['lo']['physical'])
+
+    def test_board(self):
+        inv = rpac.inventory_load(SYSROOT)
+        self.assertEqual(inv['revision'], 'a02082')
+        self.assertEqual(inv['model'], '3B')
+        self.assertEqual(inv['ram'], 1024)
+        self.assertEqual(inv['memtotal'], 926)
+        self.assertEqual(inv['serial'], '00000000abcdef01')
+        self.assertEqual(inv['hardware'], 'bcm2835')
+
+    def test_shared(self):
+        saved = (rpac.RPAC_SYSROOT, rpac.RPAC_INVENTORY)
+        try:
+            (rpac.RPAC_SYSROOT, rpac.RPAC_INVENTORY) = (SYSROOT, None)
+            self.assertEqual(rpac.inventory_wired(),
+                [('eth0', 'b8:27:eb:12:34:56')])
+            self.assertEqual(rpac.inventory_wireless(),
+                [('wlan0', 'b8:27:eb:ab:cd:ef')])
+            self.assertEqual(rpac.fleet_device_keys(), ['b8:27:eb:12:34:56',
+                'b8:27:eb:ab:cd:ef', 'abcdef01'])
+        finally:
+            (rpac.RPAC_SYSROOT, rpac.RPAC_INVENTORY) = saved
+
+    def test_missing_tree(self):
+        inv = rpac.inventory_load(os.path.join(FIXTURES, 'nonexistent'))
+        self.assertEqual(inv['nics'], [])
+        self.assertEqual(inv['model'], '')
+        self.assertEqual(inv['ram'], 0)
+
+    def test_revisions(self):
+        # (revision, model, RAM in MB)
+        boards = [('000e', 'B', 512), ('1000002', 'B', 256),
+            ('9000c1', 'ZeroW', 512), ('a020d3', '3B+', 1024),
+            ('c03111', '4B', 4096), ('c03130', '400', 4096),
+            ('a03140', 'CM4', 1024), ('d03140', 'CM4', 8192),
+            ('902120', 'Zero2W', 512)]
+        sysroot = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(sysroot, 'proc'))
+            for (revision, model, ram) in boards:
+                with open(os.path.join(sysroot, 'proc/cpuinfo'), 'w') as f:
+                    f.write('Revision\t: ' + revision + '\n')
+                inv = rpac.inventory_load(sysroot)
+                self.assertEqual((inv['model'], inv['ram']), (model, ram),
+                    revision)
+        finally:
+            shutil.rmtree(sysroot)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# Config from provisioning server: merging over autoconfig.ini
+# (config_merge()), fetching with ETag revalidation from a loopback HTTP
+# server (remote_config_fetch(), remote_config_cached(),
+# remote_config_update()), and sections configured again
+# (remote_config_reruns())
+
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from rpac import rpac
+
+BASE = '''\
+[Fleet]
+ConfigURL = http://127.0.0.1/autoconfig.ini
+
+[Memory]
+ZramSize = 25%
+'''
+
+class ConfigMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.configfilepath = os.path.join(self.tmpdir, 'autoconfig.ini')
+        open(self.configfilepath, 'w').write(BASE)
+        self.configfile = rpac.loadconfig(self.configfilepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_percent_values(self):
+        rpac.config_merge(self.configfile, '[Memory]\nZramSize = 50%\n' + \
+            '[Storage]\nTmpfsTmp = 10%\n')
+        self.assertEqual(self.configfile.get('Memory', 'ZramSize'), '50%')
+        self.assertEqual(self.configfile.get('Storage', 'TmpfsTmp',
+            raw=True), '10%')
+
+    def test_fleet_unchanged(self):
+        rpac.config_merge(self.configfile,
+            '[Fleet]\nConfigURL = http://example.com/other.ini\n')
+        self.assertEqual(self.configfile.get('Fleet', 'ConfigURL'),
+            'http://127.0.0.1/autoconfig.ini')
+
+REMOTE = '''\
+[Memory]
+ZramSize = 50%
+
+[Screen]
+Resolution = 1280x720
+'''
+
+class ConfigHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers.items()))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = REMOTE.encode('UTF-8')
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class RemoteConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = (rpac.RPAC_STATEDIR, rpac.RPAC_REMOTE_CONFIG,
+            rpac.RPAC_REMOTE_META)
+        rpac.RPAC_STATEDIR = os.path.join(self.tmpdir, 'state')
+        rpac.RPAC_REMOTE_CONFIG = os.path.join(rpac.RPAC_STATEDIR,
+            'remote.ini')
+        rpac.RPAC_REMOTE_META = os.path.join(rpac.RPAC_STATEDIR,
+            'remote.json')
+        self.server = http.server.HTTPServer(('127.0.0.1', 0),
+            ConfigHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:' + \
+            str(self.server.server_address[1]) + '/autoconfig.ini'
+        self.configfilepath = os.path.join(self.tmpdir, 'autoconfig.ini')
+        open(self.configfilepath, 'w').write(BASE.replace(
+            'http://127.0.0.1/autoconfig.ini', self.url))
+
+    def tearDown(self):
+        self.stop()
+        (rpac.RPAC_STATEDIR, rpac.RPAC_REMOTE_CONFIG,
+            rpac.RPAC_REMOTE_META) = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.server.shutdown()
+            self.thread.join()
+        self.server.server_close()
+
+    def test_fetch(self):
+        self.assertEqual(rpac.remote_config_fetch(self.url), (REMOTE, True))
+        self.assertEqual(open(rpac.RPAC_REMOTE_CONFIG).read(), REMOTE)
+        # Revalidated with ETag of cached copy
+        self.assertEqual(rpac.remote_config_fetch(self.url), (REMOTE, False))
+        self.assertEqual(self.server.requests[1].get('If-None-Match'),
+            '"v1"')
+
+    def test_unreachable(self):
+        rpac.remote_config_fetch(self.url)
+        self.stop()
+        self.assertEqual(rpac.remote_config_fetch(self.url, timeout=1),
+            (REMOTE, False))
+        # Cached copy applies at start of next run
+        configfile = rpac.loadconfig(self.configfilepath)
+        rpac.remote_config_cached(configfile)
+        self.assertEqual(configfile.get('Memory', 'ZramSize'), '50%')
+
+    def test_unreachable_no_cache(self):
+        self.stop()
+        self.assertEqual(rpac.remote_config_fetch(self.url, timeout=1),
+            (None, False))
+
+    def test_update(self):
+        configfile = rpac.loadconfig(self.configfilepath)
+        self.assertEqual(sorted(rpac.remote_config_update(configfile,
+            self.configfilepath)), ['Memory', 'Screen'])
+        self.assertEqual(configfile.get('Screen', 'Resolution'), '1280x720')
+        # Unchanged on server: nothing to configure again
+        self.assertEqual(rpac.remote_config_update(configfile,
+            self.configfilepath), [])
+
+    def test_reruns(self):
+        stepnames = ['System', 'Screen', 'Memory', 'Wired']
+        # Screen added by server; Memory run and safe to repeat; Wired
+        # run, not safe to repeat (restarts network)
+        self.assertEqual(rpac.remote_config_reruns(stepnames,
+            ['Screen', 'Memory', 'Wired', 'APT'], ['System', 'Memory',
+            'Wired']), ['Screen', 'Memory'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# Clock offset from SNTP (sntp_offset()) and HTTP Date header
+# (http_date_offset()), against loopback servers running OFFSET seconds
+# ahead; default gateway (default_gateway()) needed for clock sync, from
+# the fake procfs tree
+
+import email.utils
+import http.server
+import os
+import shutil
+import socket
+import struct
+import threading
+import tempfile
+import time
+import unittest
+
+from rpac import rpac, FIXTURES
+
+SYSROOT = os.path.join(FIXTURES, 'sysroot')
+
+OFFSET = 1000.25
+NTP_DELTA = 2208988800
+
+def ntp_stamp(seconds):
+    return struct.pack('!II', int(seconds) + NTP_DELTA,
+        int((seconds % 1) * 2**32))
+
+class SntpServer(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        try:
+            (data, peer) = self.sock.recvfrom(512)
+        except socket.error:
+            return
+        stamp = ntp_stamp(time.time() + OFFSET)
+        # LI 0, version 4, mode 4 (server), stratum 2; originate timestamp
+        # is transmit timestamp of the request
+        reply = b'\x24\x02' + bytes(22) + data[40:48] + stamp + stamp
+        self.sock.sendto(reply, peer)
+
+class DateHandler(http.server.BaseHTTPRequestHandler):
+    # No do_GET: a GET request gets an error page with the real date
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    # Date header of send_response()
+    def date_time_string(self, timestamp=None):
+        if timestamp is None and self.command == 'HEAD':
+            timestamp = time.time() + OFFSET
+        return email.utils.formatdate(timestamp, usegmt=True)
+
+    def log_message(self, *args):
+        pass
+
+class TimeOffsetTest(unittest.TestCase):
+    def test_sntp_offset(self):
+        server = SntpServer()
+        server.start()
+        try:
+            offset = rpac.sntp_offset('127.0.0.1:' + str(server.port))
+        finally:
+            server.join(5)
+            server.sock.close()
+        self.assertIsNotNone(offset)
+        self.assertAlmostEqual(offset, OFFSET, delta=0.1)
+
+    def test_sntp_offset_no_server(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        try:
+            self.assertIsNone(rpac.sntp_offset('127.0.0.1:' + str(port),
+                timeout=0.5))
+        finally:
+            sock.close()
+
+    def test_http_date_offset(self):
+        server = http.server.HTTPServer(('127.0.0.1', 0), DateHandler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.daemon = True
+        thread.start()
+        try:
+            offset = rpac.http_date_offset('http://127.0.0.1:' + \
+                str(server.server_address[1]) + '/')
+        finally:
+            thread.join(5)
+            server.server_close()
+        self.assertIsNotNone(offset)
+        # Date header has 1 second resolution
+        self.assertAlmostEqual(offset, OFFSET, delta=1)
+
+class DefaultGatewayTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = rpac.RPAC_SYSROOT
+
+    def tearDown(self):
+        rpac.RPAC_SYSROOT = self.saved
+
+    def test_gateway(self):
+        rpac.RPAC_SYSROOT = SYSROOT
+        self.assertEqual(rpac.default_gateway(), '192.168.1.1')
+
+    def test_short_lines(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        os.makedirs(os.path.join(tmpdir, 'proc/net'))
+        open(os.path.join(tmpdir, 'proc/net/route'), 'w').write(
+            'Iface\tDestination\tGateway\n' + \
+            'eth0\t00000000\t0101A8C0\n')
+        rpac.RPAC_SYSROOT = tmpdir
+        self.assertIsNone(rpac.default_gateway())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# WPA pre-shared key derivation (wpa_psk()), IEEE 802.11i-2004 H.4.2
+
+import hashlib
+import unittest
+
+from rpac import rpac
+
+# (SSID, passphrase, PSK)
+VECTORS = [
+    ('IEEE', 'password',
+        'f42c6fc52df0ebef9ebb4b90b38a5f902e83fe1b135a70e23aed762e9710a12e'),
+    ('ThisIsASSID', 'ThisIsAPassword',
+        '0dc0d6eb90555ed6419756b9a15ec3e3209b63df707dd508d14581f8982721af')]
+
+class WpaPskTest(unittest.TestCase):
+    def setUp(self):
+        rpac.RPAC_PSK_CACHE.clear()
+
+    def test_vectors(self):
+        for (ssid, passphrase, psk) in VECTORS:
+            self.assertEqual(rpac.wpa_psk(ssid, passphrase), psk, ssid)
+
+    def test_vectors_without_pbkdf2_hmac(self):
+        # Fallback of Python 3.3 and earlier
+        saved = getattr(hashlib, 'pbkdf2_hmac')
+        try:
+            del hashlib.pbkdf2_hmac
+            for (ssid, passphrase, psk) in VECTORS:
+                self.assertEqual(rpac.wpa_psk(ssid, passphrase), psk, ssid)
+        finally:
+            hashlib.pbkdf2_hmac = saved
+
+    def test_hex_key(self):
+        psk = VECTORS[0][2]
+        self.assertEqual(rpac.wpa_psk('any', psk.upper()), psk)
+
+    def test_invalid_length(self):
+        self.assertIsNone(rpac.wpa_psk('IEEE', 'short'))
+        self.assertIsNone(rpac.wpa_psk('IEEE', 'x' * 64))
+
+if __name__ == '__main__':
+    unittest.main()